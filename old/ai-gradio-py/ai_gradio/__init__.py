@@ -1,5 +1,10 @@
 """
 AI Gradio - Web Application Generator
 """
+from dotenv import load_dotenv
 
 __version__ = "0.1.0"
+
+# .envファイルから環境変数を読み込みます
+# （ai_gradio 内の各モジュールは import 時に設定値を読むため、パッケージの読み込み時に読み込む）
+load_dotenv()
@@ -1,9 +1,16 @@
+import os
 import uvicorn
 from .integrated_gradio import build_interface
 from .api_llm import app as fastapi_app
+from .clients import client_registry, CLIENT_WARMUP
+from .config import env_int
 import gradio as gr
 from fastapi.middleware.cors import CORSMiddleware
 
+# サーバーのホストとポート
+HOST = os.environ.get("HOST", "0.0.0.0")
+PORT = env_int("PORT", 7860)
+
 def create_app():
     # FastAPI アプリケーションの設定
     fastapi_app.add_middleware(
@@ -14,6 +21,11 @@ def create_app():
         allow_headers=["*"],
     )
     
+    # CLIENT_WARMUP が有効な場合は provider のAPIクライアントを起動時に生成する
+    # （無効な場合は最初の呼び出し時に生成する。終了時は api_llm の lifespan で閉じる）
+    if CLIENT_WARMUP:
+        client_registry.warmup()
+    
     # Gradio インターフェースの作成
     demo = build_interface()
     
@@ -29,8 +41,8 @@ def main():
     # サーバーの起動
     uvicorn.run(
         app,
-        host="0.0.0.0",
-        port=7860,
+        host=HOST,
+        port=PORT,
         log_level="info"
     )
 
@@ -1,70 +1,304 @@
-from fastapi import FastAPI
-from fastapi.responses import PlainTextResponse, JSONResponse
-from pydantic import BaseModel
-from dotenv import load_dotenv
+from fastapi import FastAPI, Request
+from fastapi.responses import PlainTextResponse, JSONResponse, StreamingResponse, Response
+from starlette.background import BackgroundTask
+from pydantic import BaseModel, field_validator, model_validator
+from typing import List, Optional
 from enum import Enum
-import re
-
-# 環境変数の読み込み
-load_dotenv()
+from contextlib import asynccontextmanager
+import asyncio
+import json
 
 # integrated_gradio から必要な関数と定数をインポート
-from .integrated_gradio import generate_gemini, DEFAULT_TEXT_SYSTEM_PROMPT
-from .logging_config import setup_logging  # ロガーをインポート
+from .integrated_gradio import (
+    complete,
+    stream_complete,
+    INTEGRATED_MODELS,
+    DEFAULT_TEXT_SYSTEM_PROMPT,
+    DEFAULT_JSON_SYSTEM_PROMPT,
+)
+from .config import env_int
+from .logging_config import setup_logging, truncate  # ロガーをインポート
+from .clients import client_registry
+from .cache import response_cache
+from .singleflight import llm_single_flight
+from .kroki import kroki_renderer
+from .artifacts import artifact_store, ARTIFACT_ROUTE_PREFIX, ARTIFACT_GZIP_MIN_BYTES
+from .metrics import metrics_registry
+from .scheduler import generation_scheduler
+from .scheduler import llm_api_gate, Overloaded
+from .resilience import provider_resilience
+from .routing import llm_api_router, LLM_API_FALLBACK_MODELS
+from .executors import executor_registry
+from .shared_state import shared_state
+from .fences import CodeExtractor, extract_code
+from .static_assets import static_assets, STATIC_ROUTE_PREFIX
+from .jsx import jsx_compiler
 
 # ロガーの初期化
 logger = setup_logging()
 
-app = FastAPI()
+# 1リクエストでまとめて実行できるプロンプト数と、その同時実行数
+LLM_API_MAX_BATCH = env_int("LLM_API_MAX_BATCH", 32)
+LLM_API_BATCH_CONCURRENCY = env_int("LLM_API_BATCH_CONCURRENCY", 8)
+
+@asynccontextmanager
+async def lifespan(app):
+    yield
+    # 終了時に共有のAPIクライアントのコネクションを閉じる
+    await client_registry.aclose()
+    await kroki_renderer.aclose()
+    executor_registry.shutdown()
+    await shared_state.aclose()
+
+app = FastAPI(lifespan=lifespan)
 
 # フォーマットタイプの列挙型
 class FormatType(str, Enum):
     TEXT = "text"
     JSON = "json"
 
-def remove_code_block(text):
-    """コードブロックを除去する関数"""
-    # ```json や ``` で囲まれたブロックから中身だけを抽出
-    pattern = r'```(?:json)?\n?(.*?)\n?```'
-    match = re.search(pattern, text, re.DOTALL)
-    if match:
-        return match.group(1).strip()
-    return text.strip()
+DEFAULT_MODEL = "gemini:gemini-2.0-flash"
+
+def resolve_model(value):
+    """
+    モデル名を INTEGRATED_MODELS の "provider:model" 形式に解決する
+    （"gemini-2.0-flash" のように provider を省略した指定も受け付ける）
+    """
+    if value in INTEGRATED_MODELS:
+        return value
+    for full_model in INTEGRATED_MODELS:
+        if full_model.split(":", 1)[1] == value:
+            return full_model
+    raise ValueError(f"Unknown model: {value}. Available models: {', '.join(INTEGRATED_MODELS)}")
+
+def load_fallback_models(names):
+    """LLM_API_FALLBACK_MODELS を解決する（不明なモデルは警告して除外する）"""
+    models = []
+    for name in names:
+        try:
+            models.append(resolve_model(name))
+        except ValueError as e:
+            logger.warning(f"Ignoring fallback model: {e}")
+    return models
+
+FALLBACK_MODELS = load_fallback_models(LLM_API_FALLBACK_MODELS)
+
+def route_candidates(full_model, fallback=True):
+    """呼び出すモデルの候補（先頭が指定されたモデル、以降がフォールバック先）"""
+    if not fallback:
+        return [full_model]
+    return [full_model] + [model for model in FALLBACK_MODELS if model != full_model]
 
 # リクエストボディ用の pydantic モデル
 class LLMRequest(BaseModel):
-    prompt: str
+    prompt: Optional[str] = None
+    prompts: Optional[List[str]] = None  # まとめて実行する場合のプロンプトのリスト
+    model: str = DEFAULT_MODEL  # INTEGRATED_MODELS のいずれか
     format_type: FormatType = FormatType.TEXT  # デフォルトはテキストモード
+    stream: bool = False  # True の場合は Server-Sent Events で逐次返す
+    use_cache: bool = True  # False の場合は応答キャッシュを参照しない
+    fallback: bool = True  # False の場合は指定したモデルのみを呼び出す（ヘッジ・フォールバックしない）
+
+    @field_validator("model")
+    @classmethod
+    def validate_model(cls, value):
+        return resolve_model(value)
+
+    @model_validator(mode="after")
+    def validate_prompts(self):
+        if (self.prompt is None) == (self.prompts is None):
+            raise ValueError("Specify exactly one of 'prompt' or 'prompts'.")
+        if self.prompts is not None:
+            if not self.prompts:
+                raise ValueError("'prompts' must not be empty.")
+            if len(self.prompts) > LLM_API_MAX_BATCH:
+                raise ValueError(f"'prompts' accepts at most {LLM_API_MAX_BATCH} items.")
+            if self.stream:
+                raise ValueError("stream is not supported for batch requests.")
+        if self.stream and self.format_type == FormatType.JSON:
+            raise ValueError("stream is only supported for format_type=text")
+        return self
+
+def get_api_system_prompt(format_type):
+    if format_type == FormatType.JSON:
+        return DEFAULT_JSON_SYSTEM_PROMPT
+    return DEFAULT_TEXT_SYSTEM_PROMPT
+
+async def run_llm(prompt, full_model, format_type, use_cache=True):
+    """
+    1つのプロンプトで LLM を呼び出し、コードブロックを除去した応答テキストを返す
+    JSONモードでは各providerのネイティブな JSON 出力設定を使用します。
+    """
+    provider, model = full_model.split(":", 1)
+    response_text = await complete(
+        provider, prompt, model,
+        get_api_system_prompt(format_type),
+        "Text",
+        use_cache,
+        json_mode=(format_type == FormatType.JSON)
+    )
+    # コードブロックがある場合は中身を取り出す（JSONモードでは json のブロックを優先）
+    languages = ("json",) if format_type == FormatType.JSON else None
+    return extract_code(response_text, languages)
+
+async def route_llm(prompt, full_model, format_type, use_cache=True, fallback=True):
+    """
+    run_llm を llm_api_router 経由で呼び出し、(応答テキスト, 応答したモデル) を返す
+
+    指定したモデルの応答が遅い場合は次の候補にヘッジし、失敗した場合は次の候補に
+    フォールバックします（fallback が False の場合は指定したモデルのみを呼び出す）。
+    """
+    async def call(model):
+        try:
+            return await run_llm(prompt, model, format_type, use_cache)
+        except Exception as e:
+            logger.warning(f"LLM API call to {model} failed: {str(e)}")
+            raise
+
+    return await llm_api_router.run(route_candidates(full_model, fallback), call)
+
+async def run_llm_batch(request):
+    """複数のプロンプトを同時実行数を制限しつつ並列に実行し、入力順に結果を返す"""
+    semaphore = asyncio.Semaphore(LLM_API_BATCH_CONCURRENCY)
+
+    async def run_one(prompt):
+        async with semaphore:
+            try:
+                response_text, model = await route_llm(
+                    prompt, request.model, request.format_type, request.use_cache, request.fallback
+                )
+                if request.format_type == FormatType.JSON:
+                    return {"result": json.loads(response_text), "model": model}
+                return {"result": response_text, "model": model}
+            except json.JSONDecodeError as e:
+                logger.error(f"JSON parse error: {str(e)}")
+                return {"error": "Response could not be parsed as JSON"}
+            except Exception as e:
+                logger.error(f"LLM API Batch Error: {str(e)}")
+                return {"error": str(e)}
+
+    return await asyncio.gather(*(run_one(prompt) for prompt in request.prompts))
+
+def format_sse(data, event=None):
+    """Server-Sent Events の1メッセージを組み立てる"""
+    message = f"event: {event}\n" if event else ""
+    return message + f"data: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+async def stream_llm_tokens(prompt, full_model, use_cache=True, fallback=True):
+    """
+    LLMのトークンを逐次 yield する
+
+    最初のトークンを受信する前に失敗した場合は、次の候補のモデルにフォールバックします
+    （受信済みの内容と混ざらないよう、受信開始後はフォールバックしない）。
+    """
+    candidates = route_candidates(full_model, fallback)
+    for index, candidate in enumerate(candidates):
+        provider, model = candidate.split(":", 1)
+        started = False
+        try:
+            async for token in stream_complete(provider, prompt, model, DEFAULT_TEXT_SYSTEM_PROMPT, "Text", use_cache):
+                started = True
+                yield token
+            return
+        except Exception as e:
+            if started or index == len(candidates) - 1:
+                raise
+            logger.warning(f"LLM API stream from {candidate} failed, falling back: {str(e)}")
+
+async def stream_llm_events(prompt, full_model, use_cache=True, ticket=None, fallback=True):
+    """
+    LLMのトークンを受信するたびに SSE メッセージとして yield する
+
+    コードブロックの中身が届いた場合は、そのテキストを "code" にも含めます
+    （クライアントはコードブロックの中身だけを逐次表示できます）。
+    """
+    extractor = CodeExtractor()
+    try:
+        async for token in stream_llm_tokens(prompt, full_model, use_cache, fallback):
+            data = {"text": token}
+            code = extractor.feed(token)
+            if code:
+                data["code"] = code
+            yield format_sse(data)
+        code = extractor.close()
+        if code:
+            yield format_sse({"text": "", "code": code})
+        yield format_sse({}, event="done")
+    except Exception as e:
+        logger.error(f"LLM API Stream Error: {str(e)}")
+        yield format_sse({"error": str(e)}, event="error")
+    finally:
+        if ticket is not None:
+            ticket.release()
+
+def overloaded_response(e):
+    """過負荷時の 429/503 レスポンスを生成する"""
+    return JSONResponse(
+        status_code=e.status_code,
+        content={"error": str(e)},
+        headers={"Retry-After": str(e.retry_after)}
+    )
 
 # POST /api/llm エンドポイント
 @app.post("/api/llm")
 async def llm_api(request: LLMRequest):
     """
-    リクエストの prompt を使って gemini-2.0-flash モデルで LLM 呼び出しを行います。
-    format_type に応じてテキストまたはJSONで応答を返します。
+    リクエストの prompt（または prompts）を使って指定されたモデル（デフォルトは gemini-2.0-flash）で
+    LLM 呼び出しを行います。format_type に応じてテキストまたはJSONで応答を返します。
+    prompts を指定した場合は並列に実行し、{"results": [{"result": ..., "model": ...} または {"error": ...}]} を返します。
+    指定したモデルの応答が遅い・失敗した場合は LLM_API_FALLBACK_MODELS のモデルにヘッジ・フォールバックし、
+    応答したモデルを X-LLM-Model ヘッダーで返します（fallback=false で無効）。
     """
-    logger.info(f"LLM API Request - Prompt: {request.prompt}, Format: {request.format_type}")
-    
+    logger.info(
+        f"LLM API Request - Model: {request.model}, Prompt: {truncate(request.prompt, 200)}, "
+        f"Batch: {len(request.prompts or [])}, Format: {request.format_type}"
+    )
+
+    # 同時実行数と待ち行列の長さを制限し、過負荷時は 429/503 を返す
     try:
-        default_model = "gemini-2.0-flash"
-        response_text, _ = generate_gemini(
-            request.prompt, 
-            default_model, 
-            DEFAULT_TEXT_SYSTEM_PROMPT, 
-            "Text"
+        ticket = await llm_api_gate.acquire()
+    except Overloaded as e:
+        logger.warning(f"LLM API overloaded ({e.status_code}), Retry-After: {e.retry_after}s")
+        return overloaded_response(e)
+
+    if request.stream:
+        # 実行枠はストリームの終了時に返却する（ストリームが開始されなかった場合は
+        # レスポンス送信後のバックグラウンドタスクで返却する）
+        return StreamingResponse(
+            stream_llm_events(request.prompt, request.model, request.use_cache, ticket, request.fallback),
+            media_type="text/event-stream",
+            headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+            background=BackgroundTask(ticket.release)
         )
-        
-        # コードブロックがある場合は除去
-        response_text = remove_code_block(response_text)
-        logger.info(f"LLM API Response: {response_text}")
+
+    if request.prompts is not None:
+        try:
+            results = await run_llm_batch(request)
+        finally:
+            ticket.release()
+        return JSONResponse(content={"results": results})
+    
+    try:
+        try:
+            response_text, model = await route_llm(
+                request.prompt, request.model, request.format_type, request.use_cache, request.fallback
+            )
+        except Overloaded as e:
+            # provider が障害中（circuit breaker が open）の場合は 503 を返す
+            logger.warning(f"LLM API provider unavailable: {e}")
+            return overloaded_response(e)
+        finally:
+            ticket.release()
+        logger.info(f"LLM API Response: {len(response_text)} chars from {model}")
+        # 応答したモデル（ヘッジ・フォールバックした場合は指定と異なる）
+        headers = {"X-LLM-Model": model}
         
         # format_type に応じて応答形式を変更
         if request.format_type == FormatType.JSON:
             try:
                 # JSONモードの場合は、応答をJSONとしてパースして返す
-                import json
                 json_response = json.loads(response_text)
-                return JSONResponse(content=json_response)
+                return JSONResponse(content=json_response, headers=headers)
             except json.JSONDecodeError as e:
                 logger.error(f"JSON parse error: {str(e)}")
                 return JSONResponse(
@@ -73,7 +307,7 @@ async def llm_api(request: LLMRequest):
                 )
         else:
             # テキストモードの場合は、そのまま平文で返す
-            return PlainTextResponse(response_text)
+            return PlainTextResponse(response_text, headers=headers)
             
     except Exception as e:
         logger.error(f"LLM API Error: {str(e)}")
@@ -82,4 +316,139 @@ async def llm_api(request: LLMRequest):
                 status_code=500,
                 content={"error": str(e)}
             )
-        raise 
\ No newline at end of file
+        raise
+
+# GET /api/cache/stats エンドポイント
+@app.get("/api/cache/stats")
+async def cache_stats():
+    """LLM応答キャッシュのヒット数・ミス数と、まとめられた同時呼び出し数を返します。"""
+    return {**response_cache.stats(), "single_flight": llm_single_flight.stats()}
+
+# GET /api/llm/stats エンドポイント
+@app.get("/api/llm/stats")
+async def llm_api_stats():
+    """/api/llm の実行中・待機中・拒否したリクエスト数を返します。"""
+    return {**llm_api_gate.stats(), "routing": llm_api_router.stats()}
+
+# GET /api/providers/stats エンドポイント
+@app.get("/api/providers/stats")
+async def provider_stats():
+    """provider 毎の circuit breaker の状態を返します。"""
+    return provider_resilience.stats()
+
+# GET /api/executors/stats エンドポイント
+@app.get("/api/executors/stats")
+async def executor_stats():
+    """ブロッキング処理用の executor 毎のスレッド数・実行数・待ち数を返します。"""
+    return executor_registry.stats()
+
+# GET /api/shared-state/stats エンドポイント
+@app.get("/api/shared-state/stats")
+async def shared_state_stats():
+    """共有状態のバックエンド（プロセス内・状態サーバー）の状態を返します。"""
+    return shared_state.stats()
+
+# GET /api/diagrams/stats エンドポイント
+@app.get("/api/diagrams/stats")
+async def diagram_stats():
+    """Kroki のエンドポイントと、SVGキャッシュのヒット数・ミス数を返します。"""
+    return kroki_renderer.stats()
+
+# GET /api/artifacts/{key} エンドポイント
+@app.get(ARTIFACT_ROUTE_PREFIX + "/{key}")
+async def get_artifact(key: str, request: Request):
+    """
+    生成されたHTML文書（プレビュー）を返します。
+
+    キーは内容のハッシュのため、同じキーの内容は変わりません。ETag と長期キャッシュを付け、
+    クライアントが gzip に対応している場合は圧縮して返します。
+    """
+    artifact = await artifact_store.aget(key)
+    if artifact is None:
+        return PlainTextResponse("Not Found", status_code=404)
+
+    headers = {
+        "ETag": artifact.etag,
+        "Cache-Control": "public, max-age=31536000, immutable",
+        "Vary": "Accept-Encoding",
+        # 生成されたコードはアプリと同じオリジンで実行させない（data: URI と同じく不透明なオリジンにする）
+        "Content-Security-Policy": "sandbox allow-scripts allow-forms allow-modals allow-popups",
+    }
+    if artifact.etag in request.headers.get("if-none-match", ""):
+        return Response(status_code=304, headers=headers)
+
+    content = artifact.content
+    if len(content) >= ARTIFACT_GZIP_MIN_BYTES and "gzip" in request.headers.get("accept-encoding", ""):
+        content = artifact.gzipped
+        headers["Content-Encoding"] = "gzip"
+    return Response(content, media_type="text/html; charset=utf-8", headers=headers)
+
+# GET /api/artifacts エンドポイント
+@app.get(ARTIFACT_ROUTE_PREFIX)
+async def artifact_stats():
+    """生成物ストアの保存数と使用量を返します。"""
+    return artifact_store.stats()
+
+# GET /api/static/{version}/{path} エンドポイント
+@app.get(STATIC_ROUTE_PREFIX + "/{version}/{path:path}")
+async def get_static_asset(version: str, path: str, request: Request):
+    """
+    プレビュー・結果グリッドで使うライブラリ（Prism・React など）の同梱ファイルを返します。
+
+    URL に内容のハッシュを含むため、同じ URL の内容は変わりません。ETag と長期キャッシュを付け、
+    クライアントが gzip に対応している場合は圧縮して返します。プレビューの iframe は不透明な
+    オリジンで読み込むため、どのオリジンからも読み込めるようにします。
+    """
+    found = static_assets.get(version, path)
+    if found is None:
+        return PlainTextResponse("Not Found", status_code=404)
+
+    asset, media_type = found
+    headers = {
+        "ETag": asset.etag,
+        "Cache-Control": "public, max-age=31536000, immutable",
+        "Vary": "Accept-Encoding",
+        "Access-Control-Allow-Origin": "*",
+    }
+    if asset.etag in request.headers.get("if-none-match", ""):
+        return Response(status_code=304, headers=headers)
+
+    content = asset.content
+    if len(content) >= ARTIFACT_GZIP_MIN_BYTES and "gzip" in request.headers.get("accept-encoding", ""):
+        content = asset.gzipped
+        headers["Content-Encoding"] = "gzip"
+    return Response(content, media_type=media_type, headers=headers)
+
+# GET /api/static エンドポイント
+@app.get(STATIC_ROUTE_PREFIX)
+async def static_asset_stats():
+    """同梱ファイルの一覧（URL・サイズ）と、React のプレビューの JSX をサーバー側で変換した数・キャッシュのヒット数を返します。"""
+    return {**static_assets.stats(), "jsx": jsx_compiler.stats()}
+
+# スケジューラ・受付ゲート・キャッシュの現在の状態をメトリクスに反映する
+scheduler_gauge = metrics_registry.gauge(
+    "ai_gradio_scheduler_requests", "Requests held by the schedulers and admission gates.", ("queue", "state")
+)
+cache_gauge = metrics_registry.gauge(
+    "ai_gradio_cache_lookups", "Cache lookups since startup.", ("cache", "result")
+)
+
+@metrics_registry.register_collector
+def collect_runtime_stats():
+    generation = generation_scheduler.stats()
+    scheduler_gauge.set(generation["active"], queue="generation", state="active")
+    scheduler_gauge.set(generation["waiting"], queue="generation", state="waiting")
+    gate = llm_api_gate.stats()
+    scheduler_gauge.set(gate["active"], queue="llm_api", state="active")
+    scheduler_gauge.set(gate["waiting"], queue="llm_api", state="waiting")
+    scheduler_gauge.set(gate["rejected"], queue="llm_api", state="rejected")
+    for name, cache in (("response", response_cache), ("kroki", kroki_renderer.cache), ("jsx", jsx_compiler.cache)):
+        stats = cache.stats()
+        cache_gauge.set(stats["hits"], cache=name, result="hit")
+        cache_gauge.set(stats["misses"], cache=name, result="miss")
+
+# GET /metrics エンドポイント
+@app.get("/metrics")
+async def metrics():
+    """処理時間・トークン使用量・キューの状態を Prometheus のテキスト形式で返します。"""
+    return PlainTextResponse(metrics_registry.render(), media_type="text/plain; version=0.0.4")
@@ -0,0 +1,201 @@
+import asyncio
+import gzip
+import hashlib
+import os
+import re
+import threading
+from collections import OrderedDict
+
+from .config import env_float, env_int
+from .executors import ExecutorSaturated, executor_registry
+from .shared_state import run_in_background, shared_state
+
+# 生成物ストアのメモリ上の上限（バイト）。超えた場合は古いものから追い出す
+ARTIFACT_STORE_MAX_BYTES = env_int("ARTIFACT_STORE_MAX_BYTES", 64 * 1024 * 1024)
+# 空の場合はディスクに保存しない（設定すると追い出された生成物や再起動前の生成物も配信できる）
+ARTIFACT_STORE_DIR = os.environ.get("ARTIFACT_STORE_DIR", "")
+# 状態サーバーに生成物を保持する秒数（プレビューを生成したインスタンス以外からも配信できるようにする）
+ARTIFACT_SHARED_TTL = env_float("ARTIFACT_SHARED_TTL", 24 * 3600.0)
+# 生成物を配信するルートのパス
+ARTIFACT_ROUTE_PREFIX = "/api/artifacts"
+# この長さ未満の生成物は圧縮しても小さくならないため gzip しない
+ARTIFACT_GZIP_MIN_BYTES = 1024
+
+KEY_PATTERN = re.compile(r"[0-9a-f]{64}")
+
+
+class Artifact:
+    """ストアに保存された1つの生成物（HTML文書）"""
+
+    def __init__(self, key, content):
+        self.key = key
+        self.content = content
+        self._gzipped = None
+
+    @property
+    def etag(self):
+        return f'"{self.key}"'
+
+    @property
+    def gzipped(self):
+        """gzip 圧縮した内容（最初に要求された時に一度だけ圧縮する）"""
+        if self._gzipped is None:
+            self._gzipped = gzip.compress(self.content, compresslevel=6)
+        return self._gzipped
+
+    @property
+    def size(self):
+        return len(self.content)
+
+
+class ArtifactStore:
+    """
+    生成されたHTML文書を内容のハッシュをキーに保存するストア
+
+    同じ内容は一度だけ保存され、プレビューの iframe は ARTIFACT_ROUTE_PREFIX 配下の URL で
+    文書を参照します。内容が変わればキーも変わるため、配信時は ETag と長期キャッシュを使えます。
+    共有状態のバックエンドが状態サーバーの場合は生成物をそこにも保存し、iframe の読み込みが
+    別のワーカー・ノードに届いた場合も配信できるようにします。
+    ディスクの読み書きはイベントループを止めないよう "artifacts" の executor で行います。
+    """
+
+    def __init__(self, max_bytes=ARTIFACT_STORE_MAX_BYTES, disk_dir=ARTIFACT_STORE_DIR, backend=None,
+                 shared_ttl=ARTIFACT_SHARED_TTL):
+        self.max_bytes = max(1, max_bytes)
+        self.disk_dir = disk_dir or None
+        self.backend = backend or shared_state
+        self.shared_ttl = shared_ttl
+        self._artifacts = OrderedDict()  # key -> Artifact
+        self._bytes = 0
+        # Gradio のハンドラと FastAPI のルートの両方から使われるためロックで保護する
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def make_key(content):
+        return hashlib.sha256(content).hexdigest()
+
+    def _disk_path(self, key):
+        return os.path.join(self.disk_dir, key[:2], f"{key}.html")
+
+    def _write_disk(self, key, content):
+        path = self._disk_path(key)
+        if os.path.exists(path):
+            return
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(tmp_path, "wb") as f:
+                f.write(content)
+            os.replace(tmp_path, path)
+        except OSError:
+            # ディスクへの書き込み失敗はメモリのみで動作を継続する
+            pass
+
+    def _read_disk(self, key):
+        try:
+            with open(self._disk_path(key), "rb") as f:
+                return f.read()
+        except OSError:
+            return None
+
+    def _add(self, artifact):
+        self._artifacts[artifact.key] = artifact
+        self._bytes += artifact.size
+        while self._bytes > self.max_bytes and len(self._artifacts) > 1:
+            _, evicted = self._artifacts.popitem(last=False)
+            self._bytes -= evicted.size
+
+    def put(self, text):
+        """
+        文書を保存してキーを返す（同じ内容が保存済みの場合は保存せずにキーだけを返す）
+
+        Args:
+            text (str): HTML文書
+
+        Returns:
+            str: 内容の SHA-256 ハッシュ
+        """
+        content = text.encode("utf-8")
+        key = self.make_key(content)
+        with self._lock:
+            if key in self._artifacts:
+                self._artifacts.move_to_end(key)
+                return key
+            self._add(Artifact(key, content))
+        self._persist(key, content, text)
+        return key
+
+    def _persist(self, key, content, text):
+        # put は同期的に呼ばれるため、ディスク・状態サーバーへの保存は待たずにイベントループで行う
+        # （メモリには保存済みのため、保存が終わる前に要求されても配信できる）
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            loop = None
+        if self.disk_dir:
+            if loop is None:
+                self._write_disk(key, content)
+            else:
+                run_in_background(loop, lambda: self._awrite_disk(key, content))
+        if self.backend.shared and loop is not None:
+            run_in_background(loop, lambda: self.backend.set(f"artifact:{key}", text, self.shared_ttl))
+
+    async def _awrite_disk(self, key, content):
+        try:
+            await executor_registry.run("artifacts", self._write_disk, key, content)
+        except ExecutorSaturated:
+            # ディスクへの書き込みが詰まっている場合はメモリのみに保存する
+            pass
+
+    def get(self, key):
+        """メモリ上のキーの生成物を返す（ない場合は None。ディスク・状態サーバーも参照する場合は aget を使う）"""
+        with self._lock:
+            artifact = self._artifacts.get(key)
+            if artifact is not None:
+                self._artifacts.move_to_end(key)
+            return artifact
+
+    async def aget(self, key):
+        """キーの生成物を返す（メモリにない場合はディスク、状態サーバーの順に参照する。ない場合は None）"""
+        artifact = self.get(key)
+        # キーはパスの一部になるため、ハッシュの形式でないものはディスク・状態サーバーを参照しない
+        if artifact is not None or not KEY_PATTERN.fullmatch(key):
+            return artifact
+        content = None
+        if self.disk_dir:
+            try:
+                content = await executor_registry.run("artifacts", self._read_disk, key)
+            except ExecutorSaturated:
+                # ディスクの読み込みが詰まっている場合は状態サーバーのみを参照する
+                content = None
+        if content is None and self.backend.shared:
+            text = await self.backend.get(f"artifact:{key}")
+            # 状態サーバーの内容はキー（内容のハッシュ）と一致する場合のみ受け入れる
+            if text is not None and self.make_key(text.encode("utf-8")) == key:
+                content = text.encode("utf-8")
+        if content is None:
+            return None
+        with self._lock:
+            # 読み込んでいる間に同じキーが保存・読み込まれた場合は、保存済みのものを返す
+            existing = self._artifacts.get(key)
+            if existing is not None:
+                self._artifacts.move_to_end(key)
+                return existing
+            artifact = Artifact(key, content)
+            self._add(artifact)
+        return artifact
+
+    def url(self, key):
+        """生成物を配信する URL（同一オリジンの相対パス）"""
+        return f"{ARTIFACT_ROUTE_PREFIX}/{key}"
+
+    def stats(self):
+        return {
+            "artifacts": len(self._artifacts),
+            "bytes": self._bytes,
+            "max_bytes": self.max_bytes,
+        }
+
+
+# アプリ全体で共有する生成物ストア
+artifact_store = ArtifactStore()
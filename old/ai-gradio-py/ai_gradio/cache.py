@@ -0,0 +1,190 @@
+import hashlib
+import json
+import os
+import time
+from collections import OrderedDict
+
+from .config import env_bool, env_float, env_int
+from .executors import ExecutorSaturated, executor_registry
+from .shared_state import shared_state
+
+# LLM応答キャッシュの設定
+RESPONSE_CACHE_ENABLED = env_bool("RESPONSE_CACHE_ENABLED", True)
+RESPONSE_CACHE_MAX_ENTRIES = env_int("RESPONSE_CACHE_MAX_ENTRIES", 512)
+RESPONSE_CACHE_TTL = env_float("RESPONSE_CACHE_TTL", 3600.0)
+# 空の場合はディスクキャッシュを使わない
+RESPONSE_CACHE_DIR = os.environ.get("RESPONSE_CACHE_DIR", "")
+
+
+def hash_text(text):
+    """文字列の SHA-256 ハッシュ（16進数）を返す"""
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+class ResponseCache:
+    """
+    コンテンツアドレス方式のキャッシュ（メモリ上の LRU + TTL、任意でディスク層）
+
+    キーは make_key で生成したハッシュです。値は JSON にシリアライズできるものに限ります。
+    ディスク層を有効にすると、メモリから追い出されたエントリや再起動前のエントリも
+    TTL 内であれば再利用されます。共有状態のバックエンドが状態サーバーの場合は、aget・aset で
+    その内容も参照・保存するため、他のワーカー・ノードで生成された応答も再利用されます。
+    """
+
+    def __init__(self, max_entries=RESPONSE_CACHE_MAX_ENTRIES, ttl=RESPONSE_CACHE_TTL,
+                 disk_dir=RESPONSE_CACHE_DIR, enabled=RESPONSE_CACHE_ENABLED, backend=None):
+        self.max_entries = max(1, max_entries)
+        self.ttl = ttl
+        self.disk_dir = disk_dir or None
+        self.enabled = enabled
+        self.backend = backend or shared_state
+        self._entries = OrderedDict()  # key -> (expires_at, value)
+        self.hits = 0
+        self.disk_hits = 0
+        self.shared_hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def make_key(*parts, **fields):
+        """キーの構成要素から決定的なキャッシュキーを生成する"""
+        payload = json.dumps([parts, fields], sort_keys=True, ensure_ascii=False, default=str)
+        return hash_text(payload)
+
+    def _disk_path(self, key):
+        return os.path.join(self.disk_dir, key[:2], f"{key}.json")
+
+    def _read_disk(self, key):
+        try:
+            with open(self._disk_path(key), "r", encoding="utf-8") as f:
+                entry = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if entry.get("expires_at", 0) < time.time():
+            try:
+                os.remove(self._disk_path(key))
+            except OSError:
+                pass
+            return None
+        return entry
+
+    def _write_disk(self, key, value, expires_at):
+        path = self._disk_path(key)
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump({"expires_at": expires_at, "value": value}, f, ensure_ascii=False)
+            os.replace(tmp_path, path)
+        except OSError:
+            # ディスク層への書き込み失敗はメモリ層のみで動作を継続する
+            pass
+
+    def _get_memory(self, key):
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        expires_at, value = entry
+        if expires_at < time.time():
+            del self._entries[key]
+            return None
+        self._entries.move_to_end(key)
+        return entry
+
+    def _set_memory(self, key, value, expires_at):
+        self._entries[key] = (expires_at, value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def _lookup(self, key, disk_entry=None, shared=False):
+        entry = self._get_memory(key)
+        if entry is not None:
+            self.hits += 1
+            return entry[1]
+        if disk_entry is not None:
+            self.hits += 1
+            if shared:
+                self.shared_hits += 1
+            else:
+                self.disk_hits += 1
+            self._set_memory(key, disk_entry["value"], disk_entry["expires_at"])
+            return disk_entry["value"]
+        self.misses += 1
+        return None
+
+    def _shared_key(self, key):
+        return f"cache:{key}"
+
+    def get(self, key):
+        """キャッシュされた値を返す（ない場合・期限切れの場合は None）"""
+        if not self.enabled:
+            return None
+        if self._get_memory(key) is None and self.disk_dir:
+            return self._lookup(key, self._read_disk(key))
+        return self._lookup(key)
+
+    def set(self, key, value):
+        """値をキャッシュする"""
+        if not self.enabled or value is None:
+            return
+        expires_at = time.time() + self.ttl
+        self._set_memory(key, value, expires_at)
+        if self.disk_dir:
+            self._write_disk(key, value, expires_at)
+
+    async def aget(self, key):
+        """
+        get の非同期版（ディスクの読み込みは "cache" の executor で行う）
+
+        メモリ・ディスクにない場合は共有状態（状態サーバー）も参照します。
+        """
+        if not self.enabled:
+            return None
+        if self._get_memory(key) is not None:
+            return self._lookup(key)
+        disk_entry = None
+        if self.disk_dir:
+            try:
+                disk_entry = await executor_registry.run("cache", self._read_disk, key)
+            except ExecutorSaturated:
+                # ディスクの読み込みが詰まっている場合はミスとして扱う
+                disk_entry = None
+        if disk_entry is None and self.backend.shared:
+            value = await self.backend.get(self._shared_key(key))
+            if value is not None:
+                return self._lookup(key, {"value": value, "expires_at": time.time() + self.ttl}, shared=True)
+        return self._lookup(key, disk_entry)
+
+    async def aset(self, key, value):
+        """set の非同期版（ディスクへの書き込みは "cache" の executor で行い、共有状態にも保存する）"""
+        if not self.enabled or value is None:
+            return
+        expires_at = time.time() + self.ttl
+        self._set_memory(key, value, expires_at)
+        if self.backend.shared:
+            await self.backend.set(self._shared_key(key), value, self.ttl)
+        if self.disk_dir:
+            try:
+                await executor_registry.run("cache", self._write_disk, key, value, expires_at)
+            except ExecutorSaturated:
+                # ディスクへの書き込みが詰まっている場合はメモリのみに保存する
+                pass
+
+    def clear(self):
+        self._entries.clear()
+
+    def stats(self):
+        """ヒット数・ミス数などの統計を返す"""
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self._entries),
+            "hits": self.hits,
+            "disk_hits": self.disk_hits,
+            "shared_hits": self.shared_hits,
+            "misses": self.misses,
+            "hit_ratio": self.hits / lookups if lookups else 0.0,
+        }
+
+
+# LLM応答のキャッシュ（アプリ全体で共有）
+response_cache = ResponseCache()
@@ -0,0 +1,114 @@
+import asyncio
+
+from .metrics import metrics_registry
+
+# キャンセルの理由
+CANCEL_REQUESTED = "cancel"  # キャンセルボタン
+CANCEL_RESUBMITTED = "resubmit"  # 同じセッションで新しい生成を開始した
+CANCEL_DISCONNECTED = "disconnect"  # タブを閉じた・接続が切れた
+
+generations_cancelled_total = metrics_registry.counter(
+    "ai_gradio_generations_cancelled_total",
+    "Generations cancelled before completion.",
+    ("reason",),
+)
+
+
+class GenerationCancelled(Exception):
+    """実行中の生成がキャンセルされた場合の例外"""
+
+    def __init__(self, reason):
+        super().__init__(f"Generation cancelled ({reason})")
+        self.reason = reason
+
+
+class _Generation:
+    def __init__(self, task):
+        self.task = task
+        self.reason = None
+
+
+class GenerationRegistry:
+    """
+    セッション毎に実行中の生成を保持し、外部からキャンセルできるようにするレジストリ
+
+    run() は非同期ジェネレータを専用のタスクで実行し、その出力を中継します。cancel() は
+    そのタスクをキャンセルするため、プロバイダの呼び出し・ストリーム・スケジューラの待ちまで
+    キャンセルが伝わり、確保していた実行枠はすぐに待ち行列のリクエストへ渡されます。
+    """
+
+    def __init__(self):
+        self._generations = {}
+
+    async def run(self, key, agen):
+        """
+        agen を key のセッションの生成として実行し、出力を順に yield する
+
+        同じ key で実行中の生成はキャンセルします（再送信）。cancel() でキャンセルされた場合は
+        GenerationCancelled を送出します（再送信でキャンセルされた場合は何も送出せずに終わる）。
+
+        Args:
+            key (str): セッションのキー（None の場合は他の生成をキャンセルしない）
+            agen: 実行する非同期ジェネレータ
+        """
+        # 出力を1件ずつ受け渡し、呼び出し側の消費の速さに合わせて実行する
+        queue = asyncio.Queue(maxsize=1)
+        finished = object()
+
+        async def pump():
+            try:
+                async for item in agen:
+                    await queue.put(item)
+            finally:
+                await agen.aclose()
+            await queue.put(finished)
+
+        generation = _Generation(asyncio.create_task(pump()))
+        if key is not None:
+            self.cancel(key, CANCEL_RESUBMITTED)
+            self._generations[key] = generation
+        try:
+            while True:
+                getter = asyncio.ensure_future(queue.get())
+                await asyncio.wait({getter, generation.task}, return_when=asyncio.FIRST_COMPLETED)
+                if getter.done():
+                    item = getter.result()
+                    if item is finished:
+                        return
+                    yield item
+                    continue
+                getter.cancel()
+                if generation.task.cancelled():
+                    if generation.reason == CANCEL_RESUBMITTED:
+                        return
+                    raise GenerationCancelled(generation.reason or CANCEL_REQUESTED)
+                # 例外で終了した場合はそのまま送出する
+                generation.task.result()
+                return
+        finally:
+            # 呼び出し側が途中で止めた場合（Gradio によるキャンセルなど）も生成を中断する
+            generation.task.cancel()
+            if key is not None and self._generations.get(key) is generation:
+                del self._generations[key]
+
+    def cancel(self, key, reason=CANCEL_REQUESTED):
+        """
+        key のセッションで実行中の生成をキャンセルする
+
+        Returns:
+            bool: キャンセルした場合は True
+        """
+        generation = self._generations.pop(key, None)
+        if generation is None or generation.task.done():
+            return False
+        generation.reason = reason
+        generation.task.cancel()
+        generations_cancelled_total.inc(reason=reason)
+        return True
+
+    def stats(self):
+        return {"running": len(self._generations)}
+
+
+# アプリ全体で共有するレジストリ
+generation_registry = GenerationRegistry()
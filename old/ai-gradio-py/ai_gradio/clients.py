@@ -0,0 +1,231 @@
+import json
+import os
+
+import httpx
+
+from .config import env_bool, env_float, env_int
+
+# HTTPコネクションプールの設定
+HTTP_MAX_CONNECTIONS = env_int("HTTP_MAX_CONNECTIONS", 100)
+HTTP_MAX_KEEPALIVE_CONNECTIONS = env_int("HTTP_MAX_KEEPALIVE_CONNECTIONS", 20)
+HTTP_KEEPALIVE_EXPIRY = env_float("HTTP_KEEPALIVE_EXPIRY", 60.0)
+HTTP_CONNECT_TIMEOUT = env_float("HTTP_CONNECT_TIMEOUT", 10.0)
+# 推論モデルは応答まで数分かかることがあるため長めに設定
+HTTP_READ_TIMEOUT = env_float("HTTP_READ_TIMEOUT", 600.0)
+# 起動時に APIキーが設定されている provider のクライアントを生成するかどうか
+# （生成しない場合は最初の呼び出し時に SDK を読み込んで生成するため、起動が速くなる）
+CLIENT_WARMUP = env_bool("CLIENT_WARMUP", False)
+
+# provider毎のAPIキーの環境変数名
+API_KEY_ENV = {
+    "openai": "OPENAI_API_KEY",
+    "anthropic": "ANTHROPIC_API_KEY",
+    "gemini": "GEMINI_API_KEY",
+    "deepseek": "DEEPSEEK_API_KEY",
+}
+
+# provider毎のデフォルトのベースURL
+DEFAULT_BASE_URLS = {
+    "openai": os.environ.get("OPENAI_BASE_URL", "https://api.openai.com/v1"),
+    "anthropic": os.environ.get("ANTHROPIC_BASE_URL", "https://api.anthropic.com"),
+    "gemini": os.environ.get("GEMINI_BASE_URL", "https://generativelanguage.googleapis.com"),
+    "deepseek": os.environ.get("DEEPSEEK_BASE_URL", "https://api.deepseek.com/v1"),
+}
+
+
+def http_limits():
+    """共通のコネクションプール設定を返す"""
+    return httpx.Limits(
+        max_connections=HTTP_MAX_CONNECTIONS,
+        max_keepalive_connections=HTTP_MAX_KEEPALIVE_CONNECTIONS,
+        keepalive_expiry=HTTP_KEEPALIVE_EXPIRY,
+    )
+
+
+def http_timeout():
+    """共通のタイムアウト設定を返す"""
+    return httpx.Timeout(HTTP_READ_TIMEOUT, connect=HTTP_CONNECT_TIMEOUT)
+
+
+class GeminiAPIError(Exception):
+    """Gemini APIがエラーを返した場合の例外"""
+
+    def __init__(self, status_code, message, headers=None):
+        super().__init__(f"{status_code}: {message}")
+        self.status_code = status_code
+        self.headers = headers or {}
+
+
+class GeminiClient:
+    """
+    Gemini REST API (generateContent) の薄いクライアント
+
+    google-generativeai SDK は非同期呼び出しにグローバル設定の gRPC クライアントを使い、
+    プールの上限やベースURLを呼び出し側から制御できないため、共有の httpx クライアント上で
+    REST API を直接呼び出します。
+    """
+
+    def __init__(self, api_key, base_url, http_client):
+        self.api_key = api_key
+        self.base_url = base_url.rstrip("/")
+        self.http_client = http_client
+
+    def _request_args(self, model, contents, system_instruction=None, generation_config=None,
+                      action="generateContent"):
+        body = {"contents": contents}
+        if system_instruction:
+            body["systemInstruction"] = {"parts": [{"text": system_instruction}]}
+        if generation_config:
+            body["generationConfig"] = generation_config
+        return {
+            "url": f"{self.base_url}/v1beta/models/{model}:{action}",
+            "headers": {"x-goog-api-key": self.api_key},
+            "json": body,
+        }
+
+    @staticmethod
+    def _parse(response):
+        if response.status_code >= 400:
+            try:
+                message = response.json().get("error", {}).get("message", response.text)
+            except ValueError:
+                message = response.text
+            raise GeminiAPIError(response.status_code, message, dict(response.headers))
+        return response.json()
+
+    async def generate_content_async(self, model, contents, system_instruction=None, generation_config=None):
+        response = await self.http_client.post(
+            **self._request_args(model, contents, system_instruction, generation_config)
+        )
+        return self._parse(response)
+
+    async def stream_generate_content_async(self, model, contents, system_instruction=None,
+                                            generation_config=None, on_usage=None):
+        """
+        streamGenerateContent (SSE) を呼び出し、受信したテキストを逐次 yield する
+
+        on_usage を渡すと、ストリームの終了時に最後のチャンクの内容（usageMetadata を含む）を
+        引数に呼び出します（usageMetadata は累積値のため最後のチャンクのみを使う）。
+        """
+        args = self._request_args(
+            model, contents, system_instruction, generation_config, action="streamGenerateContent"
+        )
+        last_usage = None
+        async with self.http_client.stream("POST", params={"alt": "sse"}, **args) as response:
+            if response.status_code >= 400:
+                await response.aread()
+                self._parse(response)
+            async for line in response.aiter_lines():
+                if not line.startswith("data:"):
+                    continue
+                data = json.loads(line[len("data:"):])
+                if data.get("usageMetadata"):
+                    last_usage = data
+                text = self.chunk_text(data)
+                if text:
+                    yield text
+        if on_usage is not None and last_usage is not None:
+            on_usage(last_usage)
+
+    @staticmethod
+    def chunk_text(data):
+        """ストリーミングの各チャンクからテキストを取り出す（本文がない場合は空文字）"""
+        candidates = data.get("candidates") or []
+        if not candidates:
+            return ""
+        parts = candidates[0].get("content", {}).get("parts", [])
+        return "".join(part.get("text", "") for part in parts if not part.get("thought"))
+
+    @staticmethod
+    def response_text(data):
+        """レスポンスから本文テキストを取り出す（thinkingモデルの思考部分は除く）"""
+        if not data.get("candidates"):
+            feedback = data.get("promptFeedback", {})
+            raise ValueError(f"Gemini returned no candidates: {feedback}")
+        return GeminiClient.chunk_text(data)
+
+
+class ClientRegistry:
+    """
+    provider・ベースURL毎に長寿命のAPIクライアントを保持するレジストリ
+
+    クライアントは最初に要求された時点（または warmup 時）に一度だけ生成され、
+    HTTPコネクションプールは以降のリクエストで共有されます。
+    """
+
+    def __init__(self, base_urls=None):
+        self.base_urls = dict(DEFAULT_BASE_URLS)
+        self.base_urls.update(base_urls or {})
+        self._clients = {}
+
+    def get(self, provider, base_url=None):
+        """
+        providerのクライアントを取得する
+
+        Args:
+            provider (str): openai / anthropic / gemini / deepseek
+            base_url (str): ベースURL（省略時は provider のデフォルト）
+
+        Returns:
+            provider のSDKクライアント（gemini の場合は GeminiClient）
+        """
+        base_url = base_url or self.base_urls[provider]
+        key = (provider, base_url)
+        client = self._clients.get(key)
+        if client is None:
+            client = self._build(provider, base_url)
+            self._clients[key] = client
+        return client
+
+    def _build(self, provider, base_url):
+        env_name = API_KEY_ENV.get(provider)
+        if env_name is None:
+            raise ValueError(f"Unknown provider: {provider}")
+        api_key = os.environ.get(env_name)
+        if not api_key:
+            raise ValueError(f"{env_name} environment variable is not set.")
+
+        # SDK は import に時間がかかるため、その provider のクライアントを最初に生成する時点で読み込む
+        # リトライは provider_resilience で行うため、SDK 側ではリトライしない
+        if provider in ("openai", "deepseek"):
+            import openai
+
+            http_client = openai.DefaultAsyncHttpxClient(limits=http_limits())
+            return openai.AsyncOpenAI(
+                api_key=api_key, base_url=base_url, timeout=http_timeout(), http_client=http_client,
+                max_retries=0
+            )
+        if provider == "anthropic":
+            import anthropic
+
+            http_client = anthropic.DefaultAsyncHttpxClient(limits=http_limits())
+            return anthropic.AsyncAnthropic(
+                api_key=api_key, base_url=base_url, timeout=http_timeout(), http_client=http_client,
+                max_retries=0
+            )
+        # gemini
+        http_client = httpx.AsyncClient(limits=http_limits(), timeout=http_timeout())
+        return GeminiClient(api_key, base_url, http_client)
+
+    def warmup(self):
+        """APIキーが設定されている provider のクライアントを事前に生成する"""
+        ready = []
+        for provider, env_name in API_KEY_ENV.items():
+            if os.environ.get(env_name):
+                self.get(provider)
+                ready.append(provider)
+        return ready
+
+    async def aclose(self):
+        """保持しているクライアントのコネクションをすべて閉じる"""
+        clients = list(self._clients.items())
+        self._clients.clear()
+        for (provider, _), client in clients:
+            if provider == "gemini":
+                await client.http_client.aclose()
+            else:
+                await client.close()
+
+
+# アプリ全体で共有するクライアントレジストリ
+client_registry = ClientRegistry()
@@ -0,0 +1,56 @@
+import os
+
+
+def env_int(name, default):
+    """環境変数を int として読み込む（未設定・不正値の場合は default）"""
+    value = os.environ.get(name)
+    if value is None or value.strip() == "":
+        return default
+    try:
+        return int(value)
+    except ValueError:
+        return default
+
+
+def env_float(name, default):
+    """環境変数を float として読み込む（未設定・不正値の場合は default）"""
+    value = os.environ.get(name)
+    if value is None or value.strip() == "":
+        return default
+    try:
+        return float(value)
+    except ValueError:
+        return default
+
+
+def env_bool(name, default=False):
+    """環境変数を bool として読み込む（1/true/yes/on を真とみなす）"""
+    value = os.environ.get(name)
+    if value is None or value.strip() == "":
+        return default
+    return value.strip().lower() in ("1", "true", "yes", "on")
+
+
+def env_provider_map(name, default=None, cast=int):
+    """
+    "openai=4,anthropic=2" 形式の環境変数を辞書として読み込む
+
+    Args:
+        name (str): 環境変数名
+        default (dict): 未設定時のデフォルト値
+        cast (callable): 値の変換関数
+
+    Returns:
+        dict: provider -> 値 の辞書
+    """
+    result = dict(default or {})
+    value = os.environ.get(name, "")
+    for item in value.split(","):
+        if "=" not in item:
+            continue
+        key, raw = item.split("=", 1)
+        try:
+            result[key.strip()] = cast(raw.strip())
+        except ValueError:
+            continue
+    return result
@@ -0,0 +1,158 @@
+import asyncio
+import contextvars
+import functools
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from .config import env_int, env_provider_map
+from .metrics import metrics_registry, observe_span
+from .scheduler import Overloaded
+
+# 用途（provider 名、history・cache など）毎のスレッド数と待ち行列の上限（例: "history=2,openai=8"）
+EXECUTOR_MAX_WORKERS = env_provider_map("EXECUTOR_MAX_WORKERS")
+EXECUTOR_MAX_QUEUE = env_provider_map("EXECUTOR_MAX_QUEUE")
+DEFAULT_EXECUTOR_WORKERS = env_int("DEFAULT_EXECUTOR_WORKERS", 4)
+DEFAULT_EXECUTOR_QUEUE = env_int("DEFAULT_EXECUTOR_QUEUE", 64)
+
+executor_tasks = metrics_registry.gauge(
+    "ai_gradio_executor_tasks",
+    "Blocking calls held by each bounded executor.",
+    ("executor", "state"),
+)
+executor_rejections_total = metrics_registry.counter(
+    "ai_gradio_executor_rejections_total",
+    "Blocking calls rejected because the executor queue was full.",
+    ("executor",),
+)
+
+
+class ExecutorSaturated(Overloaded):
+    """executor の待ち行列が一杯で呼び出しを受け付けられない場合の例外"""
+
+    def __init__(self, name):
+        super().__init__(f"Executor '{name}' is saturated. Please retry later.", 503, 1)
+        self.name = name
+
+
+class BoundedExecutor:
+    """
+    スレッド数と待ち行列の長さを制限したスレッドプール
+
+    asyncio.to_thread はプロセス全体で共有するデフォルトの executor を使うため、遅い処理が
+    スレッドを使い切ると他の処理（Gradio を含む）まで待たされます。用途毎にこの executor を
+    分け、待ち行列が一杯の場合は待たずに ExecutorSaturated を送出します。
+    """
+
+    def __init__(self, name, max_workers=DEFAULT_EXECUTOR_WORKERS, max_queue=DEFAULT_EXECUTOR_QUEUE):
+        self.name = name
+        self.max_workers = max(1, max_workers)
+        self.max_queue = max(0, max_queue)
+        self.active = 0
+        self.queued = 0
+        self.rejected = 0
+        self._executor = None
+        # active / queued はスレッドからも更新するためロックで保護する
+        self._lock = threading.Lock()
+
+    @property
+    def executor(self):
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(self.max_workers, thread_name_prefix=f"ai_gradio-{self.name}")
+        return self._executor
+
+    def _update_gauges(self):
+        executor_tasks.set(self.active, executor=self.name, state="active")
+        executor_tasks.set(self.queued, executor=self.name, state="queued")
+
+    def _call(self, submitted, func):
+        # スレッド上で実行を開始した時点で待ち行列から実行中へ移す
+        with self._lock:
+            self.queued -= 1
+            self.active += 1
+            self._update_gauges()
+        observe_span("executor_queue_wait", time.monotonic() - submitted, provider=self.name)
+        try:
+            return func()
+        finally:
+            with self._lock:
+                self.active -= 1
+                self._update_gauges()
+
+    def _on_done(self, future):
+        # 実行を開始する前にキャンセルされた呼び出しは待ち行列から外す
+        if future.cancelled():
+            with self._lock:
+                self.queued -= 1
+                self._update_gauges()
+
+    async def run(self, func, *args, **kwargs):
+        """
+        func(*args, **kwargs) をスレッドで実行して結果を返す（contextvars は呼び出し元から引き継ぐ）
+
+        待ち行列が一杯の場合は ExecutorSaturated を送出します。
+        """
+        with self._lock:
+            if self.queued + self.active >= self.max_workers + self.max_queue:
+                self.rejected += 1
+                executor_rejections_total.inc(executor=self.name)
+                raise ExecutorSaturated(self.name)
+            self.queued += 1
+            self._update_gauges()
+        context = contextvars.copy_context()
+        future = self.executor.submit(
+            self._call, time.monotonic(), functools.partial(context.run, func, *args, **kwargs)
+        )
+        future.add_done_callback(self._on_done)
+        return await asyncio.wrap_future(future)
+
+    def stats(self):
+        return {
+            "max_workers": self.max_workers,
+            "max_queue": self.max_queue,
+            "active": self.active,
+            "queued": self.queued,
+            "rejected": self.rejected,
+        }
+
+    def shutdown(self):
+        if self._executor is not None:
+            executor, self._executor = self._executor, None
+            executor.shutdown(wait=False, cancel_futures=True)
+
+
+class ExecutorRegistry:
+    """用途毎の BoundedExecutor を保持するレジストリ（最初に使われた時点で生成する）"""
+
+    def __init__(self, max_workers=None, max_queue=None, default_workers=DEFAULT_EXECUTOR_WORKERS,
+                 default_queue=DEFAULT_EXECUTOR_QUEUE):
+        self.max_workers = dict(max_workers or {})
+        self.max_queue = dict(max_queue or {})
+        self.default_workers = default_workers
+        self.default_queue = default_queue
+        self._executors = {}
+
+    def get(self, name):
+        executor = self._executors.get(name)
+        if executor is None:
+            executor = self._executors[name] = BoundedExecutor(
+                name,
+                self.max_workers.get(name, self.default_workers),
+                self.max_queue.get(name, self.default_queue),
+            )
+        return executor
+
+    async def run(self, name, func, *args, **kwargs):
+        """name の executor で func(*args, **kwargs) を実行する"""
+        return await self.get(name).run(func, *args, **kwargs)
+
+    def stats(self):
+        return {name: executor.stats() for name, executor in self._executors.items()}
+
+    def shutdown(self):
+        for executor in self._executors.values():
+            executor.shutdown()
+
+
+# アプリ全体で共有する executor
+executor_registry = ExecutorRegistry(EXECUTOR_MAX_WORKERS, EXECUTOR_MAX_QUEUE)
@@ -0,0 +1,285 @@
+# フェンスに使う文字
+FENCE_CHARS = "`~"
+# フェンスとみなす文字の最小の連続数
+MIN_FENCE_LENGTH = 3
+
+
+def parse_fence(line):
+    """
+    行がフェンスであれば (フェンス, 情報文字列) を返す（フェンスでない場合は (None, "")）
+
+    情報文字列は開始のフェンスの後ろに書かれた言語名など（例: "```html" の "html"）です。
+    """
+    stripped = line.strip()
+    if not stripped or stripped[0] not in FENCE_CHARS:
+        return None, ""
+    char = stripped[0]
+    length = len(stripped) - len(stripped.lstrip(char))
+    if length < MIN_FENCE_LENGTH:
+        return None, ""
+    info = stripped[length:].strip()
+    # ```x``` のように同じ行で閉じているものはインラインのコードとみなす
+    if char == "`" and "`" in info:
+        return None, ""
+    return stripped[:length], info
+
+
+class CodeBlock:
+    """応答中の1つのコードブロック"""
+
+    __slots__ = ("fence", "info", "language", "parts", "has_content", "closed")
+
+    def __init__(self, fence, info=""):
+        self.fence = fence
+        self.info = info
+        # "html title=..." や "{.html}" のような情報文字列から言語名だけを取り出す
+        self.language = info.split()[0].strip("{}.").lower() if info else ""
+        self.parts = []
+        self.has_content = False
+        self.closed = False
+
+    @property
+    def text(self):
+        return "".join(self.parts)
+
+
+class FenceParser:
+    """
+    コードブロックを逐次取り出すパーサー
+
+    feed() に受信したテキストを順に渡し、最後に close() を呼びます。各テキストは1回だけ
+    走査され、改行を受信していない行もフェンスでないことが分かった時点でブロックに追加します。
+    同じ文字・同じ長さ以上のフェンスで言語付きのブロックが入れ子になっている場合は、
+    内側のブロックを閉じるフェンスで外側のブロックを閉じません。
+    LLM の応答に多い "</html>```" のように行末に書かれた閉じるフェンスでもブロックを閉じます。
+    """
+
+    def __init__(self):
+        self.blocks = []
+        self.outside = []  # コードブロックの外のテキスト
+        self._block = None  # 開いているブロック
+        self._depth = 0  # 開いているブロック内の入れ子のブロックの数
+        self._line = ""  # フェンスかどうか判定できていない受信中の行
+        self._line_is_text = False  # 受信中の行がフェンスでないと判定済み
+        self._tail = ""  # 受信中の行の末尾の、閉じるフェンスの可能性があるため保留している文字
+
+    def feed(self, chunk):
+        """
+        chunk を読み込む
+
+        Returns:
+            list: コードブロックに追加された (CodeBlock, テキスト) のリスト
+                  （ブロックの開始時はテキストが空の要素を含む）
+        """
+        deltas = []
+        start = 0
+        while True:
+            end = chunk.find("\n", start)
+            if end < 0:
+                break
+            self._end_line(chunk[start:end + 1], deltas)
+            start = end + 1
+        if start < len(chunk):
+            self._continue_line(chunk[start:], deltas)
+        return deltas
+
+    def close(self):
+        """
+        応答の終わりを通知する（改行で終わっていない最後の行を処理する）
+
+        Returns:
+            list: feed() と同じ形式のリスト
+        """
+        deltas = []
+        if self._line_is_text:
+            self._end_line("", deltas)
+        elif self._line:
+            line, self._line = self._line, ""
+            self._process_line(line, deltas)
+        return deltas
+
+    def _emit(self, text, deltas):
+        block = self._block
+        if block is None:
+            self.outside.append(text)
+            return
+        block.parts.append(text)
+        if not block.has_content and text.strip():
+            block.has_content = True
+        deltas.append((block, text))
+
+    def _emit_partial(self, text, deltas):
+        # ブロック内では末尾のフェンスの文字を行の続きを受信するまで保留する
+        block = self._block
+        if block is not None and not self._depth:
+            text = self._tail + text
+            kept = text.rstrip(block.fence[0])
+            self._tail = text[len(kept):]
+            text = kept
+        if text:
+            self._emit(text, deltas)
+
+    def _closing_run(self, line):
+        """line の行末が開いているブロックを閉じるフェンスであれば、フェンスの文字数を返す（それ以外は 0）"""
+        block = self._block
+        if block is None or self._depth:
+            return 0
+        stripped = line.rstrip()
+        run = len(stripped) - len(stripped.rstrip(block.fence[0]))
+        return run if run >= len(block.fence) else 0
+
+    def _continue_line(self, text, deltas):
+        if self._line_is_text:
+            self._emit_partial(text, deltas)
+            return
+        self._line += text
+        stripped = self._line.lstrip()
+        if not stripped:
+            return
+        if stripped[0] in FENCE_CHARS:
+            run = len(stripped) - len(stripped.lstrip(stripped[0]))
+            if run == len(stripped) or run >= MIN_FENCE_LENGTH:
+                # フェンスの可能性があるため改行まで待つ
+                return
+        # フェンスで始まらない行は改行を待たずにそのまま追加する
+        self._line_is_text = True
+        line, self._line = self._line, ""
+        self._emit_partial(line, deltas)
+
+    def _end_line(self, text, deltas):
+        if self._line_is_text:
+            self._line_is_text = False
+            # 保留していた文字は行末の連続したフェンスの文字のため、行末のフェンスはその中に含まれる
+            line, self._tail = self._tail + text, ""
+            self._end_text_line(line, deltas)
+            return
+        line, self._line = self._line + text, ""
+        self._process_line(line, deltas)
+
+    def _process_line(self, line, deltas):
+        fence, info = parse_fence(line)
+        block = self._block
+        if block is None:
+            if fence is None:
+                self.outside.append(line)
+                return
+            self._block = CodeBlock(fence, info)
+            self.blocks.append(self._block)
+            deltas.append((self._block, ""))
+            return
+        if fence is not None and fence[0] == block.fence[0] and len(fence) >= len(block.fence):
+            if info:
+                # 閉じるフェンスには言語を書かないため、入れ子のブロックの開始とみなす
+                self._depth += 1
+            elif self._depth:
+                self._depth -= 1
+            else:
+                self._close_block()
+                return
+        elif fence is None:
+            self._end_text_line(line, deltas)
+            return
+        self._emit(line, deltas)
+
+    def _end_text_line(self, line, deltas):
+        run = self._closing_run(line)
+        if not run:
+            if line:
+                self._emit(line, deltas)
+            return
+        content = line.rstrip()[:-run]
+        if content:
+            self._emit(content, deltas)
+        self._close_block()
+
+    def _close_block(self):
+        self._block.closed = True
+        self._block = None
+
+
+def select_block(blocks, languages=None):
+    """
+    取り出すコードブロックを選ぶ
+
+    languages に一致する言語のブロックを優先し、なければ言語指定のないブロックを返します。
+    languages が None の場合は言語を問わず最初のブロックを返します（空のブロックは除く）。
+
+    Returns:
+        CodeBlock: 選んだブロック（ない場合は None）
+    """
+    fallback = None
+    for block in blocks:
+        if not block.has_content:
+            continue
+        if languages is None or block.language in languages:
+            return block
+        if not block.language and fallback is None:
+            fallback = block
+    return fallback
+
+
+def parse_blocks(text):
+    """text のすべてのコードブロックを返す"""
+    parser = FenceParser()
+    parser.feed(text)
+    parser.close()
+    return parser.blocks
+
+
+def extract_code(text, languages=None):
+    """
+    応答からコードを取り出す
+
+    select_block で選んだブロックの中身を返し、該当するブロックがない場合は応答全体を返します
+    （いずれも前後の空白を除く）。
+    """
+    block = select_block(parse_blocks(text), languages)
+    return block.text.strip() if block is not None else text.strip()
+
+
+class CodeExtractor:
+    """
+    トークンのストリームからコードを逐次取り出す
+
+    feed() は受信したトークンのうち、取り出しているブロックに追加されたテキストを返します。
+    取り出すブロックは開始した時点で決めます（languages に一致する言語、言語指定なし、
+    languages が None の場合は最初のブロック）。code は extract_code と同じ規則で、受信済みの
+    応答から取り出したコードです。
+    """
+
+    def __init__(self, languages=None):
+        self.languages = languages
+        self.parser = FenceParser()
+        self.block = None
+        self._parts = []
+
+    def _accepts(self, block):
+        return self.languages is None or not block.language or block.language in self.languages
+
+    def _collect(self, deltas):
+        texts = []
+        for block, text in deltas:
+            if self.block is None and self._accepts(block):
+                self.block = block
+            if block is self.block and text:
+                texts.append(text)
+        return "".join(texts)
+
+    def feed(self, token):
+        """トークンを読み込み、取り出しているブロックに追加されたテキストを返す"""
+        self._parts.append(token)
+        return self._collect(self.parser.feed(token))
+
+    def close(self):
+        """応答の終わりを通知し、取り出しているブロックに追加されたテキストを返す"""
+        return self._collect(self.parser.close())
+
+    @property
+    def text(self):
+        """受信済みの応答全体"""
+        return "".join(self._parts)
+
+    @property
+    def code(self):
+        block = select_block(self.parser.blocks, self.languages)
+        return block.text.strip() if block is not None else self.text.strip()
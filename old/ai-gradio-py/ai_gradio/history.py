@@ -0,0 +1,197 @@
+import os
+import re
+import sqlite3
+import threading
+import time
+
+from .config import env_bool, env_float, env_int
+
+# 生成履歴の保存先（SQLite）
+HISTORY_ENABLED = env_bool("HISTORY_ENABLED", True)
+HISTORY_DB_PATH = os.environ.get("HISTORY_DB_PATH", os.path.join("data", "generation_history.db"))
+# 保持する履歴の件数・日数の上限（0 の場合は制限しない）。保存時に上限を超えた古い履歴を削除する
+HISTORY_MAX_ENTRIES = env_int("HISTORY_MAX_ENTRIES", 10000)
+HISTORY_MAX_AGE_DAYS = env_float("HISTORY_MAX_AGE_DAYS", 90.0)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS generations (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    created_at REAL NOT NULL,
+    query TEXT NOT NULL,
+    model TEXT NOT NULL,
+    prompt_type TEXT NOT NULL,
+    system_prompt_hash TEXT NOT NULL,
+    code TEXT NOT NULL,
+    latency REAL NOT NULL,
+    input_tokens INTEGER NOT NULL DEFAULT 0,
+    output_tokens INTEGER NOT NULL DEFAULT 0
+);
+CREATE INDEX IF NOT EXISTS idx_generations_created_at ON generations (created_at DESC);
+CREATE INDEX IF NOT EXISTS idx_generations_prompt_type ON generations (prompt_type, created_at DESC);
+"""
+
+# 全文検索用のインデックス（generations の query と code を索引する）
+# 日本語は単語が空白で区切られないため、部分文字列で検索できる trigram トークナイザを使う
+FTS_SCHEMA = """
+CREATE VIRTUAL TABLE IF NOT EXISTS generations_fts USING fts5(
+    query, code, content='generations', content_rowid='id', tokenize='trigram'
+);
+CREATE TRIGGER IF NOT EXISTS generations_fts_insert AFTER INSERT ON generations BEGIN
+    INSERT INTO generations_fts (rowid, query, code) VALUES (new.id, new.query, new.code);
+END;
+CREATE TRIGGER IF NOT EXISTS generations_fts_delete AFTER DELETE ON generations BEGIN
+    INSERT INTO generations_fts (generations_fts, rowid, query, code) VALUES ('delete', old.id, old.query, old.code);
+END;
+"""
+
+COLUMNS = (
+    "id", "created_at", "query", "model", "prompt_type", "system_prompt_hash",
+    "code", "latency", "input_tokens", "output_tokens",
+)
+
+
+class HistoryStore:
+    """
+    生成結果の履歴を保存する SQLite ストア
+
+    各モデルの生成結果（query, model, prompt_type, システムプロンプトのハッシュ, コード,
+    レイテンシ, トークン使用量）を1行として保存し、新しい順の一覧と全文検索で引けるようにします。
+    保存時に max_entries 件・max_age_days 日を超えた古い履歴を削除します。
+    SQLite の呼び出しはブロッキングのため、イベントループからは executor_registry の
+    "history" の executor 経由で使います。
+    """
+
+    def __init__(self, path=HISTORY_DB_PATH, enabled=HISTORY_ENABLED, max_entries=HISTORY_MAX_ENTRIES,
+                 max_age_days=HISTORY_MAX_AGE_DAYS):
+        self.path = path
+        self.enabled = enabled
+        self.max_entries = max(0, max_entries)
+        self.max_age_days = max(0.0, max_age_days)
+        self.fts_enabled = False
+        self._conn = None
+        self._lock = threading.Lock()
+
+    def _connect(self):
+        if self._conn is None:
+            if self.path != ":memory:":
+                os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+            conn = sqlite3.connect(self.path, check_same_thread=False)
+            conn.row_factory = sqlite3.Row
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.executescript(SCHEMA)
+            fts_exists = conn.execute(
+                "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'generations_fts'"
+            ).fetchone() is not None
+            try:
+                conn.executescript(FTS_SCHEMA)
+                if not fts_exists:
+                    # 全文検索の導入前に保存された履歴もインデックスに追加する
+                    with conn:
+                        conn.execute("INSERT INTO generations_fts (generations_fts) VALUES ('rebuild')")
+                self.fts_enabled = True
+            except sqlite3.OperationalError:
+                # FTS5（trigram）が使えないバージョンの SQLite では LIKE 検索で代用する
+                self.fts_enabled = False
+            self._conn = conn
+        return self._conn
+
+    def record(self, query, model, prompt_type, system_prompt_hash, code, latency,
+               input_tokens=0, output_tokens=0):
+        """
+        生成結果を1件保存する
+
+        Returns:
+            int: 保存した履歴のID（履歴が無効の場合は None）
+        """
+        if not self.enabled:
+            return None
+        with self._lock:
+            conn = self._connect()
+            with conn:
+                cursor = conn.execute(
+                    "INSERT INTO generations (created_at, query, model, prompt_type, system_prompt_hash,"
+                    " code, latency, input_tokens, output_tokens) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                    (time.time(), query, model, prompt_type, system_prompt_hash, code, latency,
+                     input_tokens or 0, output_tokens or 0),
+                )
+                self._prune(conn)
+            return cursor.lastrowid
+
+    def _prune(self, conn):
+        """保持する件数・日数の上限を超えた古い履歴を削除する（全文検索のインデックスはトリガーで削除される）"""
+        if self.max_age_days:
+            conn.execute(
+                "DELETE FROM generations WHERE created_at < ?",
+                (time.time() - self.max_age_days * 86400,),
+            )
+        if self.max_entries:
+            conn.execute(
+                "DELETE FROM generations WHERE id <= "
+                "(SELECT id FROM generations ORDER BY id DESC LIMIT 1 OFFSET ?)",
+                (self.max_entries,),
+            )
+
+    @staticmethod
+    def _fts_query(terms):
+        # 入力をそのまま MATCH に渡すと FTS の構文として解釈されるため、語毎に引用符で囲む
+        return " ".join('"{}"'.format(term.replace('"', '""')) for term in terms)
+
+    def search(self, text="", prompt_type=None, limit=50):
+        """
+        履歴を新しい順に検索する
+
+        Args:
+            text (str): 検索語（query とコードを全文検索する。空の場合は絞り込まない）
+            prompt_type (str): 指定した場合はその prompt_type の履歴のみ
+            limit (int): 最大件数
+
+        Returns:
+            list[dict]: 履歴（新しい順）
+        """
+        if not self.enabled:
+            return []
+        with self._lock:
+            conn = self._connect()
+            conditions, args = [], []
+            terms = [term for term in re.split(r"\s+", text or "") if term]
+            # trigram は3文字未満の語を検索できないため、その場合は LIKE で検索する
+            if terms and self.fts_enabled and all(len(term) >= 3 for term in terms):
+                conditions.append("id IN (SELECT rowid FROM generations_fts WHERE generations_fts MATCH ?)")
+                args.append(self._fts_query(terms))
+            else:
+                for term in terms:
+                    conditions.append("(query LIKE ? OR code LIKE ?)")
+                    args += [f"%{term}%"] * 2
+            if prompt_type:
+                conditions.append("prompt_type = ?")
+                args.append(prompt_type)
+            where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+            rows = conn.execute(
+                f"SELECT {', '.join(COLUMNS)} FROM generations {where} ORDER BY created_at DESC LIMIT ?",
+                (*args, limit),
+            ).fetchall()
+        return [dict(row) for row in rows]
+
+    def get(self, ids):
+        """指定したIDの履歴を ids の順に返す（存在しないIDは含めない）"""
+        if not self.enabled or not ids:
+            return []
+        ids = [int(i) for i in ids]
+        with self._lock:
+            conn = self._connect()
+            rows = conn.execute(
+                f"SELECT {', '.join(COLUMNS)} FROM generations WHERE id IN ({', '.join('?' * len(ids))})",
+                ids,
+            ).fetchall()
+        by_id = {row["id"]: dict(row) for row in rows}
+        return [by_id[i] for i in ids if i in by_id]
+
+    def close(self):
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+
+
+# アプリ全体で共有する生成履歴
+history_store = HistoryStore()
@@ -1,29 +1,41 @@
+import asyncio
+import contextvars
+import json
 import os
-import base64
-import gradio as gr
-import modelscope_studio.components.antd as antd
-import modelscope_studio.components.base as ms
 import re
-import requests
-import zlib
-
-# 追加：OpenAI API を利用するためのimport（必要に応じて環境変数などでapi_keyを設定してください）
-import openai
-from openai import OpenAI
-
-# 既存のインポートに追加
-import sys
-sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
-from ai_gradio.logging_config import setup_logging
+import time
+
+from ai_gradio.artifacts import artifact_store
+from ai_gradio.cache import response_cache, hash_text
+from ai_gradio.cancellation import generation_registry, GenerationCancelled, CANCEL_REQUESTED, CANCEL_DISCONNECTED
+from ai_gradio.clients import client_registry
+from ai_gradio.config import env_bool, env_float, env_int
+from ai_gradio.executors import executor_registry
+from ai_gradio.fences import CodeExtractor, extract_code, parse_blocks, select_block
+from ai_gradio.history import history_store
+from ai_gradio.jsx import jsx_compiler, JSXSyntaxError
+from ai_gradio.kroki import kroki_renderer
+from ai_gradio.logging_config import setup_logging, truncate
+from ai_gradio.metrics import span, observe_span, record_tokens, start_trace, time_to_first_token_seconds
+from ai_gradio.resilience import provider_resilience
+from ai_gradio.routing import provider_latency
+from ai_gradio.scheduler import generation_scheduler, provider_limiter
+from ai_gradio.singleflight import llm_single_flight
+from ai_gradio.static_assets import static_assets
 
 # ロガーの初期化
 logger = setup_logging()
-import asyncio
-generation_lock = asyncio.Lock()  # 生成処理の重複実行を防ぐためのグローバルロック
 
-# 既存のインポートに追加
-from dotenv import load_dotenv
-load_dotenv()  # 追加: .envファイルから環境変数をグローバルに読み込みます
+# 順番待ち中に待ち順を更新する間隔（秒）
+QUEUE_POLL_INTERVAL = 1.0
+# ストリーミング時に結果グリッドを更新する間隔（秒）
+STREAM_UPDATE_INTERVAL = env_float("STREAM_UPDATE_INTERVAL", 0.5)
+# 未完了のモデルのプレースホルダー（経過時間）を更新する間隔（秒）
+PLACEHOLDER_REFRESH_INTERVAL = env_float("PLACEHOLDER_REFRESH_INTERVAL", 1.0)
+# provider の状態（circuit breaker）の表示を更新する間隔（秒）
+PROVIDER_STATUS_REFRESH_INTERVAL = env_float("PROVIDER_STATUS_REFRESH_INTERVAL", 5.0)
+# モデル毎の締め切り（秒）。これを過ぎたモデルは打ち切ってグリッドを確定する（0 で無効）
+MODEL_DEADLINE_SECONDS = env_float("MODEL_DEADLINE_SECONDS", 300.0)
 
 # 既存のimportの直後に追加
 BASE_URL = os.environ.get("BASE_URL", "http://localhost:7860")
@@ -74,10 +86,21 @@ DEFAULT_WEBAPP_SYSTEM_PROMPT = """You are an expert web developer. When asked to
        "number": 42,
        "roman": "XLII"
      }
-   - Note: Even with format_type="json", the response might be wrapped in ```json code blocks.
-     The API will automatically handle this and extract the JSON content.
+   - With format_type="json" the model is constrained to output JSON, and the API returns
+     the parsed JSON object directly.
    - For text responses, omit format_type or set it to "text"
-   - The default model is gemini-2.0-flash
+   - Identical requests may be answered from a cache. Add 'use_cache': false when every
+     call must produce a fresh response (e.g. random or creative content).
+   - To receive a text response incrementally, add 'stream': true. The response is
+     Server-Sent Events: each 'data:' line is JSON like {"text": "..."} and the stream
+     ends with an 'event: done' message.
+   - The default model is gemini-2.0-flash. To use another model, add a 'model' field
+     such as "openai:gpt-4o-mini" or "anthropic:claude-3-5-sonnet-20241022".
+   - When you need several independent answers, send them in one request with a
+     'prompts' array instead of 'prompt'. The response is {"results": [...]} in the same
+     order, where each item is {"result": ...} or {"error": "..."}.
+   - If the API responds with 429 or 503, wait for the number of seconds given in the
+     Retry-After header before retrying.
    - Ensure you include proper error handling when invoking this API."""
 
 # 通常テキスト応答用のシステムプロンプト
@@ -98,6 +121,10 @@ Let me think through this step by step.
 
 You are a helpful assistant. Provide concise and informative answers to user queries."""
 
+# JSON応答用のシステムプロンプト（/api/llm の JSON モードで使用）
+DEFAULT_JSON_SYSTEM_PROMPT = """You are a helpful assistant that responds only with valid JSON.
+Do not wrap the JSON in code blocks and do not add any explanations outside the JSON."""
+
 # Excalidraw図用のシステムプロンプト
 DEFAULT_EXCALIDRAW_SYSTEM_PROMPT = """You are an expert diagram creator using Excalidraw format. When asked to create a diagram:
 1. Always respond with ONLY valid Excalidraw JSON format wrapped in ```json code blocks.
@@ -200,185 +227,392 @@ sequenceDiagram
     Bob-->>John: Jolly good!
 ```"""
 
-# 各provider毎のLLM生成関数の実装を更新
-def generate_openai(query, model, system_prompt, prompt_type):
-    try:
-        logger.info(f"Starting OpenAI generation with model {model}")
-        api_key = os.environ.get("OPENAI_API_KEY")
-        if not api_key:
-            raise ValueError("OPENAI_API_KEY environment variable is not set.")
-
-        client = OpenAI(api_key=api_key)
-
-        # system_prompt を使用 (引数として受け取る)
-
-        # モデル名とパラメータの処理
-        if model in ("openai:o3-mini-high", "o3-mini-high"):
-            actual_model = "o3-mini"
-        else:
-            actual_model = model.replace("openai:", "")
-
-        # prompt_type に応じて user メッセージを設定する
-        if prompt_type == "Web App":
-            user_msg = f"Create a web application that: {query}"
-        else:
-            user_msg = query
-
-        # 基本パラメータ（すべてのモデルで共通）
-        params = {
-            "model": actual_model,
-            "messages": [
-                {"role": "system", "content": system_prompt},
-                {"role": "user", "content": user_msg}
-            ],
-            "stream": False
-        }
-
-        # o3-mini-highの場合はreasoning_effortを設定
-        if model in ("openai:o3-mini-high", "o3-mini-high"):
-            params["reasoning_effort"] = "high"
-        # o3系以外のモデルの場合は追加パラメータを設定
-        elif not actual_model.startswith("o3-"):
-            params.update({
-                "max_tokens": 2048,
-                "temperature": 0.7
-            })
-
-        response = client.chat.completions.create(**params)
-
-        response_text = response.choices[0].message.content
-        code = remove_code_block(response_text)
-        preview = send_to_preview(code)
-        logger.info(f"Successfully completed OpenAI generation with {model} ({actual_model})")
-        return code, preview
-    except Exception as e:
-        logger.error(f"Error in OpenAI generation: {str(e)}")
-        err = f"Error in OpenAI: {str(e)}"
-        return err, f"<div style='padding: 8px;color:red;'>{err}</div>"
-
-def generate_anthropic(query, model, system_prompt, prompt_type):
-    try:
-        api_key = os.environ.get("ANTHROPIC_API_KEY")
-        if not api_key:
-            raise ValueError("ANTHROPIC_API_KEY environment variable is not set.")
-
-        from anthropic import Anthropic
-        client = Anthropic(api_key=api_key)
-
-        # システムプロンプトを改善 (引数を使用)
+# システムプロンプトを provider のプロンプトキャッシュの対象にする（Anthropic は cache_control で明示する。
+# OpenAI・DeepSeek・Gemini は先頭の共通部分が自動でキャッシュされる）
+PROMPT_CACHE_ENABLED = env_bool("PROMPT_CACHE_ENABLED", True)
+
+# 各provider毎のリクエスト構築処理（同期/非同期で共通）
+# システムプロンプトは各 provider のシステムプロンプト用の項目で渡し、呼び出し毎に変わる user メッセージより
+# 前に置く（共通の先頭部分が provider 側のプロンプトキャッシュで再利用される）
+def build_user_message(query, prompt_type):
+    """prompt_type に応じて user メッセージを組み立てる"""
+    if prompt_type == "Web App":
+        return f"Create a web application that: {query}"
+    return query
+
+def build_openai_params(query, model, system_prompt, prompt_type, json_mode=False):
+    # モデル名とパラメータの処理
+    if model in ("openai:o3-mini-high", "o3-mini-high"):
+        actual_model = "o3-mini"
+    else:
+        actual_model = model.replace("openai:", "")
+
+    # 基本パラメータ（すべてのモデルで共通）
+    params = {
+        "model": actual_model,
+        "messages": [
+            {"role": "system", "content": system_prompt},
+            {"role": "user", "content": build_user_message(query, prompt_type)}
+        ],
+        "stream": False
+    }
 
-        if prompt_type == "Web App":
-            content = f"{system_prompt}\n\nCreate a web application that: {query}"
-        else:
-            content = f"{system_prompt}\n\n{query}"
-        response = client.messages.create(
-            model=model,
-            max_tokens=2048,
-            messages=[{
-                "role": "user",
-                "content": content
-            }]
-        )
+    # o3-mini-highの場合はreasoning_effortを設定
+    if model in ("openai:o3-mini-high", "o3-mini-high"):
+        params["reasoning_effort"] = "high"
+    # o3系以外のモデルの場合は追加パラメータを設定
+    elif not actual_model.startswith("o3-"):
+        params.update({
+            "max_tokens": 2048,
+            "temperature": 0.7
+        })
+
+    # JSONモードの場合はネイティブの JSON 出力を指定
+    if json_mode:
+        params["response_format"] = {"type": "json_object"}
+    return params
+
+def build_anthropic_params(query, model, system_prompt, prompt_type, json_mode=False):
+    messages = [{
+        "role": "user",
+        "content": build_user_message(query, prompt_type)
+    }]
+    # Anthropic には JSON モードがないため、応答の先頭を "{" で固定（プリフィル）する
+    if json_mode:
+        messages.append({"role": "assistant", "content": "{"})
+    params = {
+        "model": model,
+        "max_tokens": 2048,
+        "messages": messages
+    }
+    if system_prompt:
+        system = {"type": "text", "text": system_prompt}
+        if PROMPT_CACHE_ENABLED:
+            # システムプロンプトまでをプロンプトキャッシュに保存し、以降の呼び出しで再利用する
+            system["cache_control"] = {"type": "ephemeral"}
+        params["system"] = [system]
+    return params
+
+def build_gemini_params(query, model, system_prompt, prompt_type, json_mode=False):
+    params = {
+        "model": model,
+        "system_instruction": system_prompt,
+        "contents": [
+            {"role": "user", "parts": [{"text": build_user_message(query, prompt_type)}]}
+        ]
+    }
+    # JSONモードの場合はネイティブの JSON 出力を指定
+    if json_mode:
+        params["generation_config"] = {"responseMimeType": "application/json"}
+    return params
+
+def build_deepseek_params(query, model, system_prompt, prompt_type, json_mode=False):
+    params = {
+        "model": model,
+        "messages": [
+            {"role": "system", "content": system_prompt},
+            {"role": "user", "content": build_user_message(query, prompt_type)}
+        ],
+        "temperature": 0.7,
+        "max_tokens": 2048,
+        "stream": False
+    }
+    # JSONモードの場合はネイティブの JSON 出力を指定
+    if json_mode:
+        params["response_format"] = {"type": "json_object"}
+    return params
+
+def get_prefill(params):
+    """応答の先頭として指定したテキスト（assistant のプリフィル）を返す"""
+    messages = params.get("messages") or []
+    if messages and messages[-1]["role"] == "assistant":
+        return messages[-1]["content"]
+    return ""
+
+def fence_languages(prompt_type):
+    """
+    prompt_type の応答からコードとして取り出すコードブロックの言語
 
-        response_text = response.content[0].text
-        code = remove_code_block(response_text)
-        preview = send_to_preview(code)
-        return code, preview
-    except Exception as e:
-        err = f"Error in Anthropic: {str(e)}"
-        return err, f"<div style='padding: 8px;color:red;'>{err}</div>"
+    図のモードでは図のソースのブロック、それ以外はプレビューに表示する HTML・JSX（React の
+    コンポーネント）のブロックを優先します（一致するブロックがなければ言語指定のないブロック）。
+    """
+    diagram_type = DIAGRAM_TYPES.get(prompt_type)
+    if diagram_type is not None:
+        return DIAGRAM_FENCE_LANGUAGES.get(diagram_type, (diagram_type,))
+    return ("html", "jsx")
 
-def generate_gemini(query, model, system_prompt, prompt_type):
-    try:
-        load_dotenv()
+def build_result(response_text, with_preview=True, prompt_type="Web App"):
+    """
+    LLMの応答からコードとプレビューを生成する
 
-        api_key = os.environ.get("GEMINI_API_KEY")
-        if not api_key:
-            raise ValueError("GEMINI_API_KEY environment variable is not set.")
+    結果グリッドでは結果カードの生成時にプレビューを作るため、with_preview=False で
+    プレビューを省略します（その場合プレビューは None）。
+    """
+    code = extract_code(response_text, fence_languages(prompt_type))
+    preview = send_to_preview(code) if with_preview else None
+    return code, preview
+
+def build_error_result(provider_label, e):
+    err = f"Error in {provider_label}: {str(e)}"
+    return err, f"<div style='padding: 8px;color:red;'>{err}</div>"
+
+# provider毎のリクエスト構築関数
+PARAM_BUILDERS = {
+    "openai": build_openai_params,
+    "anthropic": build_anthropic_params,
+    "gemini": build_gemini_params,
+    "deepseek": build_deepseek_params,
+}
 
-        import google.generativeai as genai
-        genai.configure(api_key=api_key)
+# provider毎のAPI呼び出し（応答テキストを返す）。クライアントは client_registry で共有する
+# 実行中の生成のトークン使用量（モデル毎のタスク内で start_usage_tracking() により設定する）
+generation_usage = contextvars.ContextVar("generation_usage", default=None)
 
-        model = genai.GenerativeModel(model_name=model)
+def start_usage_tracking():
+    """
+    現在のタスクでトークン使用量の記録を開始し、記録先の辞書を返す
 
-        # システムプロンプト (引数を使用)
+    provider を呼び出して応答を得た場合は completed、キャッシュから応答した場合は
+    cache_hit が True になります。
+    """
+    usage = {"input_tokens": 0, "output_tokens": 0, "completed": False, "cache_hit": False}
+    generation_usage.set(usage)
+    return usage
 
-        if prompt_type == "Web App":
-            last_message = f"Create a web application that: {query}"
-        else:
-            last_message = query
-        response = model.generate_content(
-            [
-                {"role": "user", "parts": [{"text": system_prompt}]},
-                {"role": "model", "parts": [{"text": "I understand and will follow these guidelines."}]},
-                {"role": "user", "parts": [{"text": last_message}]}
-            ],
-            stream=False
-        )
+def record_usage(input_tokens=0, output_tokens=0, provider=None, model=None, cached_input_tokens=0,
+                 cache_write_tokens=0, **flags):
+    """
+    トークン使用量を記録する
 
-        response_text = response.text
-        code = remove_code_block(response_text)
-        preview = send_to_preview(code)
-        return code, preview
-    except Exception as e:
-        err = f"Error in Gemini: {str(e)}"
-        return err, f"<div style='padding: 8px;color:red;'>{err}</div>"
+    provider と model を指定した場合はメトリクスに加算し、start_usage_tracking() で記録を
+    開始している場合は現在のタスクの使用量にも加算します。input_tokens はプロンプトキャッシュから
+    読み込んだ分（cached_input_tokens）とキャッシュに書き込んだ分（cache_write_tokens）を含み、
+    この2つはメトリクスにのみ記録します。
+    """
+    if provider is not None:
+        record_tokens(provider, model, input_tokens, output_tokens, cached_input_tokens, cache_write_tokens)
+    usage = generation_usage.get()
+    if usage is not None:
+        usage["input_tokens"] += input_tokens or 0
+        usage["output_tokens"] += output_tokens or 0
+        usage.update(flags)
+
+def anthropic_input_usage(usage):
+    """
+    Anthropic の usage から (入力トークン数の合計, キャッシュから読み込んだ数, キャッシュに書き込んだ数) を返す
 
-def generate_deepseek(query, model, system_prompt, prompt_type):
-    try:
-        # DeepSeek APIキーの取得
-        api_key = os.environ.get("DEEPSEEK_API_KEY")
-        if not api_key:
-            raise ValueError("DEEPSEEK_API_KEY environment variable is not set.")
-
-        client = OpenAI(
-            api_key=api_key,
-            base_url="https://api.deepseek.com/v1"
+    Anthropic の input_tokens はキャッシュの読み込み・書き込み分を含まないため合計します。
+    """
+    cache_read = getattr(usage, "cache_read_input_tokens", None) or 0
+    cache_write = getattr(usage, "cache_creation_input_tokens", None) or 0
+    return (usage.input_tokens or 0) + cache_read + cache_write, cache_read, cache_write
+
+def record_response_usage(provider, model, response):
+    """provider の応答からトークン使用量（プロンプトキャッシュから読み込んだ数を含む）を取り出して記録する"""
+    if provider in ("openai", "deepseek"):
+        usage = getattr(response, "usage", None)
+        if usage is not None:
+            # OpenAI は prompt_tokens_details.cached_tokens、DeepSeek は prompt_cache_hit_tokens で返す
+            details = getattr(usage, "prompt_tokens_details", None)
+            cached = getattr(details, "cached_tokens", None) or getattr(usage, "prompt_cache_hit_tokens", None)
+            record_usage(usage.prompt_tokens, usage.completion_tokens, provider, model, cached or 0)
+    elif provider == "anthropic":
+        usage = getattr(response, "usage", None)
+        if usage is not None:
+            input_tokens, cache_read, cache_write = anthropic_input_usage(usage)
+            record_usage(input_tokens, usage.output_tokens, provider, model, cache_read, cache_write)
+    else:
+        usage = response.get("usageMetadata") or {}
+        record_usage(
+            usage.get("promptTokenCount"), usage.get("candidatesTokenCount"), provider, model,
+            usage.get("cachedContentTokenCount") or 0
         )
 
-        # DeepSeek API 呼び出し (system_promptを使用)
-        if prompt_type == "Web App":
-            user_msg = f"Create a web application that: {query}"
-        else:
-            user_msg = query
-        response = client.chat.completions.create(
-            model=model,
-            messages=[
-                {"role": "system", "content": system_prompt},
-                {"role": "user", "content": user_msg}
-            ],
-            temperature=0.7,
-            max_tokens=2048,
-            stream=False
+# 出力トークン数の上限を指定しないモデル（推論モデルなど）の出力トークン数の見積もり
+DEFAULT_OUTPUT_TOKEN_ESTIMATE = env_int("DEFAULT_OUTPUT_TOKEN_ESTIMATE", 4096)
+
+def estimate_request_tokens(params):
+    """TPM の制限に使うトークン数の見積もり（入力は4文字 = 1トークンとし、出力は上限値を使う）"""
+    chars = len(params.get("system_instruction") or "")
+    chars += sum(len(block["text"]) for block in params.get("system") or [])
+    for message in params.get("messages") or []:
+        chars += len(message["content"])
+    for content in params.get("contents") or []:
+        chars += sum(len(part.get("text", "")) for part in content["parts"])
+    return chars // 4 + params.get("max_tokens", DEFAULT_OUTPUT_TOKEN_ESTIMATE)
+
+async def request_completion(provider, params):
+    """provider を呼び出して応答テキストを返す（レート制限・リトライ・circuit breaker を経由する）"""
+    return await provider_resilience.call(
+        provider, params["model"],
+        lambda: _request_completion(provider, params),
+        estimate_request_tokens(params)
+    )
+
+async def _request_completion(provider, params):
+    model = params["model"]
+    started = time.monotonic()
+    with span("provider_call", provider=provider, model=model):
+        response_text = await _call_provider(provider, params)
+    # ヘッジの待ち時間の計算に使うため、provider を実際に呼び出した応答時間のみ記録する
+    provider_latency.observe(f"{provider}:{model}", time.monotonic() - started)
+    return response_text
+
+async def _call_provider(provider, params):
+    client = client_registry.get(provider)
+    model = params["model"]
+    if provider in ("openai", "deepseek"):
+        response = await client.chat.completions.create(**params)
+        record_response_usage(provider, model, response)
+        return response.choices[0].message.content
+    if provider == "anthropic":
+        response = await client.messages.create(**params)
+        record_response_usage(provider, model, response)
+        return get_prefill(params) + response.content[0].text
+    data = await client.generate_content_async(**params)
+    record_response_usage(provider, model, data)
+    return client.response_text(data)
+
+async def request_stream(provider, params):
+    """providerのストリーミングAPIを呼び出し、受信したトークンを逐次 yield する"""
+    async for token in provider_resilience.stream(
+        provider, params["model"],
+        lambda: _timed_stream(provider, params),
+        estimate_request_tokens(params)
+    ):
+        yield token
+
+async def _timed_stream(provider, params):
+    model = params["model"]
+    started = time.perf_counter()
+    first_token = True
+    with span("provider_call", provider=provider, model=model):
+        async for token in _request_stream(provider, params):
+            if first_token:
+                first_token = False
+                time_to_first_token_seconds.observe(time.perf_counter() - started, provider=provider, model=model)
+            yield token
+
+async def _request_stream(provider, params):
+    client = client_registry.get(provider)
+    model = params["model"]
+    if provider in ("openai", "deepseek"):
+        stream = await client.chat.completions.create(
+            **dict(params, stream=True, stream_options={"include_usage": True})
         )
+        # キャンセルされた場合もすぐに接続を閉じ、provider 側の生成を打ち切る
+        try:
+            async for chunk in stream:
+                if chunk.usage is not None:
+                    record_response_usage(provider, model, chunk)
+                if chunk.choices and chunk.choices[0].delta.content:
+                    yield chunk.choices[0].delta.content
+        finally:
+            await stream.close()
+    elif provider == "anthropic":
+        stream = await client.messages.create(**params, stream=True)
+        try:
+            if get_prefill(params):
+                yield get_prefill(params)
+            async for event in stream:
+                if event.type == "message_start":
+                    input_tokens, cache_read, cache_write = anthropic_input_usage(event.message.usage)
+                    record_usage(input_tokens, 0, provider, model, cache_read, cache_write)
+                elif event.type == "message_delta":
+                    record_usage(output_tokens=event.usage.output_tokens, provider=provider, model=model)
+                elif event.type == "content_block_delta" and getattr(event.delta, "text", None):
+                    yield event.delta.text
+        finally:
+            await stream.close()
+    else:
+        async for text in client.stream_generate_content_async(
+            **params, on_usage=lambda data: record_response_usage(provider, model, data)
+        ):
+            yield text
+
+def make_cache_key(provider, query, model, system_prompt, prompt_type, params, json_mode=False):
+    """応答キャッシュのキー（provider, model, システムプロンプトのハッシュ, prompt_type, query, 生成パラメータ）"""
+    generation_params = {
+        k: v for k, v in params.items()
+        if k not in ("messages", "contents", "system", "system_instruction", "stream")
+    }
+    return response_cache.make_key(
+        provider, model,
+        system_prompt_hash=hash_text(system_prompt),
+        prompt_type=prompt_type,
+        query=query,
+        params=generation_params,
+        json_mode=json_mode,
+    )
+
+async def complete(provider, query, model, system_prompt, prompt_type, use_cache=True,
+                   json_mode=False):
+    """
+    LLMを呼び出して応答テキストを返す（応答キャッシュと single-flight を経由する）
 
-        response_text = response.choices[0].message.content
-        code = remove_code_block(response_text)
-        preview = send_to_preview(code)
-        return code, preview
-    except Exception as e:
-        err = f"Error in DeepSeek: {str(e)}"
-        return err, f"<div style='padding: 8px;color:red;'>{err}</div>"
-
-# ユーティリティ関数の追加
-def remove_code_block(text):
-    """コードブロックから実際のコードを抽出する"""
-    pattern = r'```(?:html)?\n(.+?)\n```'
-    match = re.search(pattern, text, re.DOTALL)
-    if match:
-        return match.group(1).strip()
-    return text.strip()
+    同じキーの呼び出しが実行中の場合は provider を呼び出さずにその結果を待ちます。
+    use_cache が False の場合はキャッシュも実行中の呼び出しも共有せずに provider を
+    呼び出します（結果はキャッシュに保存されます）。
+    """
+    params = PARAM_BUILDERS[provider](query, model, system_prompt, prompt_type, json_mode)
+    key = make_cache_key(provider, query, model, system_prompt, prompt_type, params, json_mode)
+    if use_cache:
+        cached = await response_cache.aget(key)
+        if cached is not None:
+            logger.info(f"Response cache hit for {provider}:{model}")
+            record_usage(cache_hit=True)
+            return cached
+
+    async def call():
+        response_text = await request_completion(provider, params)
+        record_usage(completed=True)
+        await response_cache.aset(key, response_text)
+        return response_text
+
+    if not use_cache:
+        return await call()
+    # 同じキーの呼び出しが実行中であれば、その結果を共有する
+    return await llm_single_flight.do(key, call)
+
+async def stream_complete(provider, query, model, system_prompt, prompt_type, use_cache=True,
+                          json_mode=False):
+    """complete のストリーミング版（キャッシュにある場合は応答全体を一度に yield する）"""
+    params = PARAM_BUILDERS[provider](query, model, system_prompt, prompt_type, json_mode)
+    key = make_cache_key(provider, query, model, system_prompt, prompt_type, params, json_mode)
+    if use_cache:
+        cached = await response_cache.aget(key)
+        if cached is not None:
+            logger.info(f"Response cache hit for {provider}:{model}")
+            record_usage(cache_hit=True)
+            yield cached
+            return
+    chunks = []
+    async for token in request_stream(provider, params):
+        chunks.append(token)
+        yield token
+    record_usage(completed=True)
+    await response_cache.aset(key, "".join(chunks))
+
+# <base> タグを挿入する位置（開始タグ）
+HEAD_TAG_PATTERN = re.compile(r"<head(?:\s[^>]*)?>", re.IGNORECASE)
+HTML_TAG_PATTERN = re.compile(r"<html(?:\s[^>]*)?>", re.IGNORECASE)
 
 # send_to_preview関数を更新
 def send_to_preview(code, iframe_id=""):
     """
     HTMLプレビューを生成する関数です。
     生成されたコードに <base> タグを追加し、iframe 内での相対 URL の解決を保証します。
+    文書は artifact_store に保存し、iframe はその URL を遅延読み込みします。
+    HTML 文書ではなく GeneratedComponent を定義した React のコードの場合は send_to_preview_react で表示します。
     """
-    clean_code = code.replace("```html", "").replace("```", "").strip()
+    # code は extract_code でコードブロックの中身を取り出したもの
+    clean_code = code.strip()
+
+    if HTML_TAG_PATTERN.search(clean_code) is None and REACT_COMPONENT_PATTERN.search(clean_code):
+        return send_to_preview_react(clean_code, iframe_id=iframe_id)
 
     # 既にHTML文書でなければ、<base>タグ付きのHTMLテンプレートでラップ
-    if "<html" not in clean_code.lower():
+    if HTML_TAG_PATTERN.search(clean_code) is None:
         wrapped_code = f"""<!DOCTYPE html>
 <html>
   <head>
@@ -391,110 +625,172 @@ def send_to_preview(code, iframe_id=""):
 </html>"""
     else:
         # 既存のHTMLドキュメントの場合は<head>タグ内に<base>タグを追加
-        if "<head>" in clean_code.lower():
-            wrapped_code = clean_code.replace(
-                "<head>",
-                f'<head>\n    <base href="{BASE_URL}/">'
-            )
-        else:
+        # （大文字・属性付きのタグも含め、最初のタグの直後に1回だけ挿入する）
+        match = HEAD_TAG_PATTERN.search(clean_code)
+        tag = f'\n    <base href="{BASE_URL}/">'
+        if match is None:
             # <head>タグがない場合は追加
-            wrapped_code = clean_code.replace(
-                "<html>",
-                f'<html>\n  <head>\n    <base href="{BASE_URL}/">\n  </head>'
-            )
+            match = HTML_TAG_PATTERN.search(clean_code)
+            tag = f'\n  <head>{tag}\n  </head>'
+        if match is None:
+            wrapped_code = clean_code
+        else:
+            wrapped_code = clean_code[:match.end()] + tag + clean_code[match.end():]
+
+    return render_preview_iframe(wrapped_code, iframe_id)
 
-    encoded_html = base64.b64encode(wrapped_code.encode('utf-8')).decode('utf-8')
-    data_uri = f"data:text/html;charset=utf-8;base64,{encoded_html}"
+def render_preview_iframe(document, iframe_id=""):
+    """HTML文書を artifact_store に保存し、その URL を遅延読み込みする iframe を返す"""
+    artifact_url = artifact_store.url(artifact_store.put(document))
 
     id_attribute = f' id="{iframe_id}"' if iframe_id else ""
     return f'''
         <iframe{id_attribute}
-            src="{data_uri}"
+            src="{artifact_url}"
+            loading="lazy"
             style="width:100%;border:none;border-radius:4px;"
             sandbox="allow-scripts allow-same-origin"
         ></iframe>
     '''
 
-# 既存のsend_to_preview関数はそのままとして、以下に新しい関数 send_to_preview_react を追加
+# インラインのスクリプト内で </script> によりスクリプトが終わらないようにする
+SCRIPT_END_PATTERN = re.compile(r"</(script)", re.IGNORECASE)
+
+def escape_inline_script(code):
+    return SCRIPT_END_PATTERN.sub(r"<\\/\1", code)
+
+# React のプレビューで表示するコンポーネントの定義
+REACT_COMPONENT_PATTERN = re.compile(r"\b(?:function|class|const|let|var)\s+GeneratedComponent\b")
+# react・react-dom の import（プレビューでは同梱した React をグローバル変数として読み込む）
+REACT_IMPORT_PATTERN = re.compile(
+    r"^[ \t]*import\s+(?:(?:React|ReactDOM)\s*,?\s*)?(?:\{([^}]*)\}\s*)?from\s+['\"]react(?:-dom(?:/client)?)?['\"];?[ \t]*$",
+    re.MULTILINE,
+)
+EXPORT_PATTERN = re.compile(r"^([ \t]*)export\s+(?:default\s+)?", re.MULTILINE)
+
+def prepare_react_code(react_code):
+    """
+    react の import・export を、ブラウザでそのまま実行できる形に置き換える
 
-def send_to_preview_react(react_code, container_id=""):
+    import { useState } from 'react' は const { useState } = React に置き換え、export は取り除きます。
+    """
+    def replace_import(match):
+        names = match.group(1)
+        if not names or not names.strip():
+            return ""
+        return "const {" + re.sub(r"\s+as\s+", ": ", names) + "} = React;"
+    return EXPORT_PATTERN.sub(r"\1", REACT_IMPORT_PATTERN.sub(replace_import, react_code))
+
+def send_to_preview_react(react_code, container_id="", iframe_id=""):
     """
     LLM が生成した React コンポーネントのコードを使ってプレビューを生成する関数です。
 
     ※ この実装は試作用であり、セキュリティ対策は最小限です。
 
     生成されたコードは、Reactコンポーネント（例: GeneratedComponent）が定義されている前提です。
-    Babel を利用して JSX をランタイムにコンパイルし、ReactDOM でレンダリングします。
+    JSX はサーバー側で jsx_compiler により変換し（結果はコードのハッシュをキーにキャッシュ）、
+    通常の <script> として同梱した React の本番用ビルドでレンダリングします。
+    文書は send_to_preview と同じく artifact_store に保存し、iframe で読み込みます。
     """
     if not container_id:
         container_id = "react_preview"
-    html_react = f"""
+    try:
+        script = jsx_compiler.compile(prepare_react_code(react_code))
+    except JSXSyntaxError as e:
+        # 変換できないコードはブラウザで実行せず、エラーを表示する
+        return render_preview_iframe(f"""<!DOCTYPE html>
+<html>
+  <head>
+    <meta charset="utf-8">
+  </head>
+  <body>
+    <pre style="color:red;white-space:pre-wrap;">JSX の変換に失敗しました: {escape_html(str(e))}</pre>
+  </body>
+</html>""", iframe_id)
+    html_react = f"""<!DOCTYPE html>
+<html>
+  <head>
+    <meta charset="utf-8">
+    <base href="{BASE_URL}/">
+  </head>
+  <body>
     <div id="{container_id}"></div>
-    <!-- React と ReactDOM の読み込み（開発用版） -->
-    <script crossorigin src="https://unpkg.com/react@17/umd/react.development.js"></script>
-    <script crossorigin src="https://unpkg.com/react-dom@17/umd/react-dom.development.js"></script>
-    <!-- Babel の読み込み（JSXをランタイムコンパイルするため） -->
-    <script src="https://unpkg.com/@babel/standalone/babel.min.js"></script>
-    <!-- 生成された React コンポーネントのコードを含むスクリプト -->
-    <script type="text/babel">
-    {react_code}
-    // 例: LLM により生成されたコード内で GeneratedComponent が定義されていると仮定
-    ReactDOM.render(<GeneratedComponent />, document.getElementById("{container_id}"));
+    <!-- React と ReactDOM の読み込み（本番用ビルド） -->
+    <script src="{static_assets.url("react.js")}"></script>
+    <script src="{static_assets.url("react-dom.js")}"></script>
+    <script>
+{escape_inline_script(script)}
+ReactDOM.createRoot(document.getElementById("{container_id}")).render(React.createElement(GeneratedComponent));
     </script>
-    """
-    return html_react
-
-# 既存のimportに追加
-from concurrent.futures import ThreadPoolExecutor
+  </body>
+</html>"""
+    return render_preview_iframe(html_react, iframe_id)
 
-# 非同期のLLM生成関数を更新
-async def async_generate_openai(query, model, system_prompt, prompt_type):
+# 非同期のLLM生成関数（共有の非同期クライアントを直接 await する）
+# プレビューは結果カードの生成時に作るため、ここでは (code, None) を返す
+async def async_generate_openai(query, model, system_prompt, prompt_type, use_cache=True):
     try:
-        # 同期的な generate_openai を asyncio.to_thread で実行し、並列化
-        return await asyncio.to_thread(generate_openai, query, model, system_prompt, prompt_type)
+        logger.info(f"Starting OpenAI generation with model {model}")
+        response_text = await complete("openai", query, model, system_prompt, prompt_type, use_cache)
+        logger.info(f"Successfully completed OpenAI generation with {model}")
+        return build_result(response_text, with_preview=False, prompt_type=prompt_type)
     except Exception as e:
         logger.error(f"Error in async OpenAI generation: {str(e)}")
-        return (f"Error in OpenAI: {str(e)}",
-                f"<div style='padding: 8px;color:red;'>Error in OpenAI: {str(e)}</div>")
+        return build_error_result("OpenAI", e)
 
-async def async_generate_anthropic(query, model, system_prompt, prompt_type):
+async def async_generate_anthropic(query, model, system_prompt, prompt_type, use_cache=True):
     try:
-        # 同期的な generate_anthropic を asyncio.to_thread で実行し、並列化
-        return await asyncio.to_thread(generate_anthropic, query, model, system_prompt, prompt_type)
+        response_text = await complete("anthropic", query, model, system_prompt, prompt_type, use_cache)
+        return build_result(response_text, with_preview=False, prompt_type=prompt_type)
     except Exception as e:
         logger.error(f"Error in async Anthropic generation: {str(e)}")
-        return (f"Error in Anthropic: {str(e)}",
-                f"<div style='padding: 8px;color:red;'>Error in Anthropic: {str(e)}</div>")
+        return build_error_result("Anthropic", e)
 
-async def async_generate_gemini(query, model, system_prompt, prompt_type):
+async def async_generate_gemini(query, model, system_prompt, prompt_type, use_cache=True):
     try:
-        # 同期的な generate_gemini を asyncio.to_thread で実行し、並列化
-        return await asyncio.to_thread(generate_gemini, query, model, system_prompt, prompt_type)
+        response_text = await complete("gemini", query, model, system_prompt, prompt_type, use_cache)
+        return build_result(response_text, with_preview=False, prompt_type=prompt_type)
     except Exception as e:
         logger.error(f"Error in async Gemini generation: {str(e)}")
-        return (f"Error in Gemini: {str(e)}",
-                f"<div style='padding: 8px;color:red;'>Error in Gemini: {str(e)}</div>")
+        return build_error_result("Gemini", e)
 
-async def async_generate_deepseek(query, model, system_prompt, prompt_type):
+async def async_generate_deepseek(query, model, system_prompt, prompt_type, use_cache=True):
     try:
-        # 同期的な generate_deepseek を asyncio.to_thread で実行し、並列化
-        return await asyncio.to_thread(generate_deepseek, query, model, system_prompt, prompt_type)
+        response_text = await complete("deepseek", query, model, system_prompt, prompt_type, use_cache)
+        return build_result(response_text, with_preview=False, prompt_type=prompt_type)
     except Exception as e:
         logger.error(f"Error in async DeepSeek generation: {str(e)}")
-        return (f"Error in DeepSeek: {str(e)}",
-                f"<div style='padding: 8px;color:red;'>Error in DeepSeek: {str(e)}</div>")
-
-# 統合生成関数を簡素化
-async def get_implementation_plan(query, prompt_type):
-    """o3-miniを使用して実装計画を生成する"""
-    try:
-        api_key = os.environ.get("OPENAI_API_KEY")
-        if not api_key:
-            raise ValueError("OPENAI_API_KEY environment variable is not set.")
-
-        client = OpenAI(api_key=api_key)
+        return build_error_result("DeepSeek", e)
+
+# ストリーミング版のLLM生成関数（受信したトークンを逐次 yield する非同期ジェネレータ）
+async def stream_openai(query, model, system_prompt, prompt_type, use_cache=True):
+    async for token in stream_complete("openai", query, model, system_prompt, prompt_type, use_cache):
+        yield token
+
+async def stream_anthropic(query, model, system_prompt, prompt_type, use_cache=True):
+    async for token in stream_complete("anthropic", query, model, system_prompt, prompt_type, use_cache):
+        yield token
+
+async def stream_gemini(query, model, system_prompt, prompt_type, use_cache=True):
+    async for token in stream_complete("gemini", query, model, system_prompt, prompt_type, use_cache):
+        yield token
+
+async def stream_deepseek(query, model, system_prompt, prompt_type, use_cache=True):
+    async for token in stream_complete("deepseek", query, model, system_prompt, prompt_type, use_cache):
+        yield token
+
+# 実装計画を作成するモデル
+PLANNING_MODEL = "o3-mini"
+
+# 実装計画を待たずに（計画なしで）生成を開始するモデル（例: "openai:o3-mini,deepseek:deepseek-r1"）
+# デフォルトではすべてのモデルが計画を受け取る
+PLAN_EXEMPT_MODELS = [
+    name.strip()
+    for name in os.environ.get("PLAN_EXEMPT_MODELS", "").split(",")
+    if name.strip()
+]
 
-        planning_prompt = """あなたは優秀なソフトウェアアーキテクトです。
+PLANNING_SYSTEM_PROMPT = """あなたは優秀なソフトウェアアーキテクトです。
 以下の要件に対する実装計画を作成してください。
 
 1. 要件の分析
@@ -508,93 +804,105 @@ async def get_implementation_plan(query, prompt_type):
 [ここに計画の詳細を記載]
 </実装計画>"""
 
-        if prompt_type == "Web App":
-            user_msg = f"以下のWebアプリケーションの実装計画を作成してください：{query}"
-        else:
-            user_msg = f"以下の機能の実装計画を作成してください：{query}"
+async def request_implementation_plan(query, prompt_type):
+    """PLANNING_MODEL を呼び出して実装計画を作成する（エラーはそのまま送出する）"""
+    if prompt_type == "Web App":
+        user_msg = f"以下のWebアプリケーションの実装計画を作成してください：{query}"
+    else:
+        user_msg = f"以下の機能の実装計画を作成してください：{query}"
 
-        response = client.chat.completions.create(
-            model="o3-mini",
-            messages=[
-                {"role": "system", "content": planning_prompt},
+    async with provider_limiter.limit("openai"):
+        return await request_completion("openai", {
+            "model": PLANNING_MODEL,
+            "messages": [
+                {"role": "system", "content": PLANNING_SYSTEM_PROMPT},
                 {"role": "user", "content": user_msg}
             ],
-            stream=False
-        )
+            "stream": False
+        })
+
+# 統合生成関数を簡素化
+async def get_implementation_plan(query, prompt_type, use_cache=True):
+    """
+    o3-miniを使用して実装計画を生成する
 
-        plan = response.choices[0].message.content
-        return plan
+    計画は (query, prompt_type) 毎に応答キャッシュへ保存し、同じ要件の計画が作成中の場合は
+    その結果を共有します。エラーの場合はエラーメッセージを返します（キャッシュしません）。
+    """
+    key = response_cache.make_key("plan", PLANNING_MODEL, query=query, prompt_type=prompt_type)
+    try:
+        if use_cache:
+            cached = await response_cache.aget(key)
+            if cached is not None:
+                logger.info("Implementation plan cache hit")
+                return cached
+
+        async def call():
+            with span("planning", provider="openai", model=PLANNING_MODEL):
+                plan = await request_implementation_plan(query, prompt_type)
+            await response_cache.aset(key, plan)
+            return plan
+
+        if not use_cache:
+            return await call()
+        return await llm_single_flight.do(key, call)
     except Exception as e:
         logger.error(f"Error in implementation planning: {str(e)}")
         return f"Error in planning: {str(e)}"
 
-async def generate_parallel(query, selected_models, system_prompt, prompt_type, use_planning=False):
-    logger.info(f"Received generation request - Query: {query}")
-    logger.info(f"Selected models: {selected_models}")
+def with_plan(system_prompt, implementation_plan):
+    """実装計画をシステムプロンプトに追加する"""
+    return f"{system_prompt}\n\n実装計画：\n{implementation_plan}"
 
-    implementation_plan = ""
-    if use_planning:
-        implementation_plan = await get_implementation_plan(query, prompt_type)
-        # 実装計画をシステムプロンプトに追加
-        system_prompt = f"{system_prompt}\n\n実装計画：\n{implementation_plan}"
-
-    # 同時実行数を制御するセマフォを作成（必要に応じて数値を調整）
-    semaphore = asyncio.Semaphore(5)  # 同時に5つまで実行可能
-
-    async def run_with_semaphore(full_model, task):
-        async with semaphore:
-            return await task
+async def resolve_system_prompt(full_model, system_prompt, plan):
+    """
+    モデルに渡すシステムプロンプトを決める
 
-    tasks = []
-    for full_model in selected_models:
-        try:
-            provider, model = full_model.split(":")
-            logger.info(f"Preparing task for {full_model}")
+    plan には実装計画の文字列、または作成中の計画（Task）を渡します。PLAN_EXEMPT_MODELS の
+    モデルは計画を待たずに元のシステムプロンプトを使います。
+    """
+    if plan is None or full_model in PLAN_EXEMPT_MODELS:
+        return system_prompt
+    if not isinstance(plan, str):
+        # 1つのモデルがキャンセルされても、他のモデルのために計画の作成を続ける
+        plan = await asyncio.shield(plan)
+    return with_plan(system_prompt, plan)
+
+# 結果グリッドのHTML（Prism によるコードのハイライトを含む。Prism は同梱したものを static_assets から読み込み、
+# 配色は custom_css の .code-content .token で指定する）
+GRID_HEADER = """
+    <script src="{prism_js}"></script>
+    <div class='results-container'>
+        <div class='results-grid'>
+    """
 
-            if provider == "openai":
-                task = async_generate_openai(query, model, system_prompt, prompt_type)
-            elif provider == "anthropic":
-                task = async_generate_anthropic(query, model, system_prompt, prompt_type)
-            elif provider == "gemini":
-                task = async_generate_gemini(query, model, system_prompt, prompt_type)
-            elif provider == "deepseek":
-                task = async_generate_deepseek(query, model, system_prompt, prompt_type)
-            else:
-                logger.error(f"Unknown provider: {full_model}")
-                continue
+GRID_FOOTER = """
+        </div>
+    </div>
+    """
 
-            tasks.append((full_model, run_with_semaphore(full_model, task)))
+def get_model_id(full_model):
+    """provider:model からHTML要素のIDに使える文字列を生成する"""
+    provider, model_name = full_model.split(":", 1)
+    return f"model_{provider}_{model_name}".replace("-", "_")
 
-        except Exception as e:
-            logger.error(f"Error preparing task for {full_model}: {str(e)}")
-            continue
+def escape_html(text):
+    return text.replace("&", "&amp;").replace("<", "&lt;").replace(">", "&gt;")
 
-    results = []
-    if tasks:
-        completed_tasks = await asyncio.gather(*(task for _, task in tasks))
-        for (full_model, _), result in zip(tasks, completed_tasks):
-            # await で結果を取り出してからリストに追加
-            code, preview = result
-            results.append((full_model, code, preview))
-
-    # HTMLの生成（plan_htmlを削除）
-    grid_html = """
-    <link href="https://cdnjs.cloudflare.com/ajax/libs/prism/1.24.1/themes/prism-coy.min.css" rel="stylesheet" />
-    <script src="https://cdnjs.cloudflare.com/ajax/libs/prism/1.24.1/prism.min.js"></script>
-    <script src="https://cdnjs.cloudflare.com/ajax/libs/prism/1.24.1/components/prism-markup.min.js"></script>
-    <div class='results-container'>
-        <div class='results-grid'>
-    """
+def render_grid(cards):
+    """結果カードのリストからグリッドHTMLを生成する"""
+    header = GRID_HEADER.format(prism_js=static_assets.url("prism.js"))
+    return header + "".join(cards) + GRID_FOOTER
 
-    # 結果カードの生成
-    for full_model, code, preview in results:
-        provider, model_name = full_model.split(":")
-        model_id = f"model_{provider}_{model_name}".replace("-", "_")
+def render_result_card(full_model, code):
+    """生成が完了したモデルの結果カード（プレビュー + コード）を生成する"""
+    provider, model_name = full_model.split(":", 1)
+    model_id = get_model_id(full_model)
 
-        preview_iframe = send_to_preview(code, iframe_id=f"{model_id}_preview")
-        escaped_code = code.replace("&", "&amp;").replace("<", "&lt;").replace(">", "&gt;")
+    preview_iframe = send_to_preview(code, iframe_id=f"{model_id}_preview")
+    escaped_code = escape_html(code)
 
-        grid_html += f"""
+    return f"""
             <div class='result-card'>
                 <div class='card-header'>
                     <div class='header-title'>
@@ -639,84 +947,460 @@ async def generate_parallel(query, selected_models, system_prompt, prompt_type,
             </div>
         """
 
-    grid_html += """
-        </div>
-    </div>
+def render_streaming_card(full_model, text, elapsed):
+    """生成中のモデルのカード（受信済みの応答から取り出したコードを表示）を生成する"""
+    provider, model_name = full_model.split(":", 1)
+    model_id = get_model_id(full_model)
+    body = escape_html(text) if text else "応答を待っています..."
+    return f"""
+            <div class='result-card'>
+                <div class='card-header'>
+                    <div class='header-title'>
+                        <strong>{provider.upper()}</strong> - {model_name}
+                        <span class='card-status'>生成中... {elapsed:.0f}s</span>
+                    </div>
+                </div>
+                <div id='{model_id}_stream' class='code-content streaming-content'>
+                    <pre><code>{body}</code></pre>
+                </div>
+            </div>
+        """
+
+# provider毎の非同期生成関数
+ASYNC_GENERATORS = {
+    "openai": async_generate_openai,
+    "anthropic": async_generate_anthropic,
+    "gemini": async_generate_gemini,
+    "deepseek": async_generate_deepseek,
+}
+
+# provider毎のストリーミング生成関数
+STREAM_GENERATORS = {
+    "openai": stream_openai,
+    "anthropic": stream_anthropic,
+    "gemini": stream_gemini,
+    "deepseek": stream_deepseek,
+}
+
+PROVIDER_LABELS = {
+    "openai": "OpenAI",
+    "anthropic": "Anthropic",
+    "gemini": "Gemini",
+    "deepseek": "DeepSeek",
+}
+
+async def generate_parallel(query, selected_models, system_prompt, prompt_type, plan=None,
+                            use_cache=True):
+    """全モデルの生成結果（deadline を過ぎたモデルはタイムアウト）を並べたグリッドHTMLを返す"""
+    grid_html = render_grid([])
+    async for grid_html in iter_generate_parallel(
+        query, selected_models, system_prompt, prompt_type, plan=plan, use_cache=use_cache
+    ):
+        pass
+    return grid_html
+
+async def iter_generate_parallel(query, selected_models, system_prompt, prompt_type, plan=None,
+                                 deadline=MODEL_DEADLINE_SECONDS, use_cache=True):
+    """
+    generate_parallel の逐次版です。
+    モデルの生成が完了した順に結果カードを追加したグリッドHTMLを yield します。
+    未完了のモデルには経過時間付きのプレースホルダーを表示し、deadline 秒を過ぎたモデルは
+    打ち切ってタイムアウトとして表示します（deadline が 0 の場合は打ち切らない）。
+    plan（実装計画の文字列、または作成中の計画の Task）を渡すと、計画をシステムプロンプトに
+    追加します。PLAN_EXEMPT_MODELS のモデルは計画の完成を待たずに生成を開始します。
+    図のモードでは、各モデルの応答から図を取り出して描画した結果カードを表示します。
     """
+    logger.info(f"Received generation request - Query: {truncate(query, 200)}")
+    logger.info(f"Selected models: {selected_models}")
+
+    # provider毎の同時実行数はアプリ全体で共有する provider_limiter で制御する
+    # （計画を待つ間や図を描画する間は provider の実行枠を確保しない）
+    async def run_with_semaphore(full_model, provider, model):
+        model_prompt = await resolve_system_prompt(full_model, system_prompt, plan)
+        async with provider_limiter.limit(provider):
+            model_started = time.monotonic()
+            usage = start_usage_tracking()
+            code, _ = await ASYNC_GENERATORS[provider](query, model, model_prompt, prompt_type, use_cache)
+            latency = time.monotonic() - model_started
+        await record_generation(query, full_model, prompt_type, model_prompt, code, latency, usage)
+        return await render_final_card(full_model, code, prompt_type)
+
+    started = time.monotonic()
+    tasks = {}
+    for full_model in selected_models:
+        try:
+            provider, model = full_model.split(":")
+            logger.info(f"Preparing task for {full_model}")
+
+            if provider not in ASYNC_GENERATORS:
+                logger.error(f"Unknown provider: {full_model}")
+                continue
+            tasks[asyncio.create_task(run_with_semaphore(full_model, provider, model))] = full_model
+
+        except Exception as e:
+            logger.error(f"Error preparing task for {full_model}: {str(e)}")
+            continue
+
+    # 完了順に並べた結果カード
+    completed = []
+    pending = set(tasks)
+
+    def render():
+        elapsed = time.monotonic() - started
+        cards = list(completed)
+        cards += [
+            render_streaming_card(full_model, "", elapsed)
+            for task, full_model in tasks.items() if task in pending
+        ]
+        return render_grid(cards)
+
+    try:
+        yield render()
+        while pending:
+            timeout = PLACEHOLDER_REFRESH_INTERVAL
+            if deadline:
+                timeout = min(timeout, max(0, started + deadline - time.monotonic()))
+            done, pending = await asyncio.wait(
+                pending, timeout=timeout, return_when=asyncio.FIRST_COMPLETED
+            )
+            for task in done:
+                full_model = tasks[task]
+                try:
+                    card = task.result()
+                except Exception as e:
+                    code, _ = build_error_result(PROVIDER_LABELS[full_model.split(":")[0]], e)
+                    card = render_result_card(full_model, code)
+                completed.append(card)
+
+            # deadline を過ぎたモデルは打ち切り、グリッドを確定させる
+            if pending and deadline and time.monotonic() - started >= deadline:
+                for task in pending:
+                    task.cancel()
+                    full_model = tasks[task]
+                    logger.warning(f"Generation with {full_model} timed out after {deadline:.0f}s")
+                    code, _ = build_error_result(
+                        PROVIDER_LABELS[full_model.split(":")[0]], f"timed out after {deadline:.0f}s"
+                    )
+                    completed.append(render_result_card(full_model, code))
+                pending = set()
+            yield render()
+    finally:
+        # 呼び出し側が途中で止めた場合は残りの生成を中断する
+        for task in tasks:
+            task.cancel()
 
     logger.info("Completed generating HTML grid")
-    return grid_html
 
-# Kroki.ioを使ってSVGを取得する関数
-def get_kroki_svg(diagram_source, diagram_type):
+async def generate_parallel_stream(query, selected_models, system_prompt, prompt_type, plan=None,
+                                   deadline=MODEL_DEADLINE_SECONDS, use_cache=True):
     """
-    Kroki.ioを使って図のSVGを取得する
-    
-    Args:
-        diagram_source (str): 図のソースコード
-        diagram_type (str): 図のタイプ (excalidraw, graphviz, mermaid)
-        
-    Returns:
-        str: SVG形式の図、エラーの場合はエラーメッセージ
+    generate_parallel のストリーミング版です。
+    各モデルのトークンを受信するたびに、更新されたグリッドHTMLを yield します。
+    （更新頻度は STREAM_UPDATE_INTERVAL 秒毎に間引きます）
+    plan の扱いは iter_generate_parallel と同じです。
     """
+    logger.info(f"Received streaming generation request - Query: {truncate(query, 200)}")
+    logger.info(f"Selected models: {selected_models}")
+
+    started = time.monotonic()
+    states = {}
+    changed = asyncio.Event()
+
+    async def consume(full_model, provider, model):
+        state = states[full_model]
+        try:
+            model_prompt = await resolve_system_prompt(full_model, system_prompt, plan)
+            async with provider_limiter.limit(provider):
+                model_started = time.monotonic()
+                usage = start_usage_tracking()
+                async for token in STREAM_GENERATORS[provider](query, model, model_prompt, prompt_type, use_cache):
+                    state["extractor"].feed(token)
+                    changed.set()
+                latency = time.monotonic() - model_started
+            state["extractor"].close()
+            code = state["extractor"].code
+            await record_generation(query, full_model, prompt_type, model_prompt, code, latency, usage)
+            state["card"] = await render_final_card(full_model, code, prompt_type)
+        except Exception as e:
+            logger.error(f"Error in streaming generation with {full_model}: {str(e)}")
+            state["card"] = render_result_card(full_model, build_error_result(PROVIDER_LABELS[provider], e)[0])
+        finally:
+            changed.set()
+
+    tasks = []
+    for full_model in selected_models:
+        provider, model = full_model.split(":", 1)
+        if provider not in STREAM_GENERATORS:
+            logger.error(f"Unknown provider: {full_model}")
+            continue
+        # 受信したトークンはコードブロックの中身を逐次取り出しながら保持する
+        states[full_model] = {"extractor": CodeExtractor(fence_languages(prompt_type)), "card": None}
+        tasks.append(asyncio.create_task(consume(full_model, provider, model)))
+
+    def render():
+        elapsed = time.monotonic() - started
+        cards = []
+        for full_model, state in states.items():
+            if state["card"] is None:
+                cards.append(render_streaming_card(full_model, state["extractor"].code, elapsed))
+            else:
+                cards.append(state["card"])
+        return render_grid(cards)
+
+    pending = set(tasks)
     try:
-        # POSTリクエストを使用する方法
-        url = f"https://kroki.io/{diagram_type}/svg"
-        headers = {
-            "Content-Type": "text/plain"
-        }
-        response = requests.post(url, headers=headers, data=diagram_source)
-        
-        if response.status_code == 200:
-            return response.text
-        else:
-            # エラーの場合はエラーメッセージを返す
-            return f"<div class='error'>Error: {response.status_code} - {response.text}</div>"
-    except Exception as e:
-        logger.error(f"Error getting SVG from Kroki.io: {str(e)}")
-        return f"<div class='error'>Error: {str(e)}</div>"
+        while pending:
+            done, pending = await asyncio.wait(pending, timeout=STREAM_UPDATE_INTERVAL)
+            # deadline を過ぎたモデルは打ち切り、受信済みの内容で確定させる
+            if pending and deadline and time.monotonic() - started >= deadline:
+                for task in pending:
+                    task.cancel()
+                for full_model, state in states.items():
+                    if state["card"] is None:
+                        logger.warning(f"Streaming generation with {full_model} timed out after {deadline:.0f}s")
+                        code, _ = build_error_result(
+                            PROVIDER_LABELS[full_model.split(":")[0]], f"timed out after {deadline:.0f}s"
+                        )
+                        state["card"] = render_result_card(full_model, code)
+                pending = set()
+                changed.set()
+            if changed.is_set() or done:
+                changed.clear()
+                yield render()
+        yield render()
+    finally:
+        # 呼び出し側が途中で止めた場合は残りのストリームを中断する
+        for task in tasks:
+            task.cancel()
+
+    logger.info("Completed streaming HTML grid")
+
+# 図のモード（prompt_type -> Kroki の図のタイプ）
+DIAGRAM_TYPES = {
+    "Excalidraw": "excalidraw",
+    "GraphViz": "graphviz",
+    "Mermaid": "mermaid",
+}
+
+# 図のタイプ毎に図のソースとみなすコードブロックの言語
+DIAGRAM_FENCE_LANGUAGES = {
+    "excalidraw": ("excalidraw", "json"),
+    "graphviz": ("graphviz", "dot"),
+    "mermaid": ("mermaid",),
+}
+
+# Mermaid の図の種類を表すキーワード（ソースの先頭に書かれる）
+MERMAID_DIAGRAM_KEYWORDS = (
+    "graph", "flowchart", "sequenceDiagram", "classDiagram", "stateDiagram", "erDiagram",
+    "journey", "gantt", "pie", "quadrantChart", "requirementDiagram", "gitGraph", "C4",
+    "mindmap", "timeline", "sankey", "xychart", "block", "packet", "architecture", "kanban",
+)
 
-# 図のプレビューを表示する関数
-def send_to_diagram_preview(diagram_source, diagram_type):
+def extract_diagram_source(text, diagram_type):
     """
-    図のソースコードからSVGを取得してプレビューを表示する
-    
-    Args:
-        diagram_source (str): 図のソースコード
-        diagram_type (str): 図のタイプ (excalidraw, graphviz, mermaid)
-        
+    モデルの応答から図のソースコードを取り出す
+
+    図のタイプに対応する言語のコードブロックを優先し、なければ言語指定のないコードブロック、
+    コードブロックがなければ応答全体を図のソースとみなします。
+
     Returns:
-        str: HTMLコンテンツ
+        str: 図のソースコード（見つからない場合は None）
+    """
+    blocks = parse_blocks(text)
+    block = select_block(blocks, DIAGRAM_FENCE_LANGUAGES.get(diagram_type, (diagram_type,)))
+    if block is not None:
+        return block.text.strip()
+    if blocks:
+        return None
+    return text.strip() or None
+
+def validate_diagram_source(source, diagram_type):
+    """
+    図のソースコードを描画する前に簡単に検証する（不正な場合は ValueError を送出）
+
+    Kroki に送っても描画できないことが明らかな応答（エラーメッセージや説明文など）を
+    事前に弾くためのもので、構文を完全に検証するものではありません。
     """
-    # コードブロックから図のソースコードを抽出
-    pattern = r"```(?:" + diagram_type + r")?\s*([\s\S]*?)\s*```"
-    match = re.search(pattern, diagram_source, re.IGNORECASE)
-    
-    if match:
-        source_code = match.group(1).strip()
-        svg_content = get_kroki_svg(source_code, diagram_type)
-        
-        html_content = f"""
-        <div class="result-card">
-            <div class="card-header" style="display: flex; justify-content: space-between; padding: 8px 16px; align-items: center;">
-                <div class="header-title">
-                    <strong>{diagram_type.capitalize()} Diagram</strong>
+    if diagram_type == "excalidraw":
+        try:
+            data = json.loads(source)
+        except ValueError as e:
+            raise ValueError(f"Invalid Excalidraw JSON: {e}")
+        if not isinstance(data, dict) or not isinstance(data.get("elements"), list):
+            raise ValueError("Excalidraw JSON must be an object with an 'elements' list")
+    elif diagram_type == "graphviz":
+        if not re.match(r"\s*(strict\s+)?(di)?graph\b", source, re.IGNORECASE):
+            raise ValueError("GraphViz source must start with 'graph' or 'digraph'")
+    elif diagram_type == "mermaid":
+        lines = source.splitlines()
+        # フロントマター（--- で囲まれた設定）とコメント・ディレクティブ（%%）を読み飛ばす
+        if lines and lines[0].strip() == "---":
+            end = next((i for i, line in enumerate(lines[1:], 1) if line.strip() == "---"), len(lines))
+            lines = lines[end + 1:]
+        first = next((line.strip() for line in lines if line.strip() and not line.strip().startswith("%%")), "")
+        if not first.startswith(MERMAID_DIAGRAM_KEYWORDS):
+            raise ValueError("Mermaid source must start with a diagram type (e.g. 'graph', 'sequenceDiagram')")
+
+def render_diagram_card(full_model, diagram_type, source, svg_content, error=None):
+    """図のモードの結果カード（描画したSVG + 図のソース）を生成する"""
+    provider, model_name = full_model.split(":", 1)
+    model_id = get_model_id(full_model)
+    if error:
+        preview = f"<div class='error'>{escape_html(error)}</div>"
+    else:
+        preview = svg_content
+    # 描画できなかった場合は原因を確認できるようにソースを表示しておく
+    code_display = "block" if error else "none"
+    return f"""
+            <div class='result-card'>
+                <div class='card-header'>
+                    <div class='header-title'>
+                        <strong>{provider.upper()}</strong> - {model_name}
+                    </div>
+                    <div class='header-buttons'>
+                        <button class="button-icon" onclick="(function(){{
+                            var codeEl = document.getElementById('{model_id}_code');
+                            if (codeEl){{
+                                codeEl.style.display = (codeEl.style.display === 'none' ? 'block' : 'none');
+                            }}
+                        }})()" title="コードを表示/非表示">
+                            <svg viewBox="0 0 24 24">
+                                <path fill="currentColor" d="M9.4 16.6L4.8 12l4.6-4.6L8 6l-6 6 6 6 1.4-1.4zm5.2 0l4.6-4.6-4.6-4.6L16 6l6 6-6 6-1.4-1.4z"/>
+                            </svg>
+                        </button>
+                    </div>
+                </div>
+                <div id='{model_id}_diagram' class='diagram-preview'>
+                    {preview}
+                </div>
+                <div id='{model_id}_code' class='code-content' style='display:{code_display};'>
+                    <pre><code>{escape_html(source)}</code></pre>
                 </div>
             </div>
-            <div class="diagram-preview" style="padding: 16px; overflow: auto;">
-                {svg_content}
-            </div>
-            <div class="code-content">
-                <pre><code>{source_code}</code></pre>
-            </div>
-        </div>
         """
-        return html_content
-    else:
-        return f"<div class='error'>Error: No {diagram_type} code block found in the response.</div>"
+
+async def render_diagram_result(full_model, text, diagram_type):
+    """1モデル分の応答から図を取り出して検証し、Kroki で描画した結果カードを返す"""
+    source = extract_diagram_source(text, diagram_type)
+    if source is None:
+        return render_diagram_card(
+            full_model, diagram_type, text, None, f"No {diagram_type} code block found in the response."
+        )
+    try:
+        validate_diagram_source(source, diagram_type)
+    except ValueError as e:
+        return render_diagram_card(full_model, diagram_type, source, None, str(e))
+    try:
+        svg_content = await kroki_renderer.render(source, diagram_type)
+    except Exception as e:
+        logger.error(f"Error rendering {diagram_type} diagram from {full_model}: {str(e)}")
+        return render_diagram_card(full_model, diagram_type, source, None, f"Error: {str(e)}")
+    return render_diagram_card(full_model, diagram_type, source, svg_content)
+
+async def render_final_card(full_model, code, prompt_type):
+    """
+    生成が完了したモデルの結果カードを生成する
+
+    図のモードでは図を描画したカード、それ以外はプレビュー + コードのカードを返します。
+    """
+    diagram_type = DIAGRAM_TYPES.get(prompt_type)
+    if diagram_type is None:
+        provider, model = full_model.split(":", 1)
+        with span("postprocess", provider=provider, model=model):
+            return render_result_card(full_model, code)
+    return await render_diagram_result(full_model, code, diagram_type)
+
+async def record_generation(query, full_model, prompt_type, system_prompt, code, latency, usage):
+    """
+    provider を呼び出して得た生成結果を履歴に保存する
+
+    キャッシュから応答した場合や、同じ呼び出しの結果を共有した場合は保存しません。
+    """
+    if not usage["completed"]:
+        return
+    try:
+        await executor_registry.run(
+            "history", history_store.record, query, full_model, prompt_type, hash_text(system_prompt), code, latency,
+            usage["input_tokens"], usage["output_tokens"],
+        )
+    except Exception as e:
+        logger.error(f"Error recording generation history for {full_model}: {str(e)}")
+
+def format_history_choice(entry):
+    """履歴の選択肢に表示するラベルを生成する"""
+    created_at = time.strftime("%m/%d %H:%M", time.localtime(entry["created_at"]))
+    query = entry["query"].replace("\n", " ")
+    if len(query) > 40:
+        query = query[:40] + "..."
+    return f"{created_at} {entry['model']} [{entry['prompt_type']}] {query}"
+
+async def search_history(text=""):
+    """履歴を新しい順に検索し、選択肢を更新する"""
+    import gradio as gr
+
+    entries = await executor_registry.run("history", history_store.search, text)
+    choices = [(format_history_choice(entry), entry["id"]) for entry in entries]
+    return gr.update(choices=choices, value=[])
+
+async def replay_history(ids):
+    """選択した履歴の結果を provider を呼び出さずにグリッドに表示する"""
+    entries = await executor_registry.run("history", history_store.get, ids or [])
+    cards = await asyncio.gather(
+        *(render_final_card(entry["model"], entry["code"], entry["prompt_type"]) for entry in entries)
+    )
+    return render_grid(list(cards))
+
+def get_tenant_id(request):
+    """スケジューラのテナントID（ログインユーザー名、なければセッションID）を返す"""
+    if request is None:
+        return "anonymous"
+    username = getattr(request, "username", None)
+    if username:
+        return f"user:{username}"
+    session_hash = getattr(request, "session_hash", None)
+    return f"session:{session_hash}" if session_hash else "anonymous"
+
+def get_session_key(request):
+    """キャンセルの対象を識別するキー（ブラウザのタブ毎のセッションID、なければ None）"""
+    return getattr(request, "session_hash", None) if request is not None else None
+
+def render_cancelled_status():
+    """キャンセルした生成の結果の上に表示するHTMLを生成する"""
+    return "<div class='card-status'>生成をキャンセルしました。</div>"
+
+def render_queue_status(position, waited):
+    """順番待ち中に表示するHTMLを生成する"""
+    return f"""
+    <div class='progress-container'>
+        <div>順番待ち中です（{position} 番目 / 待ち時間 {waited:.0f} 秒）。しばらくお待ちください...</div>
+    </div>
+    """
+
+# circuit breaker の状態の表示
+PROVIDER_STATUS_LABELS = {
+    "closed": "🟢 正常",
+    "half_open": "🟡 復旧確認中",
+    "open": "🔴 一時停止中",
+}
+
+def render_provider_status():
+    """provider 毎の circuit breaker の状態を Markdown で返す"""
+    stats = provider_resilience.stats()
+    items = []
+    for provider, label in PROVIDER_LABELS.items():
+        breaker = stats.get(provider, {"state": "closed"})
+        item = f"**{label}**: {PROVIDER_STATUS_LABELS[breaker['state']]}"
+        if breaker["state"] == "open":
+            item += f"（再試行まで {breaker['retry_in']:.0f} 秒）"
+        items.append(item)
+    return "Provider の状態 ― " + " / ".join(items)
 
 # 統合Gradioインターフェースの定義
 def build_interface():
+    # gradio の import には時間がかかるため、UI を構築する時点で読み込む
+    # （/api/llm のみを使う場合や生成処理を import するだけの場合は読み込まない）
+    import gradio as gr
+
     custom_css = """
     :root {
         --card-bg: #ffffff;
@@ -875,6 +1559,53 @@ def build_interface():
         color: inherit;
     }
 
+    /* Prism によるハイライトの配色（暗い背景用） */
+    .code-content .token.comment,
+    .code-content .token.prolog,
+    .code-content .token.doctype,
+    .code-content .token.cdata {
+        color: #6a9955;
+    }
+
+    .code-content .token.punctuation {
+        color: #808080;
+    }
+
+    .code-content .token.tag,
+    .code-content .token.keyword,
+    .code-content .token.boolean,
+    .code-content .token.important {
+        color: #569cd6;
+    }
+
+    .code-content .token.attr-name,
+    .code-content .token.property,
+    .code-content .token.selector {
+        color: #9cdcfe;
+    }
+
+    .code-content .token.attr-value,
+    .code-content .token.string,
+    .code-content .token.url {
+        color: #ce9178;
+    }
+
+    .code-content .token.number,
+    .code-content .token.entity {
+        color: #b5cea8;
+    }
+
+    .code-content .token.function,
+    .code-content .token.class-name {
+        color: #dcdcaa;
+    }
+
+    .code-content .token.operator,
+    .code-content .token.regex,
+    .code-content .token.variable {
+        color: #d4d4d4;
+    }
+
     /* 図のプレビュー用スタイル */
     .diagram-preview {
         padding: 16px;
@@ -889,6 +1620,18 @@ def build_interface():
         height: auto;
     }
 
+    /* ストリーミング中のカード */
+    .card-status {
+        margin-left: 8px;
+        font-size: 12px;
+        color: var(--neutral-500, #888888);
+    }
+
+    .streaming-content {
+        max-height: 600px;
+        white-space: pre-wrap;
+    }
+
     .error {
         color: red;
         padding: 16px;
@@ -944,6 +1687,21 @@ def build_interface():
                     label="o3-miniによる実装計画を利用しますか？",
                     value="いいえ",
                     info="o3-miniが実装計画を作成し、その計画に基づいて各モデルが実装を行います。"
+                         "（推論モデルは計画を待たずに実装を開始します）"
+                )
+
+                # ストリーミング表示オプション
+                stream_output = gr.Checkbox(
+                    label="ストリーミング表示",
+                    value=True,
+                    info="トークンを受信するたびに各モデルの結果を更新します。"
+                )
+
+                # 応答キャッシュの利用オプション
+                use_cache = gr.Checkbox(
+                    label="キャッシュを使用",
+                    value=True,
+                    info="同じ条件で生成済みの応答があれば再利用します。オフにすると必ずモデルを呼び出します。"
                 )
 
             # 右側のカラム
@@ -999,12 +1757,41 @@ def build_interface():
             elem_classes="implementation-plan"
         )
 
-        # Generate ボタン
-        generate_btn = gr.Button(
-            "Generate",
-            variant="primary",
-            size="lg"
-        )
+        # Generate ボタンとキャンセルボタン
+        with gr.Row():
+            generate_btn = gr.Button(
+                "Generate",
+                variant="primary",
+                size="lg",
+                scale=4
+            )
+            cancel_btn = gr.Button(
+                "キャンセル",
+                variant="stop",
+                size="lg",
+                scale=1
+            )
+
+        # provider の状態（障害中の provider は呼び出さずにエラーとして表示される）
+        provider_status = gr.Markdown(render_provider_status())
+        provider_status_timer = gr.Timer(PROVIDER_STATUS_REFRESH_INTERVAL)
+
+        # 生成履歴（過去の結果を provider を呼び出さずに再表示する）
+        with gr.Accordion("生成履歴", open=False):
+            with gr.Row():
+                history_query = gr.Textbox(
+                    placeholder="リクエストやコードに含まれる語で検索（空欄の場合は新しい順）",
+                    show_label=False,
+                    scale=4
+                )
+                history_search_btn = gr.Button("検索", scale=1)
+            history_select = gr.Dropdown(
+                choices=[],
+                multiselect=True,
+                label="再表示する結果を選択",
+                info="選択した結果を並べて表示します"
+            )
+            replay_btn = gr.Button("再表示")
 
         # 結果セクション
         gr.Markdown("## 結果")
@@ -1053,41 +1840,95 @@ def build_interface():
         )
 
         # ボタンクリック時の処理を更新
-        async def run_generate(q, m, pt, wp, tp, ep, gp, mp, up):
-            try:
-                # 非ブロッキングでのロック取得を試みる（タイムアウトを短く設定）
-                await asyncio.wait_for(generation_lock.acquire(), timeout=0.001)
-            except asyncio.TimeoutError:
-                logger.info("Generation is already in progress. Ignoring duplicate request.")
-                return [plan_output, "<div style='padding: 8px;color:red;'>Process already in progress. Please wait...</div>"]
+        async def generate_updates(q, m, pt, wp, tp, ep, gp, mp, up, so, uc, tenant):
+            # セッション（ログインしている場合はユーザー）単位で実行枠を割り当てる
+            ticket = generation_scheduler.submit(tenant)
+            plan_task = None
+            trace = None
             try:
-                use_plan = (up == "はい")
-                if use_plan:
-                    implementation_plan = await get_implementation_plan(q, pt)
-                    logger.info("Implementation Plan:")
-                    logger.info(implementation_plan)
-                    plan_output.visible = True
-                    plan_output.value = f"## 実装計画 (o3-mini)\n\n{implementation_plan}"
+                # 実行枠が空くまで待ち順を表示しながら待機する
+                while not await ticket.wait(timeout=QUEUE_POLL_INTERVAL):
+                    yield [gr.update(), render_queue_status(ticket.position, ticket.waited)]
+                logger.info(f"Generation slot granted for {tenant} after {ticket.waited:.2f}s")
+
+                # リクエスト内の各処理時間を記録する（完了時にログへ出力）
+                # yield の前後で実行されるタスクが変わることがあるため、生成タスクを作る直前に開始する
+                trace = start_trace("generate")
+                observe_span("scheduler_wait", ticket.waited)
+
+                # 実装計画は1リクエストにつき1回だけ作成し、生成と並行して進める
+                if up == "はい":
+                    plan_task = asyncio.create_task(get_implementation_plan(q, pt, use_cache=uc))
+                    plan_update = gr.update(visible=True, value="## 実装計画 (o3-mini)\n\n作成中...")
                 else:
-                    plan_output.visible = False
-                    implementation_plan = ""
-
-                result = await generate_parallel(
+                    plan_update = gr.update(visible=False)
+                plan_shown = False
+
+                def next_plan_update():
+                    # 計画が完成したら一度だけ表示を更新する
+                    nonlocal plan_update, plan_shown
+                    update = plan_update
+                    if plan_task is not None and plan_task.done() and not plan_shown:
+                        plan_shown = True
+                        implementation_plan = plan_task.result()
+                        logger.info(f"Implementation Plan: {truncate(implementation_plan)}")
+                        update = gr.update(
+                            visible=True,
+                            value=f"## 実装計画 (o3-mini)\n\n{implementation_plan}"
+                        )
+                    plan_update = gr.update()
+                    return update
+
+                if so:
+                    # 受信したトークンを逐次グリッドに反映する
+                    generator = generate_parallel_stream
+                else:
+                    # 完了したモデルから順にグリッドに追加する
+                    generator = iter_generate_parallel
+                result = ""
+                async for grid_html in generator(
                     q, m,
                     get_system_prompt(pt, wp, tp, ep, gp, mp),
                     pt,
-                    use_planning=use_plan
-                )
+                    plan=plan_task,
+                    use_cache=uc
+                ):
+                    result = grid_html
+                    yield [next_plan_update(), grid_html]
+                if plan_task is not None and not plan_shown:
+                    # 全モデルが計画を必要としなかった場合も計画を表示する
+                    await plan_task
+                    yield [next_plan_update(), result]
 
-                # 図の場合はKroki.ioを使ってプレビューを表示
-                if pt in ["Excalidraw", "GraphViz", "Mermaid"]:
-                    diagram_type = pt.lower()
-                    diagram_preview = send_to_diagram_preview(result, diagram_type)
-                    return [plan_output, diagram_preview]
-                
-                return [plan_output, result]
             finally:
-                generation_lock.release()
+                if plan_task is not None:
+                    plan_task.cancel()
+                ticket.release()
+                if trace is not None:
+                    logger.info(f"Trace: {trace.describe()}", extra=trace.summary())
+
+        async def run_generate(q, m, pt, wp, tp, ep, gp, mp, up, so, uc, request: gr.Request = None):
+            # 生成はセッション毎に generation_registry で実行し、キャンセルボタン・タブを閉じた場合・
+            # 同じセッションでの再送信でキャンセルできるようにする
+            result = ""
+            try:
+                async for update in generation_registry.run(
+                    get_session_key(request),
+                    generate_updates(q, m, pt, wp, tp, ep, gp, mp, up, so, uc, get_tenant_id(request))
+                ):
+                    result = update[1]
+                    yield update
+            except GenerationCancelled as e:
+                logger.info(f"Generation cancelled ({e.reason})")
+                yield [gr.update(), render_cancelled_status() + result]
+
+        def cancel_generation(request: gr.Request = None):
+            """キャンセルボタン: このセッションで実行中の生成を止める"""
+            generation_registry.cancel(get_session_key(request), CANCEL_REQUESTED)
+
+        def cancel_on_unload(request: gr.Request = None):
+            """タブを閉じた場合: このセッションで実行中の生成を止める"""
+            generation_registry.cancel(get_session_key(request), CANCEL_DISCONNECTED)
 
 
         generate_btn.click(
@@ -1101,10 +1942,25 @@ def build_interface():
                 system_prompt_excalidraw_textbox,
                 system_prompt_graphviz_textbox,
                 system_prompt_mermaid_textbox,
-                use_planning
+                use_planning,
+                stream_output,
+                use_cache
             ],
-            outputs=[plan_output, output_html]
+            outputs=[plan_output, output_html],
+            # 同時実行数は generation_scheduler で制御するため Gradio 側では制限しない
+            concurrency_limit=None,
+            # 実行中に再度クリックした場合は新しい生成を開始する（前の生成は run_generate でキャンセルされる）
+            trigger_mode="multiple"
         )
+        cancel_btn.click(fn=cancel_generation, concurrency_limit=None)
+        demo.unload(cancel_on_unload)
+
+        # 生成履歴の検索・再表示
+        history_search_btn.click(fn=search_history, inputs=[history_query], outputs=[history_select])
+        history_query.submit(fn=search_history, inputs=[history_query], outputs=[history_select])
+        replay_btn.click(fn=replay_history, inputs=[history_select], outputs=[output_html])
+        demo.load(fn=search_history, outputs=[history_select])
+        provider_status_timer.tick(fn=render_provider_status, outputs=[provider_status])
     return demo
 
 if __name__ == "__main__":
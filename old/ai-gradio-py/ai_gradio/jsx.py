@@ -0,0 +1,404 @@
+import html
+import json
+import os
+import re
+
+from .cache import ResponseCache
+from .config import env_float, env_int
+from .metrics import span
+
+# JSX の変換結果のキャッシュの設定（同じコードからは常に同じ結果が得られるため TTL は長めにする）
+JSX_CACHE_MAX_ENTRIES = env_int("JSX_CACHE_MAX_ENTRIES", 256)
+JSX_CACHE_TTL = env_float("JSX_CACHE_TTL", 7 * 24 * 3600.0)
+# 空の場合はディスクキャッシュを使わない
+JSX_CACHE_DIR = os.environ.get("JSX_CACHE_DIR", "")
+
+# 変換後の要素の生成に使う関数とフラグメント
+JSX_PRAGMA = "React.createElement"
+JSX_FRAGMENT = "React.Fragment"
+
+WORD_PATTERN = re.compile(r"[A-Za-z_$][\w$]*")
+NUMBER_PATTERN = re.compile(r"[0-9][\w.]*")
+# 要素名（a・Foo・Foo.Bar・svg:rect・my-element）と属性名
+ELEMENT_NAME_PATTERN = re.compile(r"[A-Za-z_$][\w$-]*(?:[.:][A-Za-z_$][\w$-]*)*")
+ATTRIBUTE_NAME_PATTERN = re.compile(r"[A-Za-z_$][\w$-]*(?::[A-Za-z_$][\w$-]*)?")
+IDENTIFIER_PATTERN = re.compile(r"[A-Za-z_$][\w$]*")
+COMMENT_PATTERN = re.compile(r"/\*[\s\S]*?\*/|//[^\n]*")
+
+# 直前がこれらの文字・キーワードの場合、"<" は比較演算子ではなく JSX の開始（"/" は正規表現の開始）
+EXPRESSION_CHARS = frozenset("([{,;:=?!&|+-*%~^<>")
+EXPRESSION_KEYWORDS = frozenset((
+    "return", "yield", "await", "default", "case", "do", "else", "in", "of", "typeof", "void", "delete",
+    "throw", "new",
+))
+
+
+class JSXSyntaxError(ValueError):
+    """JSX を変換できない場合の例外"""
+
+
+def clean_jsx_text(raw):
+    """
+    JSX のテキストを React と同じ規則で整形する
+
+    改行を含む空白は取り除き、改行を挟んだ行は空白1つで連結します（文字参照は展開します）。
+    """
+    lines = raw.replace("\r\n", "\n").split("\n")
+    last_non_empty = max((i for i, line in enumerate(lines) if line.strip(" \t")), default=-1)
+    parts = []
+    for i, line in enumerate(lines):
+        line = line.replace("\t", " ")
+        if i > 0:
+            line = line.lstrip(" ")
+        if i < len(lines) - 1:
+            line = line.rstrip(" ")
+        if line:
+            parts.append(line if i == last_non_empty else line + " ")
+    return html.unescape("".join(parts))
+
+
+class _Transformer:
+    """JavaScript のソースを1回走査し、JSX の部分を React.createElement の呼び出しに置き換える"""
+
+    def __init__(self, source):
+        self.src = source
+        self.pos = 0
+
+    def error(self, message):
+        line = self.src.count("\n", 0, self.pos) + 1
+        return JSXSyntaxError(f"{message} (line {line})")
+
+    def expect(self, text):
+        if not self.src.startswith(text, self.pos):
+            raise self.error(f"Expected {text!r}")
+        self.pos += len(text)
+
+    def skip_space(self):
+        while self.pos < len(self.src) and self.src[self.pos] in " \t\r\n":
+            self.pos += 1
+
+    def match(self, pattern):
+        m = pattern.match(self.src, self.pos)
+        if m is None:
+            return None
+        self.pos = m.end()
+        return m.group(0)
+
+    @staticmethod
+    def expects_expression(prev):
+        return not prev or prev in EXPRESSION_CHARS or prev in EXPRESSION_KEYWORDS
+
+    def starts_element(self):
+        nxt = self.src[self.pos + 1:self.pos + 2]
+        return nxt == ">" or (nxt.isascii() and (nxt.isalpha() or nxt in "_$"))
+
+    def code(self, nested=False):
+        """
+        JavaScript のコードを変換する
+
+        nested が True の場合は対応する "{" のない "}" の手前（JSX の式・テンプレートの ${} の終わり）で止まります。
+        """
+        src = self.src
+        parts = []
+        depth = 0
+        prev = ""  # 直前の意味のある文字（識別子・キーワードは単語、値は "x"）
+        while self.pos < len(src):
+            ch = src[self.pos]
+            start = self.pos
+            if ch in " \t\r\n":
+                self.pos += 1
+                parts.append(ch)
+            elif src.startswith("//", start):
+                end = src.find("\n", start)
+                self.pos = len(src) if end < 0 else end
+                parts.append(src[start:self.pos])
+            elif src.startswith("/*", start):
+                end = src.find("*/", start + 2)
+                if end < 0:
+                    raise self.error("Unterminated comment")
+                self.pos = end + 2
+                parts.append(src[start:self.pos])
+            elif ch in "'\"":
+                parts.append(self.string(ch))
+                prev = "x"
+            elif ch == "`":
+                parts.append(self.template())
+                prev = "x"
+            elif ch == "{":
+                depth += 1
+                self.pos += 1
+                parts.append(ch)
+                prev = ch
+            elif ch == "}":
+                if nested and not depth:
+                    break
+                depth -= 1
+                self.pos += 1
+                parts.append(ch)
+                prev = ch
+            elif ch == "<" and self.expects_expression(prev) and self.starts_element():
+                parts.append(self.element())
+                prev = "x"
+            elif ch == "/" and self.expects_expression(prev):
+                parts.append(self.regex())
+                prev = "x"
+            elif ch.isascii() and (ch.isalpha() or ch in "_$"):
+                prev = self.match(WORD_PATTERN)
+                parts.append(prev)
+            elif ch.isdigit():
+                parts.append(self.match(NUMBER_PATTERN))
+                prev = "x"
+            elif ch in "+-" and src.startswith(ch * 2, start):
+                # i++ < n のような後置のインクリメントの後は値とみなす
+                self.pos += 2
+                parts.append(ch * 2)
+                prev = "x"
+            elif ch == "<":
+                # 比較・シフト演算子（<, <=, <<, <<=）はまとめて読み進める
+                while self.pos < len(src) and src[self.pos] in "<=":
+                    self.pos += 1
+                parts.append(src[start:self.pos])
+                prev = "<"
+            else:
+                self.pos += 1
+                parts.append(ch)
+                prev = ch
+        return "".join(parts)
+
+    def string(self, quote):
+        src = self.src
+        i = self.pos + 1
+        while i < len(src):
+            if src[i] == "\\":
+                i += 2
+            elif src[i] == quote:
+                break
+            elif src[i] == "\n":
+                raise self.error("Unterminated string")
+            else:
+                i += 1
+        else:
+            raise self.error("Unterminated string")
+        start, self.pos = self.pos, i + 1
+        return src[start:self.pos]
+
+    def template(self):
+        src = self.src
+        parts = ["`"]
+        self.pos += 1
+        start = self.pos
+        while self.pos < len(src):
+            ch = src[self.pos]
+            if ch == "\\":
+                self.pos += 2
+            elif ch == "`":
+                self.pos += 1
+                parts.append(src[start:self.pos])
+                return "".join(parts)
+            elif src.startswith("${", self.pos):
+                self.pos += 2
+                parts.append(src[start:self.pos])
+                parts.append(self.code(nested=True))
+                self.expect("}")
+                parts.append("}")
+                start = self.pos
+            else:
+                self.pos += 1
+        raise self.error("Unterminated template literal")
+
+    def regex(self):
+        src = self.src
+        i = self.pos + 1
+        in_class = False
+        while i < len(src):
+            ch = src[i]
+            if ch == "\\":
+                i += 2
+                continue
+            if ch == "\n":
+                break
+            if ch == "[":
+                in_class = True
+            elif ch == "]":
+                in_class = False
+            elif ch == "/" and not in_class:
+                start, self.pos = self.pos, i + 1
+                return src[start:self.pos]
+            i += 1
+        raise self.error("Unterminated regular expression")
+
+    def expression(self):
+        """"{" の直後から対応する "}" までの式を変換する（"}" は読み進める）"""
+        code = self.code(nested=True)
+        self.expect("}")
+        return code
+
+    def element(self):
+        self.expect("<")
+        self.skip_space()
+        if self.src.startswith(">", self.pos):
+            self.pos += 1
+            return self.create(JSX_FRAGMENT, [], self.children(""))
+        name = self.match(ELEMENT_NAME_PATTERN)
+        if name is None:
+            raise self.error("Expected element name")
+        attributes = self.attributes()
+        if self.src.startswith("/>", self.pos):
+            self.pos += 2
+            children = []
+        else:
+            self.expect(">")
+            children = self.children(name)
+        return self.create(self.element_type(name), attributes, children)
+
+    @staticmethod
+    def element_type(name):
+        # 小文字で始まる名前・名前空間付きの名前は HTML/SVG の要素（文字列）、それ以外はコンポーネント
+        if "." in name:
+            return name
+        if name[0].islower() or "-" in name or ":" in name:
+            return json.dumps(name)
+        return name
+
+    def attributes(self):
+        attributes = []
+        while True:
+            self.skip_space()
+            if self.pos >= len(self.src):
+                raise self.error("Unterminated element")
+            if self.src[self.pos] in "/>":
+                return attributes
+            if self.src.startswith("{", self.pos):
+                self.pos += 1
+                self.skip_space()
+                self.expect("...")
+                attributes.append("..." + self.expression().strip())
+                continue
+            name = self.match(ATTRIBUTE_NAME_PATTERN)
+            if name is None:
+                raise self.error("Expected attribute name")
+            key = name if IDENTIFIER_PATTERN.fullmatch(name) else json.dumps(name)
+            self.skip_space()
+            if not self.src.startswith("=", self.pos):
+                attributes.append(f"{key}: true")
+                continue
+            self.pos += 1
+            self.skip_space()
+            ch = self.src[self.pos:self.pos + 1]
+            if ch in ("'", '"'):
+                # 属性の文字列はエスケープを持たず、文字参照を展開する
+                end = self.src.find(ch, self.pos + 1)
+                if end < 0:
+                    raise self.error("Unterminated attribute value")
+                value = json.dumps(html.unescape(self.src[self.pos + 1:end]), ensure_ascii=False)
+                self.pos = end + 1
+            elif ch == "{":
+                self.pos += 1
+                value = self.expression().strip()
+                if not value:
+                    raise self.error(f"Empty expression for attribute {name}")
+            elif ch == "<":
+                value = self.element()
+            else:
+                raise self.error(f"Expected value for attribute {name}")
+            attributes.append(f"{key}: {value}")
+
+    def children(self, name):
+        src = self.src
+        children = []
+        while self.pos < len(src):
+            if src.startswith("</", self.pos):
+                self.pos += 2
+                self.skip_space()
+                closing = self.match(ELEMENT_NAME_PATTERN) or ""
+                self.skip_space()
+                self.expect(">")
+                if closing != name:
+                    raise self.error(f"Expected closing tag for <{name}> but found </{closing}>")
+                return children
+            ch = src[self.pos]
+            if ch == "{":
+                self.pos += 1
+                code = self.expression()
+                # {/* コメント */} のような空の式は子要素にしない
+                if COMMENT_PATTERN.sub("", code).strip():
+                    children.append(code.strip())
+            elif ch == "<":
+                children.append(self.element())
+            else:
+                end = len(src)
+                for stop in ("<", "{"):
+                    index = src.find(stop, self.pos)
+                    if 0 <= index < end:
+                        end = index
+                text = clean_jsx_text(src[self.pos:end])
+                self.pos = end
+                if text:
+                    children.append(json.dumps(text, ensure_ascii=False))
+        raise self.error(f"Unterminated element <{name}>")
+
+    @staticmethod
+    def create(element_type, attributes, children):
+        props = "{" + ", ".join(attributes) + "}" if attributes else "null"
+        return f"{JSX_PRAGMA}({element_type}, {props}" + "".join(f", {child}" for child in children) + ")"
+
+
+def compile_jsx(source):
+    """
+    JSX を含む JavaScript を、JSX を React.createElement の呼び出しに置き換えたコードに変換する
+
+    JSX 以外の構文（ES2015 以降の構文を含む）はそのまま出力するため、ブラウザがそのまま実行できる
+    コードを前提とします。
+
+    Raises:
+        JSXSyntaxError: JSX を解析できない場合
+    """
+    transformer = _Transformer(source)
+    output = transformer.code()
+    if transformer.pos < len(source):
+        raise transformer.error("Unexpected '}'")
+    return output
+
+
+class JSXCompiler:
+    """
+    React のプレビュー用に JSX をサーバー側で変換するコンパイラ
+
+    変換結果はソースのハッシュをキーにキャッシュするため、同じコードのプレビューを再生成しても
+    変換は1回だけです（ブラウザで Babel を読み込んで変換する必要もありません）。
+    """
+
+    def __init__(self, cache=None):
+        self.cache = cache or ResponseCache(
+            max_entries=JSX_CACHE_MAX_ENTRIES, ttl=JSX_CACHE_TTL, disk_dir=JSX_CACHE_DIR, enabled=True
+        )
+        self.compiled = 0
+        self.errors = 0
+
+    def compile(self, source):
+        """
+        source を変換したコードを返す（キャッシュにある場合は変換しない）
+
+        Raises:
+            JSXSyntaxError: JSX を解析できない場合
+        """
+        key = self.cache.make_key("jsx", JSX_PRAGMA, source)
+        output = self.cache.get(key)
+        if output is not None:
+            return output
+        try:
+            with span("jsx_compile"):
+                output = compile_jsx(source)
+        except JSXSyntaxError:
+            self.errors += 1
+            raise
+        self.compiled += 1
+        self.cache.set(key, output)
+        return output
+
+    def stats(self):
+        return {"compiled": self.compiled, "errors": self.errors, "cache": self.cache.stats()}
+
+
+# アプリ全体で共有する JSX のコンパイラ
+jsx_compiler = JSXCompiler()
@@ -0,0 +1,138 @@
+import asyncio
+import os
+
+import httpx
+
+from .cache import ResponseCache
+from .clients import HTTP_CONNECT_TIMEOUT, http_limits
+from .config import env_float, env_int
+from .metrics import span
+from .singleflight import SingleFlight
+
+# Kroki のエンドポイント（セルフホストの Kroki コンテナなどに向ける場合に変更する）
+KROKI_URL = os.environ.get("KROKI_URL", "https://kroki.io")
+# 1回の描画リクエストのタイムアウト（秒）
+KROKI_TIMEOUT = env_float("KROKI_TIMEOUT", 20.0)
+# 接続エラー・429・5xx の場合のリトライ回数と、初回リトライまでの待ち時間（秒、以降は倍々）
+KROKI_MAX_RETRIES = env_int("KROKI_MAX_RETRIES", 2)
+KROKI_RETRY_BACKOFF = env_float("KROKI_RETRY_BACKOFF", 0.5)
+# 同時に描画する図の数
+KROKI_CONCURRENCY = env_int("KROKI_CONCURRENCY", 4)
+# SVGキャッシュの設定（同じソースからは常に同じSVGが得られるため TTL は長めにする）
+KROKI_CACHE_MAX_ENTRIES = env_int("KROKI_CACHE_MAX_ENTRIES", 256)
+KROKI_CACHE_TTL = env_float("KROKI_CACHE_TTL", 7 * 24 * 3600.0)
+# 空の場合はディスクキャッシュを使わない
+KROKI_CACHE_DIR = os.environ.get("KROKI_CACHE_DIR", "")
+
+# リトライする HTTP ステータス
+RETRY_STATUS_CODES = (429, 500, 502, 503, 504)
+
+
+class KrokiError(Exception):
+    """図の描画に失敗した場合の例外"""
+
+    def __init__(self, message, status_code=None):
+        super().__init__(message)
+        self.status_code = status_code
+
+
+class KrokiRenderer:
+    """
+    Kroki で図のソースをSVGに描画するレンダラー
+
+    HTTPクライアントはコネクションプールを共有する長寿命のものを使い、描画結果は
+    (図のタイプ, ソース) のハッシュをキーにキャッシュします。同じ図の描画が実行中の場合は
+    その結果を共有し、同時に描画する図の数は concurrency で制限します。
+    """
+
+    def __init__(self, base_url=KROKI_URL, timeout=KROKI_TIMEOUT, max_retries=KROKI_MAX_RETRIES,
+                 retry_backoff=KROKI_RETRY_BACKOFF, concurrency=KROKI_CONCURRENCY, cache=None):
+        self.base_url = base_url.rstrip("/")
+        self.timeout = timeout
+        self.max_retries = max(0, max_retries)
+        self.retry_backoff = retry_backoff
+        self.concurrency = max(1, concurrency)
+        self.cache = cache or ResponseCache(
+            max_entries=KROKI_CACHE_MAX_ENTRIES, ttl=KROKI_CACHE_TTL, disk_dir=KROKI_CACHE_DIR
+        )
+        self._client = None
+        self._semaphore = None
+        self._single_flight = SingleFlight()
+
+    @property
+    def client(self):
+        # イベントループ上で最初に使われた時点で生成する
+        if self._client is None:
+            self._client = httpx.AsyncClient(
+                limits=http_limits(),
+                timeout=httpx.Timeout(self.timeout, connect=HTTP_CONNECT_TIMEOUT),
+            )
+        return self._client
+
+    @property
+    def semaphore(self):
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.concurrency)
+        return self._semaphore
+
+    def make_key(self, source, diagram_type):
+        return self.cache.make_key("kroki", diagram_type, source)
+
+    async def _post(self, source, diagram_type):
+        url = f"{self.base_url}/{diagram_type}/svg"
+        for attempt in range(self.max_retries + 1):
+            last_attempt = attempt == self.max_retries
+            try:
+                response = await self.client.post(
+                    url, content=source.encode("utf-8"), headers={"Content-Type": "text/plain"}
+                )
+            except httpx.HTTPError as e:
+                if last_attempt:
+                    raise KrokiError(f"Kroki request failed: {e}") from e
+            else:
+                if response.status_code == 200:
+                    return response.text
+                if last_attempt or response.status_code not in RETRY_STATUS_CODES:
+                    raise KrokiError(f"{response.status_code} - {response.text}", response.status_code)
+            await asyncio.sleep(self.retry_backoff * (2 ** attempt))
+
+    async def render(self, source, diagram_type):
+        """
+        図のソースをSVGに描画する
+
+        Args:
+            source (str): 図のソースコード
+            diagram_type (str): 図のタイプ (excalidraw, graphviz, mermaid)
+
+        Returns:
+            str: SVG形式の図（失敗した場合は KrokiError を送出）
+        """
+        key = self.make_key(source, diagram_type)
+        cached = await self.cache.aget(key)
+        if cached is not None:
+            return cached
+
+        async def call():
+            async with self.semaphore:
+                with span("kroki_render", provider="kroki", model=diagram_type):
+                    svg = await self._post(source, diagram_type)
+            await self.cache.aset(key, svg)
+            return svg
+
+        return await self._single_flight.do(key, call)
+
+    def stats(self):
+        return {
+            "base_url": self.base_url,
+            "cache": self.cache.stats(),
+            "single_flight": self._single_flight.stats(),
+        }
+
+    async def aclose(self):
+        if self._client is not None:
+            client, self._client = self._client, None
+            await client.aclose()
+
+
+# アプリ全体で共有するレンダラー
+kroki_renderer = KrokiRenderer()
@@ -1,22 +1,114 @@
+import atexit
+import json
 import logging
 import os
+import queue
+import random
 from datetime import datetime
-from logging.handlers import RotatingFileHandler
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
+
+from .config import env_float, env_int
+
+LOGGER_NAME = 'ai_code_generator'
+# ログの出力先・レベル・形式（text または json）
+LOG_DIR = os.environ.get("LOG_DIR", "logs")
+LOG_LEVEL = os.environ.get("LOG_LEVEL", "INFO").upper()
+LOG_FORMAT = os.environ.get("LOG_FORMAT", "text").lower()
+# 1行あたりのメッセージの最大文字数（超えた部分は切り詰める。0 で無制限）
+LOG_MAX_MESSAGE_LENGTH = env_int("LOG_MAX_MESSAGE_LENGTH", 2000)
+# INFO 以下のログを出力する割合（0.0〜1.0）。WARNING 以上は常に出力する
+LOG_SAMPLE_RATE = env_float("LOG_SAMPLE_RATE", 1.0)
+# ログの待ち行列の上限。溢れた場合は呼び出し側をブロックせずにそのログを捨てる
+LOG_QUEUE_SIZE = env_int("LOG_QUEUE_SIZE", 10000)
+
+# LogRecord の標準の属性（JSON 出力で extra として扱わないもの）
+_RECORD_ATTRIBUTES = set(vars(logging.LogRecord("", 0, "", 0, "", None, None))) | {"message", "asctime"}
+
+_listener = None
+
+
+def truncate(text, max_length=None):
+    """長い文字列を max_length 文字に切り詰める（切り詰めた文字数を末尾に付ける）"""
+    max_length = LOG_MAX_MESSAGE_LENGTH if max_length is None else max_length
+    text = str(text)
+    if max_length <= 0 or len(text) <= max_length:
+        return text
+    return f"{text[:max_length]}... [truncated {len(text) - max_length} chars]"
+
+
+class PayloadFilter(logging.Filter):
+    """INFO 以下のログの間引きと、長いメッセージの切り詰めを行うフィルタ"""
+
+    def __init__(self, max_length=LOG_MAX_MESSAGE_LENGTH, sample_rate=LOG_SAMPLE_RATE):
+        super().__init__()
+        self.max_length = max_length
+        self.sample_rate = sample_rate
+
+    def filter(self, record):
+        if record.levelno < logging.WARNING and self.sample_rate < 1.0 and random.random() >= self.sample_rate:
+            return False
+        message = record.getMessage()
+        if self.max_length > 0 and len(message) > self.max_length:
+            record.msg = truncate(message, self.max_length)
+            record.args = None
+        return True
+
+
+class JsonFormatter(logging.Formatter):
+    """ログを1行の JSON として出力するフォーマッタ（extra で渡した項目も含める）"""
+
+    def format(self, record):
+        entry = {
+            "time": datetime.fromtimestamp(record.created).isoformat(timespec="milliseconds"),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        for key, value in vars(record).items():
+            if key not in _RECORD_ATTRIBUTES and not key.startswith("_"):
+                entry[key] = value
+        if record.exc_info:
+            entry["exc_info"] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+class NonBlockingQueueHandler(QueueHandler):
+    """待ち行列が一杯の場合にログを捨てて、呼び出し側をブロックしない QueueHandler"""
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            pass
+
+
+def _build_formatter():
+    if LOG_FORMAT == "json":
+        return JsonFormatter()
+    return logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+
 
 def setup_logging():
-    """ロギングの設定を行う"""
+    """
+    ロギングの設定を行う
+
+    ログは待ち行列（QueueHandler）に積むだけで、ファイルやコンソールへの書き込みは
+    QueueListener のスレッドで行います。複数のモジュールから呼ばれても設定は一度だけ行います。
+    """
+    global _listener
+    logger = logging.getLogger(LOGGER_NAME)
+    if _listener is not None:
+        return logger
+
     # ログディレクトリの作成
-    log_dir = "logs"
-    if not os.path.exists(log_dir):
-        os.makedirs(log_dir)
-    
+    os.makedirs(LOG_DIR, exist_ok=True)
+
     # ログファイル名の設定（日付を含む）
-    log_file = os.path.join(log_dir, f"ai_code_generator_{datetime.now().strftime('%Y%m%d')}.log")
-    
-    # ロガーの設定
-    logger = logging.getLogger('ai_code_generator')
-    logger.setLevel(logging.INFO)
-    
+    log_file = os.path.join(LOG_DIR, f"ai_code_generator_{datetime.now().strftime('%Y%m%d')}.log")
+
+    logger.setLevel(LOG_LEVEL)
+    logger.propagate = False
+
     # ファイルハンドラーの設定（ローテーション付き）
     file_handler = RotatingFileHandler(
         log_file,
@@ -24,21 +116,33 @@ def setup_logging():
         backupCount=5,
         encoding='utf-8'
     )
-    file_handler.setLevel(logging.INFO)
-    
     # コンソールハンドラーの設定
     console_handler = logging.StreamHandler()
-    console_handler.setLevel(logging.INFO)
-    
-    # フォーマッターの設定
-    formatter = logging.Formatter(
-        '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
-    )
+
+    formatter = _build_formatter()
     file_handler.setFormatter(formatter)
     console_handler.setFormatter(formatter)
-    
-    # ハンドラーの追加
-    logger.addHandler(file_handler)
-    logger.addHandler(console_handler)
-    
-    return logger 
\ No newline at end of file
+
+    # 呼び出し側では待ち行列に積むだけにする（間引き・切り詰めは積む前に行う）
+    log_queue = queue.Queue(maxsize=max(0, LOG_QUEUE_SIZE))
+    queue_handler = NonBlockingQueueHandler(log_queue)
+    queue_handler.addFilter(PayloadFilter())
+    logger.handlers.clear()
+    logger.addHandler(queue_handler)
+
+    _listener = QueueListener(log_queue, file_handler, console_handler, respect_handler_level=True)
+    _listener.start()
+    # 終了時に待ち行列に残っているログを書き出す
+    atexit.register(shutdown_logging)
+
+    return logger
+
+
+def shutdown_logging():
+    """QueueListener を停止し、残っているログを書き出す"""
+    global _listener
+    if _listener is not None:
+        listener, _listener = _listener, None
+        listener.stop()
+        for handler in listener.handlers:
+            handler.close()
@@ -0,0 +1,265 @@
+import contextvars
+import math
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+
+# 処理時間のヒストグラムのバケット（秒）。Kroki の描画から推論モデルの応答までを想定
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0)
+
+
+def _format_labels(labelnames, values):
+    if not labelnames:
+        return ""
+    pairs = []
+    for name, value in zip(labelnames, values):
+        value = str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+        pairs.append(f'{name}="{value}"')
+    return "{" + ",".join(pairs) + "}"
+
+
+def _format_value(value):
+    if value == math.inf:
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class _Metric:
+    type_name = ""
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+
+    def _key(self, labels):
+        return tuple(str(labels.get(name, "")) for name in self.labelnames)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.type_name}"]
+        lines += self._samples()
+        return lines
+
+
+class Counter(_Metric):
+    """単調増加するカウンタ"""
+
+    type_name = "counter"
+
+    def __init__(self, name, documentation, labelnames=()):
+        super().__init__(name, documentation, labelnames)
+        self._values = {}
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def _samples(self):
+        with self._lock:
+            items = list(self._values.items())
+        return [f"{self.name}{_format_labels(self.labelnames, key)} {_format_value(value)}" for key, value in items]
+
+
+class Gauge(_Metric):
+    """現在値を表すゲージ"""
+
+    type_name = "gauge"
+
+    def __init__(self, name, documentation, labelnames=()):
+        super().__init__(name, documentation, labelnames)
+        self._values = {}
+
+    def set(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+    def _samples(self):
+        with self._lock:
+            items = list(self._values.items())
+        return [f"{self.name}{_format_labels(self.labelnames, key)} {_format_value(value)}" for key, value in items]
+
+
+class Histogram(_Metric):
+    """値の分布を表すヒストグラム（バケット毎の累積数・合計・件数）"""
+
+    type_name = "histogram"
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets)) + (math.inf,)
+        self._values = {}  # key -> [バケット毎の件数..., 合計, 件数]
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                state = self._values[key] = [0] * len(self.buckets) + [0.0, 0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    state[i] += 1
+                    break
+            state[-2] += value
+            state[-1] += 1
+
+    def _samples(self):
+        with self._lock:
+            items = [(key, list(state)) for key, state in self._values.items()]
+        lines = []
+        labelnames = self.labelnames + ("le",)
+        for key, state in items:
+            cumulative = 0
+            for bound, count in zip(self.buckets, state):
+                cumulative += count
+                lines.append(
+                    f"{self.name}_bucket{_format_labels(labelnames, key + (_format_value(bound),))} {cumulative}"
+                )
+            lines.append(f"{self.name}_sum{_format_labels(self.labelnames, key)} {_format_value(state[-2])}")
+            lines.append(f"{self.name}_count{_format_labels(self.labelnames, key)} {state[-1]}")
+        return lines
+
+
+class MetricsRegistry:
+    """
+    メトリクスを保持し、Prometheus のテキスト形式で出力するレジストリ
+
+    collector には出力の直前に呼ばれる関数を登録できます（スケジューラやキャッシュの
+    統計をゲージに反映する場合など）。
+    """
+
+    def __init__(self):
+        self._metrics = []
+        self._collectors = []
+
+    def counter(self, name, documentation, labelnames=()):
+        return self._register(Counter(name, documentation, labelnames))
+
+    def gauge(self, name, documentation, labelnames=()):
+        return self._register(Gauge(name, documentation, labelnames))
+
+    def histogram(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        return self._register(Histogram(name, documentation, labelnames, buckets))
+
+    def _register(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def register_collector(self, collector):
+        self._collectors.append(collector)
+        return collector
+
+    def render(self):
+        for collector in self._collectors:
+            collector()
+        lines = []
+        for metric in self._metrics:
+            lines += metric.render()
+        return "\n".join(lines) + "\n"
+
+
+# アプリ全体で共有するレジストリと主要なメトリクス
+metrics_registry = MetricsRegistry()
+
+span_seconds = metrics_registry.histogram(
+    "ai_gradio_span_seconds",
+    "Duration of request phases (planning, queue waits, provider calls, rendering) in seconds.",
+    ("span", "provider", "model", "status"),
+)
+time_to_first_token_seconds = metrics_registry.histogram(
+    "ai_gradio_time_to_first_token_seconds",
+    "Time from sending a streaming provider request to receiving the first token in seconds.",
+    ("provider", "model"),
+)
+tokens_total = metrics_registry.counter(
+    "ai_gradio_tokens_total",
+    "Tokens reported by providers (cached_input / cache_write: input tokens read from / written to prompt caches).",
+    ("provider", "model", "kind"),
+)
+
+# 実行中のリクエストのトレース（start_trace() で開始する）
+current_trace = contextvars.ContextVar("current_trace", default=None)
+
+
+class Trace:
+    """1リクエスト分の span の記録"""
+
+    def __init__(self, name):
+        self.name = name
+        self.trace_id = uuid.uuid4().hex[:16]
+        self.started = time.perf_counter()
+        self.spans = []
+
+    def add(self, name, duration, labels):
+        self.spans.append({"span": name, "seconds": round(duration, 4), **labels})
+
+    def describe(self):
+        """ログのメッセージ用の1行の要約"""
+        spans = ", ".join(
+            f"{span['span']}{'/' + span['model'] if span.get('model') else ''}={span['seconds']}s"
+            for span in self.spans
+        )
+        return f"{self.name} {self.trace_id} total={time.perf_counter() - self.started:.3f}s [{spans}]"
+
+    def summary(self):
+        """ログ出力用の要約（extra にそのまま渡せる辞書）"""
+        return {
+            "trace_id": self.trace_id,
+            "trace": self.name,
+            "total_seconds": round(time.perf_counter() - self.started, 4),
+            "spans": self.spans,
+        }
+
+
+def start_trace(name):
+    """現在のタスク（と、そこから生成されるタスク）でトレースを開始する"""
+    trace = Trace(name)
+    current_trace.set(trace)
+    return trace
+
+
+def observe_span(name, duration, status="ok", **labels):
+    """計測済みの処理時間を span として記録する"""
+    span_seconds.observe(duration, span=name, status=status, **labels)
+    trace = current_trace.get()
+    if trace is not None:
+        trace.add(name, duration, dict(labels, status=status) if status != "ok" else labels)
+
+
+@contextmanager
+def span(name, **labels):
+    """
+    with ブロックの処理時間を span として記録する
+
+    labels には provider と model を指定できます（ラベルの組み合わせが増えすぎないよう、
+    リクエスト毎に変わる値は渡さないでください）。例外で抜けた場合は status="error" になります。
+    """
+    started = time.perf_counter()
+    status = "ok"
+    try:
+        yield
+    except BaseException:
+        status = "error"
+        raise
+    finally:
+        observe_span(name, time.perf_counter() - started, status, **labels)
+
+
+def record_tokens(provider, model, input_tokens=0, output_tokens=0, cached_input_tokens=0, cache_write_tokens=0):
+    """
+    トークン数を記録する
+
+    cached_input・cache_write は input のうち provider のプロンプトキャッシュから読み込んだ数と
+    キャッシュに書き込んだ数です。
+    """
+    if input_tokens:
+        tokens_total.inc(input_tokens, provider=provider, model=model, kind="input")
+    if output_tokens:
+        tokens_total.inc(output_tokens, provider=provider, model=model, kind="output")
+    if cached_input_tokens:
+        tokens_total.inc(cached_input_tokens, provider=provider, model=model, kind="cached_input")
+    if cache_write_tokens:
+        tokens_total.inc(cache_write_tokens, provider=provider, model=model, kind="cache_write")
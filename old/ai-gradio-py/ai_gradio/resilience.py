@@ -0,0 +1,367 @@
+import asyncio
+import random
+import sys
+import time
+from email.utils import parsedate_to_datetime
+
+import httpx
+
+from .config import env_float, env_int, env_provider_map
+from .metrics import metrics_registry, observe_span
+from .scheduler import Overloaded
+from .shared_state import shared_state
+
+# provider（または "provider:model"）毎の1分あたりのリクエスト数・トークン数の上限
+# （例: "openai=500,anthropic:claude-3-5-sonnet-20241022=50"）。未設定・0 の場合は制限しない
+PROVIDER_RPM_LIMITS = env_provider_map("PROVIDER_RPM_LIMITS")
+PROVIDER_TPM_LIMITS = env_provider_map("PROVIDER_TPM_LIMITS")
+DEFAULT_RPM_LIMIT = env_int("DEFAULT_RPM_LIMIT", 0)
+DEFAULT_TPM_LIMIT = env_int("DEFAULT_TPM_LIMIT", 0)
+# 1回の呼び出しで試行する回数（初回を含む）と、リトライ間隔の基準値・上限（秒）
+# Retry-After がリトライ間隔の上限を超える場合はリトライせずに失敗とする
+RETRY_MAX_ATTEMPTS = env_int("RETRY_MAX_ATTEMPTS", 3)
+RETRY_BASE_DELAY = env_float("RETRY_BASE_DELAY", 1.0)
+RETRY_MAX_DELAY = env_float("RETRY_MAX_DELAY", 30.0)
+# 連続してこの回数だけ障害（5xx・接続エラー）が続いた provider は、BREAKER_RESET_TIMEOUT 秒の間
+# 呼び出さずに即座に失敗させる（その後1件だけ試行し、成功すれば復帰する）
+BREAKER_FAILURE_THRESHOLD = env_int("BREAKER_FAILURE_THRESHOLD", 5)
+BREAKER_RESET_TIMEOUT = env_float("BREAKER_RESET_TIMEOUT", 30.0)
+
+# リトライする HTTP ステータス（529 は Anthropic の過負荷）
+RETRY_STATUS_CODES = (408, 409, 429, 500, 502, 503, 504, 529)
+# 接続できなかった・タイムアウトした場合の例外（SDK の例外は is_connection_error で判定する）
+CONNECTION_ERRORS = (httpx.TransportError, asyncio.TimeoutError)
+# APIConnectionError で接続エラーを表す SDK
+CONNECTION_ERROR_SDKS = ("openai", "anthropic")
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+BREAKER_STATE_VALUES = {CLOSED: 0, HALF_OPEN: 1, OPEN: 2}
+
+provider_retries_total = metrics_registry.counter(
+    "ai_gradio_provider_retries_total",
+    "Provider calls retried after a transient error.",
+    ("provider", "model", "reason"),
+)
+circuit_breaker_state = metrics_registry.gauge(
+    "ai_gradio_circuit_breaker_state",
+    "Circuit breaker state per provider (0=closed, 1=half_open, 2=open).",
+    ("provider",),
+)
+circuit_breaker_rejections_total = metrics_registry.counter(
+    "ai_gradio_circuit_breaker_rejections_total",
+    "Provider calls rejected without being sent because the circuit breaker was open.",
+    ("provider",),
+)
+
+
+class CircuitOpenError(Overloaded):
+    """circuit breaker が開いているため provider を呼び出さなかった場合の例外"""
+
+    def __init__(self, provider, retry_after):
+        super().__init__(
+            f"{provider} is temporarily unavailable (circuit open, retry in {retry_after}s)", 503, retry_after
+        )
+        self.provider = provider
+
+
+def get_status_code(e):
+    """例外の HTTP ステータス（SDK の APIStatusError・GeminiAPIError など）。なければ None"""
+    status_code = getattr(e, "status_code", None)
+    return status_code if isinstance(status_code, int) else None
+
+
+def get_retry_after(e):
+    """
+    例外のレスポンスヘッダーから Retry-After（秒）を取り出す
+
+    retry-after-ms・retry-after（秒数または HTTP 日付）に対応し、ない場合は None を返します。
+    """
+    headers = getattr(e, "headers", None)
+    if headers is None:
+        headers = getattr(getattr(e, "response", None), "headers", None)
+    if not headers:
+        return None
+    headers = {str(k).lower(): v for k, v in headers.items()}
+    try:
+        if "retry-after-ms" in headers:
+            return float(headers["retry-after-ms"]) / 1000
+        value = headers.get("retry-after")
+        if value is None:
+            return None
+        try:
+            return max(0.0, float(value))
+        except ValueError:
+            return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+def is_connection_error(e):
+    """接続できなかった・タイムアウトした場合の例外であれば True"""
+    if isinstance(e, CONNECTION_ERRORS):
+        return True
+    # SDK は使う時点で読み込むため、読み込まれていない SDK の例外は発生しない
+    for name in CONNECTION_ERROR_SDKS:
+        module = sys.modules.get(name)
+        if module is not None and isinstance(e, module.APIConnectionError):
+            return True
+    return False
+
+
+def is_retryable(e):
+    """一時的なエラー（429・5xx・接続エラー）であれば True"""
+    status_code = get_status_code(e)
+    if status_code is not None:
+        return status_code in RETRY_STATUS_CODES
+    return is_connection_error(e)
+
+
+def is_outage(e):
+    """provider の障害とみなすエラー（5xx・接続エラー）であれば True（429 などは含めない）"""
+    status_code = get_status_code(e)
+    if status_code is not None:
+        return status_code >= 500
+    return is_connection_error(e)
+
+
+def backoff_delay(attempt, retry_after=None, base_delay=RETRY_BASE_DELAY, max_delay=RETRY_MAX_DELAY):
+    """
+    attempt 回目（0始まり）の失敗後に待つ秒数
+
+    指数バックオフの上限までの一様乱数（full jitter）とし、Retry-After がある場合は
+    それより短くしません。
+    """
+    delay = random.uniform(0, min(max_delay, base_delay * (2 ** attempt)))
+    if retry_after is not None:
+        delay = max(delay, retry_after)
+    return delay
+
+
+class RateLimiter:
+    """
+    provider・モデル毎に RPM（リクエスト数）と TPM（トークン数）のトークンバケットを持つレート制限
+
+    上限は "provider:model"、"provider"、デフォルトの順に探します。TPM には呼び出し前の
+    見積もり（入力トークン数 + 出力トークン数の上限）を使います（provider 側のレート制限と
+    同じ考え方で、出力の上限分を先に確保します）。トークンバケットは共有状態のバックエンドに
+    保持するため、状態サーバーを使う場合はワーカー・ノード全体で上限を共有します。
+    """
+
+    def __init__(self, rpm_limits=None, tpm_limits=None, default_rpm=DEFAULT_RPM_LIMIT,
+                 default_tpm=DEFAULT_TPM_LIMIT, backend=None):
+        self.rpm_limits = dict(rpm_limits or {})
+        self.tpm_limits = dict(tpm_limits or {})
+        self.default_rpm = default_rpm
+        self.default_tpm = default_tpm
+        self.backend = backend or shared_state
+
+    @staticmethod
+    def _lookup(limits, default, provider, model):
+        for key in (f"{provider}:{model}", provider):
+            if key in limits:
+                return key, limits[key]
+        return provider, default
+
+    async def _reserve(self, kind, limits, default, provider, model, amount):
+        key, limit = self._lookup(limits, default, provider, model)
+        if limit <= 0 or not amount:
+            return 0.0
+        return await self.backend.reserve(f"{kind}:{key}", amount, limit)
+
+    async def acquire(self, provider, model, tokens=0):
+        """リクエスト1件と tokens トークンを消費できるまで待ち、待った秒数を返す"""
+        started = time.monotonic()
+        # リクエスト数とトークン数の両方を予約し、長い方の時間だけ待つ
+        delay = max(
+            await self._reserve("rpm", self.rpm_limits, self.default_rpm, provider, model, 1),
+            await self._reserve("tpm", self.tpm_limits, self.default_tpm, provider, model, tokens),
+        )
+        if delay > 0:
+            await asyncio.sleep(delay)
+        return time.monotonic() - started
+
+
+class CircuitBreaker:
+    """
+    provider 毎の circuit breaker
+
+    closed: 通常どおり呼び出す。障害が failure_threshold 回続くと open になる
+    open: reset_timeout 秒の間は呼び出さずに CircuitOpenError を送出する
+    half_open: 1件だけ試行し、成功すれば closed、失敗すれば再び open になる
+    """
+
+    def __init__(self, provider, failure_threshold=BREAKER_FAILURE_THRESHOLD, reset_timeout=BREAKER_RESET_TIMEOUT):
+        self.provider = provider
+        self.failure_threshold = max(1, failure_threshold)
+        self.reset_timeout = reset_timeout
+        self.state = CLOSED
+        self.failures = 0
+        self.opened_at = 0.0
+        self._probing = False
+        circuit_breaker_state.set(BREAKER_STATE_VALUES[CLOSED], provider=provider)
+
+    def _set_state(self, state):
+        self.state = state
+        circuit_breaker_state.set(BREAKER_STATE_VALUES[state], provider=self.provider)
+
+    def retry_in(self):
+        """open の場合に試行を再開するまでの秒数"""
+        if self.state != OPEN:
+            return 0.0
+        return max(0.0, self.reset_timeout - (time.monotonic() - self.opened_at))
+
+    def before_call(self):
+        """呼び出してよいか判定する（呼び出せない場合は CircuitOpenError を送出）"""
+        if self.state == OPEN and self.retry_in() <= 0:
+            self._set_state(HALF_OPEN)
+        if self.state == OPEN or (self.state == HALF_OPEN and self._probing):
+            circuit_breaker_rejections_total.inc(provider=self.provider)
+            raise CircuitOpenError(self.provider, max(1, round(self.retry_in())))
+        if self.state == HALF_OPEN:
+            self._probing = True
+
+    def record_success(self):
+        self._probing = False
+        self.failures = 0
+        if self.state != CLOSED:
+            self._set_state(CLOSED)
+
+    def record_failure(self, outage=True):
+        """呼び出しの失敗を記録する（outage が False のエラーは障害として数えない）"""
+        was_probing, self._probing = self._probing, False
+        if not outage:
+            if was_probing:
+                # 試行の結果が判定できないため、次の呼び出しで改めて試行する
+                return
+            self.failures = 0
+            return
+        self.failures += 1
+        if was_probing or self.failures >= self.failure_threshold:
+            self.opened_at = time.monotonic()
+            self._set_state(OPEN)
+
+    def release(self):
+        """結果を記録せずに終わった呼び出し（キャンセルなど）の試行枠を返す"""
+        self._probing = False
+
+    def stats(self):
+        return {"state": self.state, "failures": self.failures, "retry_in": round(self.retry_in(), 1)}
+
+
+class ProviderResilience:
+    """
+    provider 呼び出しの共通の耐障害レイヤー
+
+    呼び出し毎に circuit breaker の確認とレート制限の待機を行い、一時的なエラーは
+    Retry-After を尊重したジッター付き指数バックオフでリトライします。
+    """
+
+    def __init__(self, rate_limiter=None, max_attempts=RETRY_MAX_ATTEMPTS, base_delay=RETRY_BASE_DELAY,
+                 max_delay=RETRY_MAX_DELAY, failure_threshold=BREAKER_FAILURE_THRESHOLD,
+                 reset_timeout=BREAKER_RESET_TIMEOUT):
+        self.rate_limiter = rate_limiter or RateLimiter(PROVIDER_RPM_LIMITS, PROVIDER_TPM_LIMITS)
+        self.max_attempts = max(1, max_attempts)
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self._breakers = {}
+
+    def breaker(self, provider):
+        breaker = self._breakers.get(provider)
+        if breaker is None:
+            breaker = self._breakers[provider] = CircuitBreaker(
+                provider, self.failure_threshold, self.reset_timeout
+            )
+        return breaker
+
+    async def _before_attempt(self, provider, model, tokens):
+        self.breaker(provider).before_call()
+        try:
+            waited = await self.rate_limiter.acquire(provider, model, tokens)
+        except BaseException:
+            self.breaker(provider).release()
+            raise
+        observe_span("rate_limit_wait", waited, provider=provider, model=model)
+
+    async def _after_failure(self, provider, model, attempt, e):
+        """
+        失敗を記録し、リトライする場合は待機する
+
+        Returns:
+            bool: リトライする場合は True（しない場合は呼び出し側で例外を送出する）
+        """
+        breaker = self.breaker(provider)
+        breaker.record_failure(is_outage(e))
+        if attempt + 1 >= self.max_attempts or not is_retryable(e) or breaker.state == OPEN:
+            return False
+        retry_after = get_retry_after(e)
+        if retry_after is not None and retry_after > self.max_delay:
+            return False
+        delay = backoff_delay(attempt, retry_after, self.base_delay, self.max_delay)
+        reason = get_status_code(e) or type(e).__name__
+        provider_retries_total.inc(provider=provider, model=model, reason=reason)
+        observe_span("retry_backoff", delay, provider=provider, model=model)
+        await asyncio.sleep(delay)
+        return True
+
+    async def call(self, provider, model, func, tokens=0):
+        """
+        func() を呼び出して結果を返す（一時的なエラーはリトライする）
+
+        Args:
+            provider (str): provider 名
+            model (str): モデル名
+            func (callable): provider を呼び出すコルーチンを返す関数（試行毎に呼ばれる）
+            tokens (int): TPM の制限に使うトークン数の見積もり
+        """
+        for attempt in range(self.max_attempts):
+            await self._before_attempt(provider, model, tokens)
+            try:
+                result = await func()
+            except Exception as e:
+                if not await self._after_failure(provider, model, attempt, e):
+                    raise
+                continue
+            except BaseException:
+                self.breaker(provider).release()
+                raise
+            self.breaker(provider).record_success()
+            return result
+
+    async def stream(self, provider, model, factory, tokens=0):
+        """
+        factory() が返す非同期イテレータの要素を yield する
+
+        最初の要素を受信する前のエラーのみリトライします（受信済みの内容を重複させないため、
+        それ以降のエラーはそのまま送出します）。
+        """
+        for attempt in range(self.max_attempts):
+            await self._before_attempt(provider, model, tokens)
+            started = False
+            try:
+                async for item in factory():
+                    started = True
+                    yield item
+            except Exception as e:
+                if started:
+                    self.breaker(provider).record_failure(is_outage(e))
+                    raise
+                if not await self._after_failure(provider, model, attempt, e):
+                    raise
+                continue
+            except BaseException:
+                self.breaker(provider).release()
+                raise
+            self.breaker(provider).record_success()
+            return
+
+    def stats(self):
+        """provider 毎の circuit breaker の状態"""
+        return {provider: breaker.stats() for provider, breaker in self._breakers.items()}
+
+
+# アプリ全体で共有する耐障害レイヤー
+provider_resilience = ProviderResilience()
@@ -0,0 +1,174 @@
+import asyncio
+import os
+import time
+from collections import deque
+
+from .config import env_bool, env_float, env_int
+from .metrics import metrics_registry
+from .resilience import is_outage
+from .scheduler import Overloaded
+
+# /api/llm で主モデルが失敗・遅延した場合に使うモデル（INTEGRATED_MODELS の "provider:model"、先頭から順に使う）
+# 主モデルと同時に障害が起きにくいよう、既定では別の provider のモデルを指定する
+LLM_API_FALLBACK_MODELS = [
+    name.strip()
+    for name in os.environ.get(
+        "LLM_API_FALLBACK_MODELS", "openai:gpt-4o-mini,anthropic:claude-3-5-sonnet-20241022"
+    ).split(",")
+    if name.strip()
+]
+# 主モデルの応答が遅い場合に、次のモデルへ同じリクエストを送る（ヘッジ）かどうか
+LLM_API_HEDGE_ENABLED = env_bool("LLM_API_HEDGE_ENABLED", True)
+# ヘッジを送るまでの待ち時間は、モデルの直近の応答時間のこのパーセンタイルとする
+LLM_API_HEDGE_PERCENTILE = env_float("LLM_API_HEDGE_PERCENTILE", 95.0)
+# 待ち時間の下限・上限（秒）と、応答時間の記録が少ない間に使う待ち時間（秒）
+LLM_API_HEDGE_MIN_DELAY = env_float("LLM_API_HEDGE_MIN_DELAY", 1.0)
+LLM_API_HEDGE_MAX_DELAY = env_float("LLM_API_HEDGE_MAX_DELAY", 60.0)
+LLM_API_HEDGE_DEFAULT_DELAY = env_float("LLM_API_HEDGE_DEFAULT_DELAY", 10.0)
+# パーセンタイルを計算するのに必要な記録数と、モデル毎に保持する記録数
+LLM_API_HEDGE_MIN_SAMPLES = env_int("LLM_API_HEDGE_MIN_SAMPLES", 20)
+LLM_API_LATENCY_WINDOW = env_int("LLM_API_LATENCY_WINDOW", 200)
+
+routed_requests_total = metrics_registry.counter(
+    "ai_gradio_routed_requests_total",
+    "Routed requests by the model that answered and how it was reached (primary, hedge or fallback).",
+    ("model", "route"),
+)
+hedged_requests_total = metrics_registry.counter(
+    "ai_gradio_hedged_requests_total",
+    "Secondary requests sent because the primary model was slower than its hedge delay.",
+    ("model",),
+)
+
+
+def is_fallback_error(e):
+    """
+    次の候補にフォールバックするエラー（5xx・タイムアウト・接続エラー・過負荷）であれば True
+
+    リクエスト自体の誤り（4xx など）は他のモデルでも同じく失敗するため、フォールバックしません。
+    """
+    return is_outage(e) or isinstance(e, Overloaded)
+
+
+class LatencyTracker:
+    """
+    モデル（"provider:model"）毎の直近の provider の応答時間（成功したもののみ）を保持する
+
+    応答キャッシュや実行中の呼び出しの共有で得た結果は provider を呼び出していないため、
+    provider を呼び出した箇所（integrated_gradio._request_completion）でのみ記録します。
+    """
+
+    def __init__(self, window=LLM_API_LATENCY_WINDOW):
+        self.window = max(1, window)
+        self._samples = {}
+
+    def observe(self, model, seconds):
+        samples = self._samples.get(model)
+        if samples is None:
+            samples = self._samples[model] = deque(maxlen=self.window)
+        samples.append(seconds)
+
+    def percentile(self, model, q, min_samples=1):
+        """直近の応答時間の q パーセンタイル（記録が min_samples 件未満の場合は None）"""
+        samples = self._samples.get(model)
+        if not samples or len(samples) < min_samples:
+            return None
+        ordered = sorted(samples)
+        index = min(len(ordered) - 1, max(0, round(q / 100 * len(ordered)) - 1))
+        return ordered[index]
+
+    def stats(self):
+        return {model: len(samples) for model, samples in self._samples.items()}
+
+
+class HedgingRouter:
+    """
+    ヘッジとフォールバックで複数のモデルに振り分けるルーター
+
+    候補の先頭（主モデル）から呼び出し、応答時間がそのモデルの p95（hedge_percentile）を
+    超えたら次の候補にも同じリクエストを送り（ヘッジ）、先に成功した応答を返して残りを
+    キャンセルします。呼び出しが一時的なエラー（is_fallback_error）で失敗した場合は待たずに
+    次の候補を呼び出し（フォールバック）、それ以外のエラーはそのまま送出します。
+    同時に実行するのは最大2件です。
+    """
+
+    def __init__(self, hedge=LLM_API_HEDGE_ENABLED, hedge_percentile=LLM_API_HEDGE_PERCENTILE,
+                 min_delay=LLM_API_HEDGE_MIN_DELAY, max_delay=LLM_API_HEDGE_MAX_DELAY,
+                 default_delay=LLM_API_HEDGE_DEFAULT_DELAY, min_samples=LLM_API_HEDGE_MIN_SAMPLES,
+                 latency=None):
+        self.hedge = hedge
+        self.hedge_percentile = hedge_percentile
+        self.min_delay = min_delay
+        self.max_delay = max_delay
+        self.default_delay = default_delay
+        self.min_samples = min_samples
+        self.latency = latency or provider_latency
+
+    def hedge_delay(self, model):
+        """model の呼び出しからヘッジを送るまでの秒数"""
+        observed = self.latency.percentile(model, self.hedge_percentile, self.min_samples)
+        if observed is None:
+            return self.default_delay
+        return min(self.max_delay, max(self.min_delay, observed))
+
+    async def run(self, candidates, call, hedge=None):
+        """
+        candidates のモデルを順に call(model) で呼び出し、最初に成功した結果を返す
+
+        Args:
+            candidates (list): 呼び出すモデルのリスト（先頭が主モデル）
+            call (callable): モデル名を受け取り、コルーチンを返す関数
+            hedge (bool): ヘッジするかどうか（省略時はルーターの設定に従う）
+
+        Returns:
+            tuple: (結果, 応答したモデル)。すべて失敗した場合は最後のエラー、フォールバックしない
+                   エラーの場合はそのエラーを送出
+        """
+        hedge = self.hedge if hedge is None else hedge
+        pending = list(candidates)
+        running = {}  # task -> (model, route, 開始時刻)
+        last_error = None
+
+        def start(route):
+            model = pending.pop(0)
+            if route == "hedge":
+                hedged_requests_total.inc(model=model)
+            running[asyncio.ensure_future(call(model))] = (model, route, time.monotonic())
+
+        start("primary")
+        try:
+            while running:
+                timeout = None
+                if hedge and pending and len(running) == 1:
+                    model, _, started = next(iter(running.values()))
+                    timeout = max(0.0, self.hedge_delay(model) - (time.monotonic() - started))
+                done, _ = await asyncio.wait(running, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+                if not done:
+                    start("hedge")
+                    continue
+                for task in done:
+                    model, route, _ = running.pop(task)
+                    if task.exception() is None:
+                        routed_requests_total.inc(model=model, route=route)
+                        return task.result(), model
+                    last_error = task.exception()
+                    if not is_fallback_error(last_error):
+                        raise last_error
+                if pending and len(running) < 2:
+                    start("fallback")
+            raise last_error
+        finally:
+            for task in running:
+                task.cancel()
+
+    def stats(self):
+        return {
+            "hedge": self.hedge,
+            "latency_samples": self.latency.stats(),
+        }
+
+
+# provider の応答時間（ヘッジを送るまでの待ち時間の計算に使う）
+provider_latency = LatencyTracker()
+# /api/llm で使うルーター
+llm_api_router = HedgingRouter()
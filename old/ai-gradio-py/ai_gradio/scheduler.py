@@ -0,0 +1,349 @@
+import asyncio
+import math
+import time
+from collections import OrderedDict, deque
+from contextlib import asynccontextmanager
+
+from .config import env_float, env_int, env_provider_map
+from .metrics import observe_span
+from .shared_state import SharedLimit
+
+# 同時に実行できる生成リクエスト数（全体）
+MAX_CONCURRENT_GENERATIONS = env_int("MAX_CONCURRENT_GENERATIONS", 8)
+# 1セッション（ユーザー）あたりの同時実行数
+MAX_GENERATIONS_PER_SESSION = env_int("MAX_GENERATIONS_PER_SESSION", 1)
+# provider毎の同時API呼び出し数（例: "openai=8,anthropic=4"）
+DEFAULT_PROVIDER_CONCURRENCY = env_int("DEFAULT_PROVIDER_CONCURRENCY", 8)
+PROVIDER_CONCURRENCY_LIMITS = env_provider_map("PROVIDER_CONCURRENCY_LIMITS")
+# /api/llm の同時実行数・待ち行列の上限・待ち時間の上限（秒）
+LLM_API_MAX_CONCURRENCY = env_int("LLM_API_MAX_CONCURRENCY", 16)
+LLM_API_MAX_QUEUE = env_int("LLM_API_MAX_QUEUE", 64)
+LLM_API_QUEUE_TIMEOUT = env_float("LLM_API_QUEUE_TIMEOUT", 30.0)
+
+
+class QueueTicket:
+    """スケジューラに投入された1リクエスト分の整理券"""
+
+    def __init__(self, scheduler, tenant):
+        self.scheduler = scheduler
+        self.tenant = tenant
+        self.enqueued_at = time.monotonic()
+        self.granted = False
+        self.released = False
+        # ワーカー・ノード全体の実行枠（FairScheduler に shared_limit がある場合のみ）
+        self.lease = None
+        self._event = asyncio.Event()
+
+    @property
+    def position(self):
+        """待ち順（1始まり）。実行中の場合は 0"""
+        return self.scheduler.position(self)
+
+    @property
+    def waited(self):
+        """投入からの経過秒数"""
+        return time.monotonic() - self.enqueued_at
+
+    def _grant(self):
+        self.granted = True
+        self._event.set()
+
+    async def wait(self, timeout=None):
+        """
+        実行枠が割り当てられるまで待つ
+
+        プロセス内の実行枠が割り当てられた後、shared_limit がある場合はワーカー・ノード全体の
+        実行枠も確保します。
+
+        Returns:
+            bool: 割り当て済みなら True、timeout した場合は False
+        """
+        started = time.monotonic()
+        if not self.granted:
+            try:
+                await asyncio.wait_for(self._event.wait(), timeout)
+            except asyncio.TimeoutError:
+                return False
+        shared_limit = self.scheduler.shared_limit
+        if shared_limit is None or self.lease is not None:
+            return True
+        remaining = None if timeout is None else max(0.0, timeout - (time.monotonic() - started))
+        self.lease = await shared_limit.acquire(remaining)
+        if self.lease is not None and self.released:
+            # 確保している間に返却された場合はすぐに返す
+            self.lease.release()
+        return self.lease is not None
+
+    def release(self):
+        """実行枠を返却する（待機中の場合はキューから取り除く）"""
+        self.scheduler.release(self)
+
+
+class FairScheduler:
+    """
+    テナント（セッション/ユーザー）間で公平に実行枠を割り当てるスケジューラ
+
+    テナント毎に待ち行列を持ち、ラウンドロビンで実行枠を割り当てます。
+    全体の同時実行数と、テナントあたりの同時実行数をそれぞれ制限できます。
+    shared_limit を指定すると、全体の同時実行数をワーカー・ノード全体でも制限します
+    （公平性はプロセス内のテナント間で保ちます）。
+    """
+
+    def __init__(self, max_active=MAX_CONCURRENT_GENERATIONS, max_per_tenant=MAX_GENERATIONS_PER_SESSION,
+                 shared_limit=None):
+        self.max_active = max(1, max_active)
+        self.max_per_tenant = max(1, max_per_tenant)
+        self.shared_limit = shared_limit
+        self._waiting = OrderedDict()  # tenant -> deque[QueueTicket]
+        self._active = {}  # tenant -> 実行中の数
+        self._active_total = 0
+
+    def submit(self, tenant):
+        """リクエストをキューに投入し、整理券を返す"""
+        ticket = QueueTicket(self, tenant)
+        self._waiting.setdefault(tenant, deque()).append(ticket)
+        self._dispatch()
+        return ticket
+
+    @asynccontextmanager
+    async def slot(self, tenant):
+        """実行枠を確保する async コンテキストマネージャ"""
+        ticket = self.submit(tenant)
+        try:
+            await ticket.wait()
+            yield ticket
+        finally:
+            ticket.release()
+
+    def release(self, ticket):
+        if ticket.released:
+            return
+        ticket.released = True
+        if ticket.lease is not None:
+            ticket.lease.release()
+        if ticket.granted:
+            self._active[ticket.tenant] -= 1
+            if self._active[ticket.tenant] <= 0:
+                del self._active[ticket.tenant]
+            self._active_total -= 1
+        else:
+            queue = self._waiting.get(ticket.tenant)
+            if queue is not None:
+                try:
+                    queue.remove(ticket)
+                except ValueError:
+                    pass
+                if not queue:
+                    del self._waiting[ticket.tenant]
+        self._dispatch()
+
+    def position(self, ticket):
+        """
+        ラウンドロビンで割り当てた場合の待ち順を求める
+
+        各テナントの i 番目のチケットは i 巡目に割り当てられるため、
+        自分より前に割り当てられるチケット数を数えれば待ち順になる。
+        """
+        if ticket.released:
+            return 0
+        if ticket.granted:
+            # ワーカー・ノード全体の実行枠を待っている場合は先頭とする
+            return 1 if self.shared_limit is not None and ticket.lease is None else 0
+        queue = self._waiting.get(ticket.tenant)
+        if queue is None or ticket not in queue:
+            return 0
+        index = queue.index(ticket)
+        ahead = 0
+        before_own_tenant = True
+        for tenant, other in self._waiting.items():
+            if tenant == ticket.tenant:
+                before_own_tenant = False
+                continue
+            ahead += min(len(other), index)
+            if before_own_tenant and len(other) > index:
+                ahead += 1
+        return ahead + index + 1
+
+    def _dispatch(self):
+        while self._active_total < self.max_active:
+            for tenant in list(self._waiting):
+                if self._active.get(tenant, 0) >= self.max_per_tenant:
+                    continue
+                queue = self._waiting[tenant]
+                ticket = queue.popleft()
+                if queue:
+                    # 割り当てたテナントは末尾へ回す（ラウンドロビン）
+                    self._waiting.move_to_end(tenant)
+                else:
+                    del self._waiting[tenant]
+                self._active[tenant] = self._active.get(tenant, 0) + 1
+                self._active_total += 1
+                ticket._grant()
+                break
+            else:
+                return
+
+    def stats(self):
+        """現在の実行数・待ち数を返す"""
+        return {
+            "active": self._active_total,
+            "waiting": sum(len(q) for q in self._waiting.values()),
+            "tenants": len(set(self._active) | set(self._waiting)),
+        }
+
+
+class ProviderLimiter:
+    """provider毎の同時API呼び出し数を制限する（共有状態のバックエンドではワーカー・ノード全体で制限する）"""
+
+    def __init__(self, limits=None, default_limit=DEFAULT_PROVIDER_CONCURRENCY):
+        self.limits = dict(limits or {})
+        self.default_limit = max(1, default_limit)
+        self._semaphores = {}
+        self._shared_limits = {}
+
+    def _semaphore(self, provider):
+        if provider not in self._semaphores:
+            limit = max(1, self.limits.get(provider, self.default_limit))
+            self._semaphores[provider] = asyncio.Semaphore(limit)
+            self._shared_limits[provider] = SharedLimit(f"provider:{provider}", limit)
+        return self._semaphores[provider]
+
+    @asynccontextmanager
+    async def limit(self, provider):
+        started = time.monotonic()
+        async with self._semaphore(provider):
+            lease = await self._shared_limits[provider].acquire()
+            try:
+                observe_span("provider_queue_wait", time.monotonic() - started, provider=provider)
+                yield
+            finally:
+                lease.release()
+
+
+class Overloaded(Exception):
+    """過負荷のためリクエストを受け付けられない場合の例外"""
+
+    def __init__(self, message, status_code, retry_after):
+        super().__init__(message)
+        self.status_code = status_code
+        self.retry_after = retry_after
+
+
+class _NoLease:
+    """shared_limit がない場合の実行枠（返却する必要がない）"""
+
+    def release(self):
+        pass
+
+
+NO_LEASE = _NoLease()
+
+
+class AdmissionTicket:
+    """AdmissionGate で確保した実行枠"""
+
+    def __init__(self, gate, lease):
+        self.gate = gate
+        self.lease = lease
+        self.started = time.monotonic()
+        self.released = False
+
+    def release(self):
+        """実行枠を返却する（複数回呼んでも1回だけ返却される）"""
+        if self.released:
+            return
+        self.released = True
+        self.lease.release()
+        self.gate._release(time.monotonic() - self.started)
+
+
+class AdmissionGate:
+    """
+    同時実行数と待ち行列の長さを制限する受付ゲート
+
+    待ち行列が一杯の場合は 429、待ち時間が queue_timeout を超えた場合は 503 として
+    Overloaded を送出します。retry_after は平均処理時間と待ち行列の長さから見積もります。
+    shared_limit を指定すると、同時実行数をワーカー・ノード全体でも制限します（待ち行列の長さは
+    プロセス毎の制限です）。
+    """
+
+    def __init__(self, max_concurrency=LLM_API_MAX_CONCURRENCY, max_queue=LLM_API_MAX_QUEUE,
+                 queue_timeout=LLM_API_QUEUE_TIMEOUT, shared_limit=None):
+        self.max_concurrency = max(1, max_concurrency)
+        self.max_queue = max(0, max_queue)
+        self.queue_timeout = queue_timeout
+        self.shared_limit = shared_limit
+        self._semaphore = asyncio.Semaphore(self.max_concurrency)
+        self.active = 0
+        self.waiting = 0
+        self.rejected = 0
+        # 処理時間の指数移動平均（秒）
+        self.avg_service_time = 1.0
+
+    def retry_after(self):
+        """待ち行列がはけるまでのおおよその秒数"""
+        backlog = (self.waiting + 1) / self.max_concurrency
+        return max(1, math.ceil(backlog * self.avg_service_time))
+
+    async def _acquire_slot(self, started):
+        """プロセス内の実行枠、ワーカー・ノード全体の実行枠の順に確保する（確保できない場合は None）"""
+        await asyncio.wait_for(self._semaphore.acquire(), self.queue_timeout)
+        if self.shared_limit is None:
+            return NO_LEASE
+        try:
+            remaining = max(0.0, self.queue_timeout - (time.monotonic() - started))
+            lease = await self.shared_limit.acquire(remaining)
+        except BaseException:
+            self._semaphore.release()
+            raise
+        if lease is None:
+            self._semaphore.release()
+        return lease
+
+    async def acquire(self):
+        """実行枠を確保する（確保できない場合は Overloaded を送出）"""
+        if self.active + self.waiting >= self.max_concurrency + self.max_queue:
+            self.rejected += 1
+            raise Overloaded("Too many requests. Please retry later.", 429, self.retry_after())
+        self.waiting += 1
+        started = time.monotonic()
+        try:
+            lease = await self._acquire_slot(started)
+        except asyncio.TimeoutError:
+            lease = None
+        finally:
+            self.waiting -= 1
+        if lease is None:
+            self.rejected += 1
+            raise Overloaded("Service is overloaded. Please retry later.", 503, self.retry_after())
+        observe_span("admission_wait", time.monotonic() - started)
+        self.active += 1
+        return AdmissionTicket(self, lease)
+
+    def _release(self, service_time):
+        self.active -= 1
+        self.avg_service_time = 0.8 * self.avg_service_time + 0.2 * service_time
+        self._semaphore.release()
+
+    @asynccontextmanager
+    async def admit(self):
+        ticket = await self.acquire()
+        try:
+            yield ticket
+        finally:
+            ticket.release()
+
+    def stats(self):
+        return {
+            "active": self.active,
+            "waiting": self.waiting,
+            "rejected": self.rejected,
+            "avg_service_time": self.avg_service_time,
+        }
+
+
+# アプリ全体で共有するスケジューラ
+generation_scheduler = FairScheduler(shared_limit=SharedLimit("generation", MAX_CONCURRENT_GENERATIONS))
+provider_limiter = ProviderLimiter(PROVIDER_CONCURRENCY_LIMITS)
+# /api/llm の受付ゲート
+llm_api_gate = AdmissionGate(shared_limit=SharedLimit("llm_api", LLM_API_MAX_CONCURRENCY))
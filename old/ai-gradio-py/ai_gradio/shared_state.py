@@ -0,0 +1,335 @@
+import asyncio
+import os
+import random
+import time
+import uuid
+
+import httpx
+
+from .config import env_float
+from .metrics import metrics_registry, observe_span
+
+# 複数のワーカー・ノードで共有する状態サーバー（python -m ai_gradio.state_server）の URL
+# （例: "http://state:7870"）。空の場合は状態をプロセス内で保持する（1プロセスでの実行）
+SHARED_STATE_URL = os.environ.get("SHARED_STATE_URL", "")
+# 状態サーバーの認証トークン（状態サーバーの STATE_SERVER_TOKEN と同じ値）
+SHARED_STATE_TOKEN = os.environ.get("SHARED_STATE_TOKEN", "")
+SHARED_STATE_TIMEOUT = env_float("SHARED_STATE_TIMEOUT", 2.0)
+# 共有の実行枠（リース）・実行中の呼び出しの有効期限（秒）。保持している間は期限の 1/3 毎に延長し、
+# プロセスが落ちた場合は期限切れで解放される
+SHARED_LEASE_TTL = env_float("SHARED_LEASE_TTL", 30.0)
+# 共有の実行枠・他のワーカーで実行中の呼び出しを待つ間の問い合わせ間隔の上限（秒）
+SHARED_POLL_INTERVAL = env_float("SHARED_POLL_INTERVAL", 0.5)
+
+shared_state_errors_total = metrics_registry.counter(
+    "ai_gradio_shared_state_errors_total",
+    "Shared state operations that failed and fell back to process-local behavior.",
+    ("op",),
+)
+
+# 結果を待たずに実行する状態の更新（解放など）のタスク（完了まで参照を保持する）
+_background_tasks = set()
+
+
+def run_in_background(loop, factory):
+    """
+    loop 上で factory() のコルーチンを実行する（呼び出し元のスレッドを問わない）
+
+    解放処理は同期的な release() やスレッドで実行されるバックグラウンドタスクから呼ばれるため、
+    ループに処理を渡して結果を待たずに戻ります。
+    """
+    def start():
+        task = loop.create_task(factory())
+        _background_tasks.add(task)
+        task.add_done_callback(_background_tasks.discard)
+
+    if not loop.is_closed():
+        loop.call_soon_threadsafe(start)
+
+
+class TokenBucket:
+    """1分あたり per_minute 単位まで消費できるトークンバケット（予約方式）"""
+
+    def __init__(self, per_minute):
+        self.capacity = per_minute
+        self.rate = per_minute / 60.0
+        self.tokens = float(per_minute)
+        self.updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def reserve(self, amount):
+        """
+        amount 単位を予約し、実際に消費できるまでの秒数を返す
+
+        残量が足りない場合も先に予約する（残量は負になる）ため、先に予約した呼び出しから
+        順に消費できるようになります。
+        """
+        self._refill()
+        self.tokens -= min(amount, self.capacity)
+        return max(0.0, -self.tokens / self.rate)
+
+
+class InProcessBackend:
+    """
+    プロセス内で状態を保持するバックエンド
+
+    1プロセスで実行する場合のデフォルトで、状態サーバーの保存先としても使います。
+    キャッシュ・実行中の呼び出し・実行枠はプロセス内の仕組み（ResponseCache・SingleFlight・
+    FairScheduler など）がそのまま管理できるため、shared が False のバックエンドは
+    それらからは使われません（レート制限のトークンバケットのみ保持します）。
+    """
+
+    shared = False
+
+    def __init__(self):
+        self._values = {}  # key -> (expires_at, value)
+        self._leases = {}  # name -> {holder: expires_at}
+        self._buckets = {}  # name -> TokenBucket
+        self._next_sweep = 1024
+
+    def _sweep(self):
+        # 期限切れの値は参照された時に削除するが、参照されないものは件数が増えた時にまとめて削除する
+        now = time.monotonic()
+        self._values = {key: entry for key, entry in self._values.items() if entry[0] > now}
+        self._next_sweep = max(1024, len(self._values) * 2)
+
+    def _get(self, key):
+        entry = self._values.get(key)
+        if entry is None:
+            return None
+        if entry[0] <= time.monotonic():
+            del self._values[key]
+            return None
+        return entry[1]
+
+    async def get(self, key):
+        """key の値を返す（ない場合・期限切れの場合は None）"""
+        return self._get(key)
+
+    async def set(self, key, value, ttl):
+        """key に value を ttl 秒の間保存する"""
+        self._values[key] = (time.monotonic() + ttl, value)
+        if len(self._values) > self._next_sweep:
+            self._sweep()
+
+    async def add(self, key, value, ttl):
+        """key に値がない場合のみ保存する（保存した場合は True）"""
+        if self._get(key) is not None:
+            return False
+        await self.set(key, value, ttl)
+        return True
+
+    async def delete(self, key, value=None):
+        """key の値を削除する（value を指定した場合は値が一致する場合のみ）"""
+        if value is None or self._get(key) == value:
+            self._values.pop(key, None)
+
+    async def acquire(self, name, holder, limit, ttl):
+        """
+        name の実行枠を holder のために ttl 秒の間確保する（確保済みの場合は延長する）
+
+        Returns:
+            bool: 確保・延長できた場合は True（limit 件が確保済みの場合は False）
+        """
+        now = time.monotonic()
+        leases = {h: expires_at for h, expires_at in self._leases.get(name, {}).items() if expires_at > now}
+        self._leases[name] = leases
+        if holder not in leases and len(leases) >= limit:
+            return False
+        leases[holder] = now + ttl
+        return True
+
+    async def release(self, name, holder):
+        """holder が確保した name の実行枠を返却する"""
+        leases = self._leases.get(name)
+        if leases is not None:
+            leases.pop(holder, None)
+            if not leases:
+                del self._leases[name]
+
+    async def reserve(self, name, amount, per_minute):
+        """name のトークンバケット（1分あたり per_minute）から amount を予約し、待つべき秒数を返す"""
+        bucket = self._buckets.get(name)
+        if bucket is None or bucket.capacity != per_minute:
+            bucket = self._buckets[name] = TokenBucket(per_minute)
+        return bucket.reserve(amount)
+
+    def stats(self):
+        now = time.monotonic()
+        return {
+            "backend": "in_process",
+            "values": len(self._values),
+            "leases": {
+                name: sum(1 for expires_at in leases.values() if expires_at > now)
+                for name, leases in self._leases.items()
+            },
+            "buckets": len(self._buckets),
+        }
+
+    async def aclose(self):
+        pass
+
+
+class HttpStateBackend:
+    """
+    状態サーバー（python -m ai_gradio.state_server）に状態を保持するバックエンド
+
+    複数のワーカー・ノードで同じ状態サーバーを使うと、キャッシュ・実行中の呼び出し・
+    実行枠・レート制限がアプリ全体で共有されます。状態サーバーに接続できない場合は
+    エラーを数えたうえでプロセス内の動作（キャッシュのミス、制限はプロセス内の上限のみ）に
+    切り替えて処理を続けます。
+    """
+
+    shared = True
+
+    # 状態サーバーに接続できない場合に返す値（プロセス内の動作に切り替える）
+    FALLBACKS = {"get": None, "set": None, "add": True, "delete": None, "acquire": True, "release": None,
+                 "reserve": 0.0}
+
+    def __init__(self, url, token=SHARED_STATE_TOKEN, timeout=SHARED_STATE_TIMEOUT):
+        self.url = url.rstrip("/")
+        self.token = token
+        self.timeout = timeout
+        self.errors = 0
+        self.last_error = None
+        self._client = None
+
+    @property
+    def client(self):
+        # イベントループ上で最初に使われた時点で生成する
+        if self._client is None:
+            headers = {"Authorization": f"Bearer {self.token}"} if self.token else {}
+            self._client = httpx.AsyncClient(base_url=self.url, headers=headers, timeout=self.timeout)
+        return self._client
+
+    async def _call(self, op, **payload):
+        started = time.monotonic()
+        try:
+            response = await self.client.post(f"/state/{op}", json=payload)
+            response.raise_for_status()
+            return response.json()["result"]
+        except (httpx.HTTPError, TypeError, ValueError, KeyError) as e:
+            self.errors += 1
+            self.last_error = f"{op}: {type(e).__name__}: {e}"
+            shared_state_errors_total.inc(op=op)
+            return self.FALLBACKS[op]
+        finally:
+            observe_span("shared_state", time.monotonic() - started, provider=op)
+
+    async def get(self, key):
+        return await self._call("get", key=key)
+
+    async def set(self, key, value, ttl):
+        await self._call("set", key=key, value=value, ttl=ttl)
+
+    async def add(self, key, value, ttl):
+        return await self._call("add", key=key, value=value, ttl=ttl)
+
+    async def delete(self, key, value=None):
+        await self._call("delete", key=key, value=value)
+
+    async def acquire(self, name, holder, limit, ttl):
+        return await self._call("acquire", name=name, holder=holder, limit=limit, ttl=ttl)
+
+    async def release(self, name, holder):
+        await self._call("release", name=name, holder=holder)
+
+    async def reserve(self, name, amount, per_minute):
+        return await self._call("reserve", name=name, amount=amount, per_minute=per_minute)
+
+    def stats(self):
+        return {"backend": "http", "url": self.url, "errors": self.errors, "last_error": self.last_error}
+
+    async def aclose(self):
+        if self._client is not None:
+            client, self._client = self._client, None
+            await client.aclose()
+
+
+def create_backend(url=SHARED_STATE_URL):
+    """SHARED_STATE_URL に応じたバックエンドを生成する"""
+    return HttpStateBackend(url) if url else InProcessBackend()
+
+
+async def keep_alive(interval, renew):
+    """interval 秒毎に renew() を呼び出す（キャンセルされるまで続ける）"""
+    while True:
+        await asyncio.sleep(interval)
+        await renew()
+
+
+class SharedLease:
+    """SharedLimit で確保した実行枠"""
+
+    def __init__(self, limit, holder=None):
+        self.limit = limit
+        self.holder = holder
+        self.released = False
+        self._loop = None
+        self._renewer = None
+        if holder is not None:
+            self._loop = asyncio.get_running_loop()
+            self._renewer = self._loop.create_task(keep_alive(limit.ttl / 3, self._renew))
+
+    async def _renew(self):
+        await self.limit.backend.acquire(self.limit.name, self.holder, self.limit.limit, self.limit.ttl)
+
+    def release(self):
+        """実行枠を返却する（複数回呼んでも1回だけ返却される。どのスレッドから呼んでもよい）"""
+        if self.released or self.holder is None:
+            return
+        self.released = True
+        self._loop.call_soon_threadsafe(self._renewer.cancel)
+        run_in_background(self._loop, lambda: self.limit.backend.release(self.limit.name, self.holder))
+
+
+class SharedLimit:
+    """
+    ワーカー・ノード全体の同時実行数を limit に制限する実行枠（共有状態のリース）
+
+    プロセス内の制限（FairScheduler・ProviderLimiter・AdmissionGate）で枠を確保した後に
+    確保します。バックエンドが共有されていない場合はプロセス内の制限だけで十分なため、
+    待たずに実行枠を返します。
+    """
+
+    def __init__(self, name, limit, backend=None, ttl=SHARED_LEASE_TTL, poll_interval=SHARED_POLL_INTERVAL):
+        self.name = name
+        self.limit = max(1, limit)
+        self.backend = backend or shared_state
+        self.ttl = ttl
+        self.poll_interval = poll_interval
+
+    async def acquire(self, timeout=None):
+        """
+        実行枠を確保する
+
+        Returns:
+            SharedLease: 確保した実行枠（timeout 秒以内に確保できない場合は None）
+        """
+        if not self.backend.shared:
+            return SharedLease(self)
+        holder = uuid.uuid4().hex
+        deadline = None if timeout is None else time.monotonic() + timeout
+        delay = 0.01
+        try:
+            while not await self.backend.acquire(self.name, holder, self.limit, self.ttl):
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    return None
+                # 他のワーカーが返却するまで間隔を広げながら問い合わせる
+                sleep = random.uniform(delay / 2, delay)
+                await asyncio.sleep(sleep if remaining is None else min(sleep, remaining))
+                delay = min(delay * 2, self.poll_interval)
+        except BaseException:
+            # 状態サーバー側では確保済みの可能性があるため返却しておく
+            run_in_background(asyncio.get_running_loop(), lambda: self.backend.release(self.name, holder))
+            raise
+        return SharedLease(self, holder)
+
+
+# アプリ全体で共有する状態のバックエンド
+shared_state = create_backend()
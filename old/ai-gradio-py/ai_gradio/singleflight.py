@@ -0,0 +1,131 @@
+import asyncio
+import random
+import uuid
+
+from .config import env_float
+from .shared_state import SHARED_LEASE_TTL, SHARED_POLL_INTERVAL, keep_alive, run_in_background, shared_state
+
+# 他のワーカーで実行された呼び出しの結果を、待っているワーカーが受け取れるように保持する秒数
+SHARED_RESULT_TTL = env_float("SHARED_RESULT_TTL", 60.0)
+
+
+class _Call:
+    """実行中の1回分の呼び出しと、その結果を待っている呼び出し元の数"""
+
+    def __init__(self, task):
+        self.task = task
+        self.waiters = 0
+        self.abandoned = False
+
+
+class SingleFlight:
+    """
+    同じキーの同時呼び出しを1回にまとめる（single-flight）
+
+    あるキーの呼び出しが実行中の間に同じキーで do を呼ぶと、新たに呼び出さずに
+    実行中の呼び出しの結果を共有します。待っている呼び出し元がすべてキャンセルされた
+    場合は、実行中の呼び出しもキャンセルします。
+
+    共有状態のバックエンドが状態サーバーの場合は、他のワーカー・ノードで同じキーの呼び出しが
+    実行中であれば、その結果（JSON にシリアライズできる値）が保存されるまで待ちます。
+    実行していたワーカーが失敗した場合は、待っていたワーカーが改めて呼び出します。
+    """
+
+    def __init__(self, backend=None, lease_ttl=SHARED_LEASE_TTL, result_ttl=SHARED_RESULT_TTL,
+                 poll_interval=SHARED_POLL_INTERVAL):
+        self.backend = backend or shared_state
+        self.lease_ttl = lease_ttl
+        self.result_ttl = result_ttl
+        self.poll_interval = poll_interval
+        self._calls = {}
+        self.leaders = 0
+        self.shared = 0
+        self.remote_shared = 0
+
+    async def do(self, key, factory):
+        """
+        key の呼び出しが実行中であればその結果を待ち、なければ factory() を実行する
+
+        Args:
+            key (str): 呼び出しを識別するキー
+            factory (callable): コルーチンを返す関数
+
+        Returns:
+            factory() の結果
+        """
+        call = self._calls.get(key)
+        if call is None or call.abandoned:
+            call = _Call(asyncio.ensure_future(self._run(key, factory)))
+            self._calls[key] = call
+            call.task.add_done_callback(lambda _: self._forget(key, call))
+            self.leaders += 1
+        else:
+            self.shared += 1
+
+        call.waiters += 1
+        try:
+            # 1つの呼び出し元がキャンセルされても、他の呼び出し元のために実行を続ける
+            return await asyncio.shield(call.task)
+        finally:
+            call.waiters -= 1
+            if call.waiters == 0 and not call.task.done():
+                call.abandoned = True
+                call.task.cancel()
+
+    async def _run(self, key, factory):
+        """factory() を実行する（状態サーバーでは他のワーカーで実行中の呼び出しの結果を待つ）"""
+        if not self.backend.shared:
+            return await factory()
+        claim_key, result_key = f"inflight:{key}", f"inflight_result:{key}"
+        holder = uuid.uuid4().hex
+        delay = 0.01
+        waited = False
+        while not await self.backend.add(claim_key, holder, self.lease_ttl):
+            waited = True
+            # 結果は実行中の印を消す前に保存されるため、印を確認してから結果を確認する
+            running = await self.backend.get(claim_key) is not None
+            result = await self.backend.get(result_key)
+            if result is not None:
+                self.remote_shared += 1
+                return result
+            if not running:
+                # 実行していたワーカーが結果を保存せずに終わった（失敗した）ため自分で呼び出す
+                continue
+            await asyncio.sleep(random.uniform(delay / 2, delay))
+            delay = min(delay * 2, self.poll_interval)
+        if waited:
+            # 待っている間に他のワーカーの呼び出しが終わった場合は、その結果を使う
+            result = await self.backend.get(result_key)
+            if result is not None:
+                self.remote_shared += 1
+                run_in_background(asyncio.get_running_loop(), lambda: self.backend.delete(claim_key, holder))
+                return result
+
+        # 実行している間は有効期限を延長し続ける（プロセスが落ちた場合は期限切れで他のワーカーが引き継ぐ）
+        renewer = asyncio.create_task(
+            keep_alive(self.lease_ttl / 3, lambda: self.backend.set(claim_key, holder, self.lease_ttl))
+        )
+        try:
+            result = await factory()
+            await self.backend.set(result_key, result, self.result_ttl)
+            return result
+        finally:
+            renewer.cancel()
+            run_in_background(asyncio.get_running_loop(), lambda: self.backend.delete(claim_key, holder))
+
+    def _forget(self, key, call):
+        if self._calls.get(key) is call:
+            del self._calls[key]
+
+    def stats(self):
+        """まとめられた呼び出し数などの統計を返す"""
+        return {
+            "in_flight": len(self._calls),
+            "leaders": self.leaders,
+            "shared": self.shared,
+            "remote_shared": self.remote_shared,
+        }
+
+
+# LLM呼び出しの single-flight（アプリ全体で共有）
+llm_single_flight = SingleFlight()
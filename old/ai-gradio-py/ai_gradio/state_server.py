@@ -0,0 +1,83 @@
+"""
+共有状態サーバー
+
+複数のワーカー・ノードで実行する場合に、キャッシュ・実行中の呼び出し・実行枠・レート制限を
+1か所で保持するサーバーです。各インスタンスの SHARED_STATE_URL にこのサーバーの URL を設定します。
+状態はメモリ上に保持するため、このサーバー自体は1プロセスで実行してください。
+ループバック以外のアドレスで待ち受ける場合は STATE_SERVER_TOKEN の設定が必要です。
+
+    python -m ai_gradio.state_server --port 7870
+    STATE_SERVER_TOKEN=... python -m ai_gradio.state_server --host 0.0.0.0 --port 7870
+"""
+import argparse
+import hmac
+import ipaddress
+import os
+
+import uvicorn
+from fastapi import FastAPI, HTTPException, Request
+
+from .config import env_int
+from .shared_state import InProcessBackend
+
+# 認証トークン（空の場合は認証しない。SHARED_STATE_TOKEN と同じ値を設定する）
+STATE_SERVER_TOKEN = os.environ.get("STATE_SERVER_TOKEN", "")
+# 待ち受けるアドレス（ループバック以外の場合は STATE_SERVER_TOKEN が必要）
+STATE_SERVER_HOST = os.environ.get("STATE_SERVER_HOST", "127.0.0.1")
+STATE_SERVER_PORT = env_int("STATE_SERVER_PORT", 7870)
+
+# HTTP で公開する InProcessBackend の操作
+STATE_OPERATIONS = ("get", "set", "add", "delete", "acquire", "release", "reserve")
+
+
+def is_loopback(host):
+    """host がループバックアドレス（localhost を含む）であれば True"""
+    if host == "localhost":
+        return True
+    try:
+        return ipaddress.ip_address(host).is_loopback
+    except ValueError:
+        return False
+
+
+def create_state_app(backend=None, token=STATE_SERVER_TOKEN):
+    """backend の操作を POST /state/{op} で公開する FastAPI アプリを生成する"""
+    backend = backend or InProcessBackend()
+    app = FastAPI()
+
+    def authorize(request):
+        if token and not hmac.compare_digest(request.headers.get("authorization", ""), f"Bearer {token}"):
+            raise HTTPException(status_code=401, detail="Unauthorized")
+
+    @app.post("/state/{op}")
+    async def state_operation(op: str, request: Request):
+        authorize(request)
+        if op not in STATE_OPERATIONS:
+            raise HTTPException(status_code=404, detail=f"Unknown operation: {op}")
+        try:
+            result = await getattr(backend, op)(**await request.json())
+        except (TypeError, ValueError) as e:
+            raise HTTPException(status_code=400, detail=str(e))
+        return {"result": result}
+
+    @app.get("/state/stats")
+    async def state_stats(request: Request):
+        authorize(request)
+        return backend.stats()
+
+    return app
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Shared state server for ai_gradio")
+    parser.add_argument("--host", default=STATE_SERVER_HOST)
+    parser.add_argument("--port", type=int, default=STATE_SERVER_PORT)
+    args = parser.parse_args(argv)
+    # 状態サーバーはキャッシュした応答や生成物を返すため、認証なしでは外部に公開しない
+    if not STATE_SERVER_TOKEN and not is_loopback(args.host):
+        parser.error(f"STATE_SERVER_TOKEN must be set to listen on a non-loopback address ({args.host})")
+    uvicorn.run(create_state_app(token=STATE_SERVER_TOKEN), host=args.host, port=args.port, log_level="warning")
+
+
+if __name__ == "__main__":
+    main()
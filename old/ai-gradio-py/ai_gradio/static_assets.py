@@ -0,0 +1,139 @@
+import argparse
+import hashlib
+import os
+import sys
+import threading
+
+from .artifacts import Artifact
+
+# 同梱するライブラリ（vendor）を置くディレクトリ
+STATIC_DIR = os.environ.get("STATIC_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), "static"))
+# 静的ファイルを配信するルートのパス（Gradio の /static と重ならないようにする）
+STATIC_ROUTE_PREFIX = "/api/static"
+# URL に含める内容のハッシュの長さ
+STATIC_VERSION_LENGTH = 16
+
+# 同梱するライブラリ: 名前 -> (STATIC_DIR からの相対パス, 内容の SHA-256)
+# ファイルはリポジトリに含めており、内容が SHA-256 と一致しないものは配信しない
+VENDOR_ASSETS = {
+    # PrismJS 1.23.0（markup・css・javascript などを含むビルド。PyPI の pywebio 1.8.4 に同梱のもの）
+    "prism.js": (
+        "vendor/prism/1.23.0/prism.min.js",
+        "746f1719be158499c1ab9bbdb52d69674f5bc5fca1e38340752bfcaebfdc4b27",
+    ),
+    # React 18.3.1 の本番用ビルド（PyPI の dash 4.4.1 に同梱のもの）
+    "react.js": (
+        "vendor/react/18.3.1/react.production.min.js",
+        "d949f1c3687aedadcedac85261865f29b17cd273997e7f6b2bfc53b2f9d4c4dd",
+    ),
+    "react-dom.js": (
+        "vendor/react-dom/18.3.1/react-dom.production.min.js",
+        "35f4f974f4b2bcd44da73963347f8952e341f83909e4498227d4e26b98f66f0d",
+    ),
+}
+
+CONTENT_TYPES = {
+    ".js": "text/javascript; charset=utf-8",
+    ".css": "text/css; charset=utf-8",
+}
+
+
+class StaticAssets:
+    """
+    同梱するライブラリの静的ファイル
+
+    URL には内容のハッシュを含めるため（/api/static/{ハッシュ}/{パス}）、配信時は長期キャッシュ
+    （immutable）を付けられます。ライブラリを更新すると URL も変わります。ファイルは最初に
+    参照された時に読み込み、SHA-256 が一致したものだけをメモリ上に保持します（ない・一致しない
+    ファイルは保持せず、次に参照された時に読み込み直します）。
+    """
+
+    def __init__(self, static_dir=STATIC_DIR, assets=None):
+        self.static_dir = static_dir
+        self.assets = dict(assets or VENDOR_ASSETS)
+        self._paths = {path: name for name, (path, _) in self.assets.items()}
+        self._loaded = {}  # name -> Artifact
+        # Gradio のハンドラと FastAPI のルートの両方から使われるためロックで保護する
+        self._lock = threading.Lock()
+
+    def file_path(self, name):
+        return os.path.join(self.static_dir, self.assets[name][0])
+
+    def load(self, name):
+        """name のファイルを返す（ない場合・SHA-256 が一致しない場合は None）"""
+        with self._lock:
+            asset = self._loaded.get(name)
+        if asset is not None:
+            return asset
+        try:
+            with open(self.file_path(name), "rb") as f:
+                content = f.read()
+        except OSError:
+            return None
+        digest = hashlib.sha256(content).hexdigest()
+        if digest != self.assets[name][1]:
+            return None
+        with self._lock:
+            return self._loaded.setdefault(name, Artifact(digest, content))
+
+    def url(self, name):
+        """
+        name のファイルの URL を返す
+
+        ファイルがない場合・SHA-256 が一致しない場合も同じ形式の URL を返します（配信時に 404 になる）。
+        """
+        path = self.assets[name][0]
+        asset = self.load(name)
+        version = asset.key[:STATIC_VERSION_LENGTH] if asset is not None else "missing"
+        return f"{STATIC_ROUTE_PREFIX}/{version}/{path}"
+
+    def get(self, version, path):
+        """
+        URL のハッシュとパスに対応するファイルを返す
+
+        Returns:
+            tuple: (Artifact, Content-Type)。ない場合・ハッシュが一致しない場合は None
+        """
+        name = self._paths.get(path)
+        if name is None:
+            return None
+        asset = self.load(name)
+        if asset is None or asset.key[:STATIC_VERSION_LENGTH] != version:
+            return None
+        return asset, CONTENT_TYPES.get(os.path.splitext(path)[1], "application/octet-stream")
+
+    def missing(self):
+        """ない・SHA-256 が一致しないファイルの名前"""
+        return [name for name in self.assets if self.load(name) is None]
+
+    def stats(self):
+        assets = {}
+        for name, (path, _) in self.assets.items():
+            asset = self.load(name)
+            assets[name] = {
+                "path": path,
+                "bytes": asset.size if asset is not None else None,
+                "url": self.url(name),
+            }
+        return {"dir": self.static_dir, "assets": assets}
+
+
+# アプリ全体で共有する静的ファイル
+static_assets = StaticAssets()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Vendored static assets for ai_gradio")
+    parser.add_argument("command", choices=("check",),
+                        help="check: ない・SHA-256 が一致しないファイルがあれば終了コード 1")
+    parser.parse_args(argv)
+
+    missing = static_assets.missing()
+    for name in missing:
+        print(f"missing or modified {name}: {static_assets.file_path(name)}")
+    if missing:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
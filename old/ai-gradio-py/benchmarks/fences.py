@@ -0,0 +1,129 @@
+"""
+コードブロックの取り出しのマイクロベンチマーク
+
+大きな応答（HTML のコードブロックを含む）から、正規表現でコードを取り出す従来の方法と
+ai_gradio.fences のパーサーを比較します。
+
+- final_*: 応答全体を受信した後にコードを取り出す（プレビュー用の置換も含む）
+- stream_*: トークンを受信するたびに、受信済みの応答から取り出したコードを更新する
+
+    python -m benchmarks.fences --size-kb 64 --runs 5 --output fences.json
+    python -m benchmarks.fences --baseline fences.json --max-regression 0.2
+"""
+import argparse
+import re
+import sys
+import time
+
+from ai_gradio.fences import CodeExtractor, extract_code
+
+from .stats import check_baseline, format_result, save_results, summarize
+
+# 1行分の HTML（応答のコードブロックの中身を繰り返しで組み立てる）
+HTML_LINE = '    <div class="item"><span>Item {index}</span><button onclick="select({index})">Select</button></div>\n'
+
+
+def legacy_remove_code_block(text):
+    """従来の integrated_gradio.remove_code_block（比較用）"""
+    match = re.search(r'```(?:html)?\n(.+?)\n```', text, re.DOTALL)
+    if match:
+        return match.group(1).strip()
+    return text.strip()
+
+
+def legacy_extract(text):
+    # 従来は send_to_preview でもフェンスを除去するため文字列全体を置換していた
+    return legacy_remove_code_block(text).replace("```html", "").replace("```", "").strip()
+
+
+def build_response(size_kb):
+    """前後に説明文があり、size_kb 程度の HTML のコードブロックを含む応答"""
+    lines = []
+    size = 0
+    while size < size_kb * 1024:
+        line = HTML_LINE.format(index=len(lines))
+        lines.append(line)
+        size += len(line)
+    return (
+        "Here is the web application you asked for.\n\n"
+        "```html\n<!DOCTYPE html>\n<html>\n<head><title>Items</title></head>\n<body>\n"
+        + "".join(lines)
+        + "</body>\n</html>\n```\n\nOpen it in your browser to try it.\n"
+    )
+
+
+def tokenize(text, token_size):
+    return [text[i:i + token_size] for i in range(0, len(text), token_size)]
+
+
+def run_final(extract, text):
+    return extract(text)
+
+
+def run_stream_legacy(tokens):
+    # 受信するたびに受信済みの応答全体から取り出し直す
+    text = ""
+    code = ""
+    for token in tokens:
+        text += token
+        code = legacy_remove_code_block(text)
+    return code
+
+
+def run_stream_parser(tokens):
+    extractor = CodeExtractor(("html",))
+    for token in tokens:
+        extractor.feed(token)
+    extractor.close()
+    return extractor.code
+
+
+def run_scenario(name, runs, call, size):
+    latencies = []
+    started = time.perf_counter()
+    for _ in range(runs):
+        call_started = time.perf_counter()
+        call()
+        latencies.append(time.perf_counter() - call_started)
+    elapsed = time.perf_counter() - started
+    return summarize(name, latencies, elapsed, {"ok": runs}, response_bytes=size)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Code fence extraction benchmark for ai_gradio")
+    parser.add_argument("--size-kb", type=int, default=64, help="応答のコードブロックの大きさ（KB）")
+    parser.add_argument("--token-size", type=int, default=16, help="ストリーミングの1トークンの文字数")
+    parser.add_argument("--runs", type=int, default=5, help="シナリオ毎の計測回数")
+    parser.add_argument("--output", help="結果を JSON で保存するパス")
+    parser.add_argument("--baseline", help="比較するベースラインの結果（JSON）")
+    parser.add_argument("--max-regression", type=float, default=0.2, help="許容する p95/p99 の悪化の割合")
+    args = parser.parse_args(argv)
+
+    text = build_response(args.size_kb)
+    tokens = tokenize(text, args.token_size)
+    # 比較する前に両者が同じコードを取り出すことを確認する
+    if legacy_extract(text) != extract_code(text, ("html",)):
+        raise RuntimeError("legacy and parser extraction results differ")
+
+    scenarios = {
+        "fences_final_legacy": lambda: run_final(legacy_extract, text),
+        "fences_final_parser": lambda: run_final(lambda t: extract_code(t, ("html",)), text),
+        "fences_stream_legacy": lambda: run_stream_legacy(tokens),
+        "fences_stream_parser": lambda: run_stream_parser(tokens),
+    }
+    results = []
+    for name, call in scenarios.items():
+        result = run_scenario(name, args.runs, call, len(text))
+        print(format_result(result), flush=True)
+        results.append(result)
+
+    if args.output:
+        save_results(args.output, results, {
+            "size_kb": args.size_kb, "token_size": args.token_size, "runs": args.runs,
+        })
+    if args.baseline and not check_baseline(results, args.baseline, args.max_regression):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,355 @@
+"""
+ベンチマーク用のモックサーバー
+
+OpenAI 互換（OpenAI / DeepSeek）、Anthropic、Gemini、Kroki のエンドポイントを1つのアプリで
+提供します。応答までの待ち時間・ストリーミングの速度・エラーの発生率は provider 毎に設定でき、
+実行中でも POST /_profile で変更できます。一度送られたシステムプロンプトは以降プロンプトキャッシュから
+読み込んだものとして、各 provider の形式で usage に含めます。
+
+    python -m benchmarks.mock_servers --port 8900 --latency 0.5 --tokens-per-second 200
+
+アプリ側は以下の環境変数でモックサーバーに向けます（benchmarks.run は自動で設定します）。
+
+    OPENAI_BASE_URL=http://127.0.0.1:8900/openai/v1
+    DEEPSEEK_BASE_URL=http://127.0.0.1:8900/deepseek/v1
+    ANTHROPIC_BASE_URL=http://127.0.0.1:8900/anthropic
+    GEMINI_BASE_URL=http://127.0.0.1:8900/gemini
+    KROKI_URL=http://127.0.0.1:8900/kroki
+"""
+import argparse
+import asyncio
+import json
+import random
+import time
+import uuid
+from dataclasses import asdict, dataclass, fields
+
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, PlainTextResponse, StreamingResponse
+
+PROVIDERS = ("openai", "deepseek", "anthropic", "gemini", "kroki")
+
+
+@dataclass
+class Profile:
+    """provider 毎の応答の振る舞い"""
+
+    # 最初の応答（ストリーミングの場合は最初のトークン）までの待ち時間（秒）と、そのゆらぎ（±秒）
+    latency: float = 0.5
+    jitter: float = 0.1
+    # ストリーミング時の1秒あたりのトークン数（0 の場合は待たずに送る）
+    tokens_per_second: float = 200.0
+    # 応答のトークン数
+    response_tokens: int = 400
+    # エラーを返す割合（0.0〜1.0）と、その HTTP ステータス・Retry-After（秒）
+    error_rate: float = 0.0
+    error_status: int = 503
+    retry_after: float = 1.0
+
+    def delay(self):
+        return max(0.0, self.latency + random.uniform(-self.jitter, self.jitter))
+
+    def should_fail(self):
+        return self.error_rate > 0 and random.random() < self.error_rate
+
+
+def make_tokens(count):
+    """```html で囲まれた HTML アプリを count 個のトークンに分けて返す"""
+    body = [f"<p>item {i}</p> " for i in range(max(0, count - 2))]
+    return ["```html\n<!DOCTYPE html><html><body>"] + body + ["</body></html>\n```"]
+
+
+def count_prompt_tokens(payload):
+    # 実際のトークナイザは使わず、おおよそ4文字を1トークンとみなす
+    return max(1, len(json.dumps(payload, ensure_ascii=False)) // 4)
+
+
+def create_app(profiles=None):
+    """モックサーバーの FastAPI アプリを生成する"""
+    app = FastAPI()
+    app.state.profiles = {provider: Profile() for provider in PROVIDERS}
+    app.state.profiles.update(profiles or {})
+    app.state.requests = {provider: 0 for provider in PROVIDERS}
+    # provider 毎に送られたことのあるシステムプロンプト（プロンプトキャッシュの代わり）
+    app.state.cached_prompts = set()
+
+    def profile_for(provider):
+        app.state.requests[provider] += 1
+        return app.state.profiles[provider]
+
+    def prompt_cache(provider, prompt):
+        """(prompt のトークン数, キャッシュ済みだったか) を返し、prompt をキャッシュ済みにする"""
+        if not prompt:
+            return 0, False
+        key = (provider, json.dumps(prompt, sort_keys=True, ensure_ascii=False))
+        cached = key in app.state.cached_prompts
+        app.state.cached_prompts.add(key)
+        return count_prompt_tokens(prompt), cached
+
+    def error_response(provider, profile):
+        headers = {"Retry-After": f"{profile.retry_after:g}"}
+        message = f"Mock {provider} error ({profile.error_status})"
+        if provider == "anthropic":
+            content = {"type": "error", "error": {"type": "overloaded_error", "message": message}}
+        elif provider == "gemini":
+            content = {"error": {"code": profile.error_status, "message": message, "status": "UNAVAILABLE"}}
+        else:
+            content = {"error": {"message": message, "type": "server_error", "code": None}}
+        return JSONResponse(content, status_code=profile.error_status, headers=headers)
+
+    async def stream_tokens(profile, tokens, render):
+        """トークンを tokens_per_second の速さで送る SSE ストリーム"""
+        interval = 1.0 / profile.tokens_per_second if profile.tokens_per_second > 0 else 0.0
+        await asyncio.sleep(profile.delay())
+        for index, token in enumerate(tokens):
+            if interval and index:
+                await asyncio.sleep(interval)
+            for event in render(index, token):
+                yield event
+
+    # --- OpenAI 互換 (OpenAI / DeepSeek) ---
+
+    async def chat_completions(provider, request):
+        payload = await request.json()
+        profile = profile_for(provider)
+        if profile.should_fail():
+            await asyncio.sleep(profile.delay())
+            return error_response(provider, profile)
+
+        model = payload.get("model", "mock")
+        tokens = make_tokens(profile.response_tokens)
+        messages = payload.get("messages") or []
+        prompt_tokens = count_prompt_tokens(messages)
+        system = messages[0] if messages and messages[0].get("role") == "system" else None
+        system_tokens, cached = prompt_cache(provider, system)
+        completion_id = f"chatcmpl-{uuid.uuid4().hex[:12]}"
+        created = int(time.time())
+        usage = {
+            "prompt_tokens": prompt_tokens,
+            "completion_tokens": len(tokens),
+            "total_tokens": prompt_tokens + len(tokens),
+            "prompt_tokens_details": {"cached_tokens": system_tokens if cached else 0},
+        }
+
+        if not payload.get("stream"):
+            await asyncio.sleep(profile.delay())
+            return {
+                "id": completion_id,
+                "object": "chat.completion",
+                "created": created,
+                "model": model,
+                "choices": [{
+                    "index": 0,
+                    "message": {"role": "assistant", "content": "".join(tokens)},
+                    "finish_reason": "stop",
+                }],
+                "usage": usage,
+            }
+
+        def chunk(choices, **extra):
+            data = {"id": completion_id, "object": "chat.completion.chunk", "created": created,
+                    "model": model, "choices": choices, **extra}
+            return f"data: {json.dumps(data)}\n\n"
+
+        def render(index, token):
+            yield chunk([{"index": 0, "delta": {"content": token}, "finish_reason": None}])
+            if index == len(tokens) - 1:
+                yield chunk([{"index": 0, "delta": {}, "finish_reason": "stop"}])
+                if (payload.get("stream_options") or {}).get("include_usage"):
+                    yield chunk([], usage=usage)
+                yield "data: [DONE]\n\n"
+
+        return StreamingResponse(stream_tokens(profile, tokens, render), media_type="text/event-stream")
+
+    @app.post("/openai/v1/chat/completions")
+    async def openai_chat(request: Request):
+        return await chat_completions("openai", request)
+
+    @app.post("/deepseek/v1/chat/completions")
+    async def deepseek_chat(request: Request):
+        return await chat_completions("deepseek", request)
+
+    # --- Anthropic ---
+
+    @app.post("/anthropic/v1/messages")
+    async def anthropic_messages(request: Request):
+        payload = await request.json()
+        profile = profile_for("anthropic")
+        if profile.should_fail():
+            await asyncio.sleep(profile.delay())
+            return error_response("anthropic", profile)
+
+        model = payload.get("model", "mock")
+        tokens = make_tokens(profile.response_tokens)
+        # input_tokens はキャッシュの読み込み・書き込み分を含まない（cache_control を付けたシステムプロンプトのみキャッシュする）
+        input_tokens = count_prompt_tokens(payload.get("messages"))
+        system = payload.get("system")
+        usage = {"input_tokens": input_tokens, "cache_creation_input_tokens": 0, "cache_read_input_tokens": 0}
+        if isinstance(system, list) and any("cache_control" in block for block in system):
+            system_tokens, cached = prompt_cache("anthropic", system)
+            usage["cache_read_input_tokens" if cached else "cache_creation_input_tokens"] = system_tokens
+        elif system:
+            usage["input_tokens"] += count_prompt_tokens(system)
+        message_id = f"msg_{uuid.uuid4().hex[:12]}"
+
+        if not payload.get("stream"):
+            await asyncio.sleep(profile.delay())
+            return {
+                "id": message_id,
+                "type": "message",
+                "role": "assistant",
+                "model": model,
+                "content": [{"type": "text", "text": "".join(tokens)}],
+                "stop_reason": "end_turn",
+                "stop_sequence": None,
+                "usage": dict(usage, output_tokens=len(tokens)),
+            }
+
+        def event(name, data):
+            return f"event: {name}\ndata: {json.dumps(data)}\n\n"
+
+        def render(index, token):
+            if index == 0:
+                yield event("message_start", {"type": "message_start", "message": {
+                    "id": message_id, "type": "message", "role": "assistant", "model": model, "content": [],
+                    "stop_reason": None, "stop_sequence": None,
+                    "usage": dict(usage, output_tokens=1),
+                }})
+                yield event("content_block_start", {
+                    "type": "content_block_start", "index": 0, "content_block": {"type": "text", "text": ""},
+                })
+            yield event("content_block_delta", {
+                "type": "content_block_delta", "index": 0, "delta": {"type": "text_delta", "text": token},
+            })
+            if index == len(tokens) - 1:
+                yield event("content_block_stop", {"type": "content_block_stop", "index": 0})
+                yield event("message_delta", {
+                    "type": "message_delta", "delta": {"stop_reason": "end_turn", "stop_sequence": None},
+                    "usage": {"output_tokens": len(tokens)},
+                })
+                yield event("message_stop", {"type": "message_stop"})
+
+        return StreamingResponse(stream_tokens(profile, tokens, render), media_type="text/event-stream")
+
+    # --- Gemini ---
+
+    @app.post("/gemini/v1beta/models/{model_action}")
+    async def gemini_generate(model_action: str, request: Request):
+        payload = await request.json()
+        profile = profile_for("gemini")
+        if profile.should_fail():
+            await asyncio.sleep(profile.delay())
+            return error_response("gemini", profile)
+
+        _, action = model_action.rsplit(":", 1)
+        tokens = make_tokens(profile.response_tokens)
+        system_tokens, cached = prompt_cache("gemini", payload.get("systemInstruction"))
+        prompt_tokens = count_prompt_tokens(payload.get("contents")) + system_tokens
+
+        def response(text, candidates_tokens, finished):
+            candidate = {"content": {"role": "model", "parts": [{"text": text}]}, "index": 0}
+            if finished:
+                candidate["finishReason"] = "STOP"
+            return {
+                "candidates": [candidate],
+                "usageMetadata": {
+                    "promptTokenCount": prompt_tokens,
+                    "cachedContentTokenCount": system_tokens if cached else 0,
+                    "candidatesTokenCount": candidates_tokens,
+                    "totalTokenCount": prompt_tokens + candidates_tokens,
+                },
+            }
+
+        if action == "generateContent":
+            await asyncio.sleep(profile.delay())
+            return response("".join(tokens), len(tokens), True)
+
+        def render(index, token):
+            data = response(token, index + 1, index == len(tokens) - 1)
+            yield f"data: {json.dumps(data)}\r\n\r\n"
+
+        return StreamingResponse(stream_tokens(profile, tokens, render), media_type="text/event-stream")
+
+    # --- Kroki ---
+
+    @app.post("/kroki/{diagram_type}/svg")
+    async def kroki_svg(diagram_type: str, request: Request):
+        source = (await request.body()).decode("utf-8")
+        profile = profile_for("kroki")
+        await asyncio.sleep(profile.delay())
+        if profile.should_fail():
+            return PlainTextResponse("Mock kroki error", status_code=profile.error_status)
+        lines = len(source.splitlines())
+        return PlainTextResponse(
+            f'<svg xmlns="http://www.w3.org/2000/svg" width="200" height="{20 * lines}">'
+            f'<text x="10" y="20">{diagram_type}: {lines} lines</text></svg>',
+            media_type="image/svg+xml",
+        )
+
+    # --- 設定・統計 ---
+
+    @app.get("/_profile")
+    async def get_profiles():
+        return {
+            "profiles": {provider: asdict(profile) for provider, profile in app.state.profiles.items()},
+            "requests": app.state.requests,
+        }
+
+    @app.post("/_profile")
+    async def update_profile(request: Request):
+        """{"provider": "openai", "latency": 1.0, ...}（provider を省略した場合はすべての provider）"""
+        payload = await request.json()
+        provider = payload.pop("provider", None)
+        names = {field.name for field in fields(Profile)}
+        for target in ([provider] if provider else PROVIDERS):
+            profile = app.state.profiles[target]
+            for key, value in payload.items():
+                if key in names:
+                    setattr(profile, key, type(getattr(profile, key))(value))
+        return await get_profiles()
+
+    return app
+
+
+def add_profile_arguments(parser):
+    """Profile の各項目をコマンドライン引数として追加する"""
+    defaults = Profile()
+    parser.add_argument("--latency", type=float, default=defaults.latency)
+    parser.add_argument("--jitter", type=float, default=defaults.jitter)
+    parser.add_argument("--tokens-per-second", type=float, default=defaults.tokens_per_second)
+    parser.add_argument("--response-tokens", type=int, default=defaults.response_tokens)
+    parser.add_argument("--error-rate", type=float, default=defaults.error_rate)
+    parser.add_argument("--error-status", type=int, default=defaults.error_status)
+    parser.add_argument("--retry-after", type=float, default=defaults.retry_after)
+    parser.add_argument("--kroki-latency", type=float, default=0.05)
+
+
+def profiles_from_args(args):
+    profile = Profile(
+        latency=args.latency,
+        jitter=args.jitter,
+        tokens_per_second=args.tokens_per_second,
+        response_tokens=args.response_tokens,
+        error_rate=args.error_rate,
+        error_status=args.error_status,
+        retry_after=args.retry_after,
+    )
+    profiles = {provider: Profile(**asdict(profile)) for provider in PROVIDERS}
+    profiles["kroki"] = Profile(latency=args.kroki_latency, jitter=args.kroki_latency / 5,
+                                error_rate=args.error_rate, error_status=args.error_status)
+    return profiles
+
+
+def main():
+    import uvicorn
+
+    parser = argparse.ArgumentParser(description="Mock OpenAI/Anthropic/Gemini/Kroki server for benchmarks")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8900)
+    add_profile_arguments(parser)
+    args = parser.parse_args()
+    uvicorn.run(create_app(profiles_from_args(args)), host=args.host, port=args.port, log_level="warning")
+
+
+if __name__ == "__main__":
+    main()
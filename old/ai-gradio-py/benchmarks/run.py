@@ -0,0 +1,311 @@
+"""
+オフラインのベンチマーク・負荷試験
+
+モックサーバー（benchmarks.mock_servers）を起動し、ai_gradio の生成処理・/api/llm・Kroki 描画に
+負荷をかけて p50/p95/p99 レイテンシ・スループット・メモリを出力します。実際の API は呼び出しません。
+
+    python -m benchmarks.run --scenario generate --users 8 --fanout 4
+    python -m benchmarks.run --scenario all --output results.json
+    python -m benchmarks.run --scenario all --baseline results.json --max-regression 0.2
+
+--baseline を指定すると、p95/p99 が --max-regression を超えて悪化したシナリオがある場合に
+終了コード 1 で終了します（デプロイ前のチェック用）。
+"""
+import argparse
+import asyncio
+import os
+import subprocess
+import sys
+import time
+from collections import Counter
+
+from .mock_servers import add_profile_arguments
+from .stats import check_baseline, format_result, percentile, save_results, summarize
+
+SCENARIOS = ("generate", "stream", "llm_api", "llm_api_burst", "kroki", "ui")
+
+QUERY = "ToDoリストを管理できるWebアプリを作成してください（ベンチマーク {index}）"
+MERMAID_SOURCE = "graph TD\n  A[Start] --> B{{Check {index}}}\n  B -->|Yes| C[OK]\n  B -->|No| D[Retry]"
+
+
+def configure_environment(mock_url, args):
+    """ai_gradio を import する前に、各 provider の接続先をモックサーバーに向ける"""
+    os.environ.update({
+        "OPENAI_BASE_URL": f"{mock_url}/openai/v1",
+        "DEEPSEEK_BASE_URL": f"{mock_url}/deepseek/v1",
+        "ANTHROPIC_BASE_URL": f"{mock_url}/anthropic",
+        "GEMINI_BASE_URL": f"{mock_url}/gemini",
+        "KROKI_URL": f"{mock_url}/kroki",
+        "OPENAI_API_KEY": "mock",
+        "DEEPSEEK_API_KEY": "mock",
+        "ANTHROPIC_API_KEY": "mock",
+        "GEMINI_API_KEY": "mock",
+        # キャッシュや履歴で provider の呼び出しが省略されないようにする（--cache で有効）
+        "RESPONSE_CACHE_ENABLED": "true" if args.cache else "false",
+        "RESPONSE_CACHE_DIR": "",
+        "KROKI_CACHE_DIR": "",
+        "ARTIFACT_STORE_DIR": "",
+        "HISTORY_ENABLED": "false",
+        "LOG_LEVEL": os.environ.get("LOG_LEVEL", "WARNING"),
+    })
+
+
+async def start_mock_server(args):
+    """モックサーバーを別プロセスで起動し、応答するまで待つ"""
+    import httpx
+
+    command = [
+        sys.executable, "-m", "benchmarks.mock_servers", "--port", str(args.mock_port),
+        "--latency", str(args.latency), "--jitter", str(args.jitter),
+        "--tokens-per-second", str(args.tokens_per_second), "--response-tokens", str(args.response_tokens),
+        "--error-rate", str(args.error_rate), "--error-status", str(args.error_status),
+        "--retry-after", str(args.retry_after), "--kroki-latency", str(args.kroki_latency),
+    ]
+    process = subprocess.Popen(command, cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    url = f"http://127.0.0.1:{args.mock_port}"
+    async with httpx.AsyncClient() as client:
+        for _ in range(100):
+            try:
+                await client.get(f"{url}/_profile")
+                return process, url
+            except httpx.HTTPError:
+                await asyncio.sleep(0.1)
+    process.terminate()
+    raise RuntimeError("Mock server did not start")
+
+
+async def run_users(users, requests_per_user, request):
+    """users 人が requests_per_user 回ずつ順番に request(index) を実行する"""
+    latencies, statuses = [], Counter()
+
+    async def user(user_index):
+        for i in range(requests_per_user):
+            index = user_index * requests_per_user + i
+            started = time.perf_counter()
+            status = await request(index)
+            statuses[status] += 1
+            if status in ("ok", 200):
+                latencies.append(time.perf_counter() - started)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(user(u) for u in range(users)))
+    return latencies, statuses, time.perf_counter() - started
+
+
+async def scenario_generate(args, stream=False):
+    """generate_parallel（stream の場合は generate_parallel_stream）に users 人で負荷をかける"""
+    from ai_gradio import integrated_gradio as ig
+
+    models = ig.INTEGRATED_MODELS[:args.fanout]
+
+    async def request(index):
+        query = QUERY.format(index=index)
+        try:
+            if stream:
+                async for _ in ig.generate_parallel_stream(query, models, ig.DEFAULT_WEBAPP_SYSTEM_PROMPT,
+                                                           "Web App", use_cache=args.cache):
+                    pass
+            else:
+                await ig.generate_parallel(query, models, ig.DEFAULT_WEBAPP_SYSTEM_PROMPT, "Web App",
+                                           use_cache=args.cache)
+        except Exception as e:
+            return type(e).__name__
+        return "ok"
+
+    latencies, statuses, elapsed = await run_users(args.users, args.requests, request)
+    name = "stream" if stream else "generate"
+    return summarize(name, latencies, elapsed, statuses, fanout=len(models), users=args.users)
+
+
+def api_client(args):
+    """/api/llm を呼び出すクライアント（--app-url がなければプロセス内のアプリを直接呼び出す）"""
+    import httpx
+
+    timeout = httpx.Timeout(600.0)
+    if args.app_url:
+        return httpx.AsyncClient(base_url=args.app_url, timeout=timeout)
+    from ai_gradio.api_llm import app
+
+    return httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://app", timeout=timeout)
+
+
+async def post_llm(client, index, args):
+    response = await client.post("/api/llm", json={
+        "prompt": QUERY.format(index=index),
+        "model": args.api_model,
+        "use_cache": args.cache,
+    })
+    return response.status_code
+
+
+async def scenario_llm_api(args):
+    """/api/llm に users 人が連続してリクエストする"""
+    async with api_client(args) as client:
+        latencies, statuses, elapsed = await run_users(
+            args.users, args.requests, lambda index: post_llm(client, index, args)
+        )
+    return summarize("llm_api", latencies, elapsed, statuses, users=args.users)
+
+
+async def run_burst(client, args, offset=0):
+    """args.burst 件のリクエストを同時に送る"""
+    latencies, statuses = [], Counter()
+
+    async def request(index):
+        started = time.perf_counter()
+        status = await post_llm(client, offset + index, args)
+        statuses[status] += 1
+        if status == 200:
+            latencies.append(time.perf_counter() - started)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(request(i) for i in range(args.burst)))
+    return latencies, statuses, time.perf_counter() - started
+
+
+async def scenario_llm_api_burst(args):
+    """/api/llm に args.burst 件を同時に送り、429/503 による負荷制限の挙動を見る"""
+    async with api_client(args) as client:
+        latencies, statuses, elapsed = await run_burst(client, args)
+    return summarize("llm_api_burst", latencies, elapsed, statuses, burst=args.burst)
+
+
+async def scenario_kroki(args):
+    """Kroki の描画（重複のない図）を users 並列で行い、続けて同じ図を再描画してキャッシュを確認する"""
+    from ai_gradio.kroki import kroki_renderer
+
+    total = args.users * args.requests
+    sources = [MERMAID_SOURCE.format(index=i) for i in range(total)]
+    statuses = Counter()
+    latencies = []
+    semaphore = asyncio.Semaphore(args.users)
+
+    async def render(source):
+        async with semaphore:
+            started = time.perf_counter()
+            try:
+                await kroki_renderer.render(source, "mermaid")
+            except Exception as e:
+                statuses[type(e).__name__] += 1
+                return
+            statuses["ok"] += 1
+            latencies.append(time.perf_counter() - started)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(render(source) for source in sources))
+    elapsed = time.perf_counter() - started
+
+    cached_started = time.perf_counter()
+    await asyncio.gather(*(kroki_renderer.render(source, "mermaid") for source in sources))
+    cached_elapsed = time.perf_counter() - cached_started
+    return summarize("kroki", latencies, elapsed, statuses, cached_pass_seconds=cached_elapsed)
+
+
+async def scenario_ui(args):
+    """
+    /api/llm を飽和させた状態で、同じイベントループ上の軽いリクエストの応答時間を測る
+
+    Gradio の UI は /api/llm と同じプロセス・イベントループで動くため、負荷中も軽いリクエストと
+    イベントループの遅延が小さいままであれば、UI の応答性が保たれていることを示します。
+    """
+    probe_latencies, loop_lags = [], []
+    done = asyncio.Event()
+
+    async def probe(client):
+        while not done.is_set():
+            started = time.perf_counter()
+            await client.get("/api/llm/stats")
+            probe_latencies.append(time.perf_counter() - started)
+            await asyncio.sleep(0.05)
+
+    async def measure_loop_lag():
+        interval = 0.01
+        while not done.is_set():
+            started = time.perf_counter()
+            await asyncio.sleep(interval)
+            loop_lags.append(max(0.0, time.perf_counter() - started - interval))
+
+    async with api_client(args) as client:
+        background = [asyncio.create_task(probe(client)), asyncio.create_task(measure_loop_lag())]
+        try:
+            # 2回続けてバーストを送り、待ち行列が溢れる状態を作る
+            first = await run_burst(client, args)
+            second = await run_burst(client, args, offset=args.burst)
+        finally:
+            done.set()
+            await asyncio.gather(*background)
+
+    latencies = first[0] + second[0]
+    statuses = first[1] + second[1]
+    return summarize(
+        "ui", latencies, first[2] + second[2], statuses,
+        probe_p50=percentile(probe_latencies, 50),
+        probe_p99=percentile(probe_latencies, 99),
+        loop_lag_p99=percentile(loop_lags, 99),
+    )
+
+
+SCENARIO_FUNCTIONS = {
+    "generate": lambda args: scenario_generate(args),
+    "stream": lambda args: scenario_generate(args, stream=True),
+    "llm_api": scenario_llm_api,
+    "llm_api_burst": scenario_llm_api_burst,
+    "kroki": scenario_kroki,
+    "ui": scenario_ui,
+}
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Offline benchmarks for ai_gradio with mock providers")
+    parser.add_argument("--scenario", action="append", choices=SCENARIOS + ("all",),
+                        help="実行するシナリオ（複数指定可。省略時は all）")
+    parser.add_argument("--users", type=int, default=4, help="同時ユーザー数")
+    parser.add_argument("--requests", type=int, default=3, help="ユーザーあたりのリクエスト数")
+    parser.add_argument("--fanout", type=int, default=3, help="1リクエストで並列に呼び出すモデル数")
+    parser.add_argument("--burst", type=int, default=100, help="バーストで同時に送るリクエスト数")
+    parser.add_argument("--api-model", default="gemini:gemini-2.0-flash", help="/api/llm で使うモデル")
+    parser.add_argument("--cache", action="store_true", help="応答キャッシュを有効にする")
+    parser.add_argument("--mock-url", help="起動済みのモックサーバーの URL（省略時は起動する）")
+    parser.add_argument("--mock-port", type=int, default=8900)
+    parser.add_argument("--app-url", help="起動済みのアプリの URL（省略時はプロセス内のアプリを呼び出す）")
+    parser.add_argument("--output", help="結果を JSON で保存するパス")
+    parser.add_argument("--baseline", help="比較するベースラインの結果（JSON）")
+    parser.add_argument("--max-regression", type=float, default=0.2, help="許容する p95/p99 の悪化の割合")
+    add_profile_arguments(parser)
+    args = parser.parse_args(argv)
+    scenarios = args.scenario or ["all"]
+    args.scenario = list(SCENARIOS) if "all" in scenarios else scenarios
+    return args
+
+
+async def run(args):
+    process = None
+    mock_url = args.mock_url
+    if not mock_url:
+        process, mock_url = await start_mock_server(args)
+    configure_environment(mock_url, args)
+    results = []
+    try:
+        for name in args.scenario:
+            result = await SCENARIO_FUNCTIONS[name](args)
+            print(format_result(result), flush=True)
+            results.append(result)
+    finally:
+        if process is not None:
+            process.terminate()
+            process.wait()
+    return results
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    results = asyncio.run(run(args))
+    settings = {key: value for key, value in vars(args).items() if key not in ("output", "baseline")}
+    if args.output:
+        save_results(args.output, results, settings)
+    if args.baseline and not check_baseline(results, args.baseline, args.max_regression):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,160 @@
+"""
+起動時間のベンチマーク
+
+新しいプロセスで ai_gradio の import 時間と、python -m ai_gradio が応答できるようになるまでの
+時間（ready-to-serve）を計測します。オートスケールで追加したコンテナが使えるようになるまでの
+時間に相当します。
+
+    python -m benchmarks.startup --runs 5 --output startup.json
+    python -m benchmarks.startup --runs 5 --baseline startup.json --max-regression 0.2
+"""
+import argparse
+import json
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+from .stats import check_baseline, format_result, save_results, summarize
+
+PROJECT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# 起動時に読み込まれていないことを確認する重いモジュール
+HEAVY_MODULES = ("gradio", "openai", "anthropic", "modelscope_studio", "torch", "transformers", "requests")
+
+# 新しいプロセスで statement を実行し、所要時間と読み込まれた重いモジュールを出力するスクリプト
+IMPORT_SCRIPT = """
+import json, sys, time
+started = time.perf_counter()
+{statement}
+seconds = time.perf_counter() - started
+with open("/proc/self/status") as f:
+    rss = next((int(line.split()[1]) / 1024 for line in f if line.startswith("VmRSS:")), 0.0)
+print(json.dumps({{
+    "seconds": seconds,
+    "rss_mb": rss,
+    "modules": [name for name in {heavy_modules!r} if name in sys.modules],
+}}))
+"""
+
+STATEMENTS = {
+    # /api/llm と生成処理のみ（UI を構築しない）
+    "import_api": "import ai_gradio.api_llm",
+    # UI を含むアプリ全体の構築
+    "import_app": "from ai_gradio.__main__ import create_app; create_app()",
+}
+
+
+def child_env():
+    """計測用のプロセスの環境変数（ログ・履歴は一時ディレクトリに出力する）"""
+    env = dict(os.environ)
+    workdir = tempfile.mkdtemp(prefix="ai_gradio_startup_")
+    env.update({
+        "LOG_DIR": os.path.join(workdir, "logs"),
+        "HISTORY_DB_PATH": os.path.join(workdir, "history.db"),
+        "LOG_LEVEL": "WARNING",
+        "PYTHONDONTWRITEBYTECODE": "1",
+    })
+    return env
+
+
+def measure_import(statement):
+    script = IMPORT_SCRIPT.format(statement=statement, heavy_modules=HEAVY_MODULES)
+    output = subprocess.run(
+        [sys.executable, "-c", script], cwd=PROJECT_DIR, env=child_env(),
+        capture_output=True, text=True, check=True,
+    ).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def process_rss_mb(pid):
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return 0.0
+
+
+def measure_ready(timeout):
+    """python -m ai_gradio を起動し、UI（/）が 200 を返すまでの秒数を計測する"""
+    import httpx
+
+    port = free_port()
+    env = child_env()
+    env.update({"HOST": "127.0.0.1", "PORT": str(port)})
+    started = time.perf_counter()
+    process = subprocess.Popen(
+        [sys.executable, "-m", "ai_gradio"], cwd=PROJECT_DIR, env=env,
+        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+    )
+    try:
+        while time.perf_counter() - started < timeout:
+            if process.poll() is not None:
+                raise RuntimeError(f"python -m ai_gradio exited with {process.returncode}")
+            try:
+                if httpx.get(f"http://127.0.0.1:{port}/", timeout=1.0).status_code == 200:
+                    return {"seconds": time.perf_counter() - started, "rss_mb": process_rss_mb(process.pid)}
+            except httpx.HTTPError:
+                pass
+            time.sleep(0.05)
+        raise RuntimeError(f"python -m ai_gradio was not ready within {timeout}s")
+    finally:
+        process.terminate()
+        process.wait()
+
+
+def run_scenario(name, runs, timeout):
+    measurements = []
+    started = time.perf_counter()
+    for _ in range(runs):
+        if name == "ready":
+            measurements.append(measure_ready(timeout))
+        else:
+            measurements.append(measure_import(STATEMENTS[name]))
+    elapsed = time.perf_counter() - started
+    # メモリは計測したプロセスの値（ベンチマーク自体のプロセスではない）
+    rss = max(m["rss_mb"] for m in measurements)
+    extra = {"rss_mb": rss, "peak_rss_mb": rss}
+    if "modules" in measurements[-1]:
+        extra["heavy_modules"] = measurements[-1]["modules"]
+    return summarize(f"startup_{name}", [m["seconds"] for m in measurements], elapsed, {"ok": runs}, **extra)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Startup time benchmark for ai_gradio")
+    parser.add_argument("--scenario", action="append", choices=tuple(STATEMENTS) + ("ready",),
+                        help="実行するシナリオ（複数指定可。省略時はすべて）")
+    parser.add_argument("--runs", type=int, default=3, help="シナリオ毎の計測回数")
+    parser.add_argument("--timeout", type=float, default=120.0, help="起動を待つ時間の上限（秒）")
+    parser.add_argument("--output", help="結果を JSON で保存するパス")
+    parser.add_argument("--baseline", help="比較するベースラインの結果（JSON）")
+    parser.add_argument("--max-regression", type=float, default=0.2, help="許容する p95/p99 の悪化の割合")
+    args = parser.parse_args(argv)
+
+    results = []
+    for name in args.scenario or list(STATEMENTS) + ["ready"]:
+        result = run_scenario(name, args.runs, args.timeout)
+        print(format_result(result), flush=True)
+        if result.get("heavy_modules"):
+            print(f"  heavy modules loaded: {', '.join(result['heavy_modules'])}")
+        results.append(result)
+
+    if args.output:
+        save_results(args.output, results, {"runs": args.runs})
+    if args.baseline and not check_baseline(results, args.baseline, args.max_regression):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,129 @@
+"""ベンチマーク結果の集計（パーセンタイル・スループット・メモリ）"""
+import json
+import math
+import os
+import resource
+import sys
+
+
+def percentile(values, q):
+    """values の q パーセンタイル（0〜100、最近傍法）"""
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = max(0, math.ceil(q / 100 * len(ordered)) - 1)
+    return ordered[index]
+
+
+def rss_mb():
+    """現在のプロセスの常駐メモリ（MB）。取得できない場合はピーク値"""
+    try:
+        with open("/proc/self/statm") as f:
+            pages = int(f.read().split()[1])
+        return pages * os.sysconf("SC_PAGE_SIZE") / 1024 / 1024
+    except (OSError, ValueError):
+        return peak_rss_mb()
+
+
+def peak_rss_mb():
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # macOS はバイト、Linux は KB 単位
+    return peak / 1024 / 1024 if sys.platform == "darwin" else peak / 1024
+
+
+def summarize(name, latencies, elapsed, statuses=None, **extra):
+    """
+    1シナリオ分の結果をまとめる
+
+    Args:
+        name (str): シナリオ名
+        latencies (list): 成功したリクエストのレイテンシ（秒）
+        elapsed (float): シナリオ全体の所要時間（秒）
+        statuses (dict): 結果（ステータス）毎の件数
+    """
+    statuses = dict(statuses or {})
+    total = sum(statuses.values()) or len(latencies)
+    return {
+        "scenario": name,
+        "requests": total,
+        "ok": len(latencies),
+        "statuses": statuses,
+        "p50": percentile(latencies, 50),
+        "p95": percentile(latencies, 95),
+        "p99": percentile(latencies, 99),
+        "max": max(latencies) if latencies else 0.0,
+        "throughput": len(latencies) / elapsed if elapsed > 0 else 0.0,
+        "elapsed": elapsed,
+        "rss_mb": rss_mb(),
+        "peak_rss_mb": peak_rss_mb(),
+        **extra,
+    }
+
+
+def format_result(result):
+    statuses = ", ".join(f"{key}={value}" for key, value in sorted(result["statuses"].items(), key=str))
+    lines = [
+        f"[{result['scenario']}] {result['ok']}/{result['requests']} ok in {result['elapsed']:.2f}s"
+        f" ({result['throughput']:.2f} req/s)",
+        f"  latency p50={result['p50'] * 1000:.0f}ms p95={result['p95'] * 1000:.0f}ms"
+        f" p99={result['p99'] * 1000:.0f}ms max={result['max'] * 1000:.0f}ms",
+        f"  memory rss={result['rss_mb']:.0f}MB peak={result['peak_rss_mb']:.0f}MB",
+    ]
+    if statuses:
+        lines.append(f"  statuses {statuses}")
+    for key in ("probe_p99", "loop_lag_p99"):
+        if key in result:
+            lines.append(f"  {key}={result[key] * 1000:.1f}ms")
+    return "\n".join(lines)
+
+
+def compare(results, baseline, max_regression):
+    """
+    ベースラインと比べて p95 / p99 が max_regression（割合）を超えて悪化したシナリオを返す
+
+    Returns:
+        list[str]: 悪化したシナリオの説明
+    """
+    baseline_by_name = {result["scenario"]: result for result in baseline}
+    regressions = []
+    for result in results:
+        base = baseline_by_name.get(result["scenario"])
+        if base is None:
+            continue
+        for key in ("p95", "p99", "probe_p99"):
+            if key not in result or not base.get(key):
+                continue
+            ratio = result[key] / base[key] - 1
+            if ratio > max_regression:
+                regressions.append(
+                    f"{result['scenario']} {key}: {base[key] * 1000:.0f}ms -> {result[key] * 1000:.0f}ms"
+                    f" (+{ratio:.0%})"
+                )
+    return regressions
+
+
+def load_results(path):
+    with open(path, encoding="utf-8") as f:
+        return json.load(f)["results"]
+
+
+def save_results(path, results, settings):
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump({"settings": settings, "results": results}, f, indent=2, ensure_ascii=False)
+
+
+def check_baseline(results, path, max_regression):
+    """
+    ベースラインと比較して結果を表示する
+
+    Returns:
+        bool: 悪化したシナリオがなければ True
+    """
+    regressions = compare(results, load_results(path), max_regression)
+    if regressions:
+        print("Regressions detected:")
+        for regression in regressions:
+            print(f"  {regression}")
+        return False
+    print("No regressions against baseline.")
+    return True
@@ -0,0 +1,9 @@
+import os
+import tempfile
+
+# テスト中のログ・履歴・キャッシュは一時ディレクトリに出力する（ai_gradio の import より前に設定する）
+_workdir = tempfile.mkdtemp(prefix="ai_gradio_tests_")
+os.environ.setdefault("LOG_DIR", os.path.join(_workdir, "logs"))
+os.environ.setdefault("HISTORY_DB_PATH", os.path.join(_workdir, "history.db"))
+os.environ.setdefault("LOG_LEVEL", "WARNING")
+os.environ.pop("SHARED_STATE_URL", None)
@@ -0,0 +1,74 @@
+import asyncio
+
+from ai_gradio.artifacts import ArtifactStore
+from ai_gradio.shared_state import InProcessBackend
+
+
+class SharedBackend(InProcessBackend):
+    """他のワーカー・ノードと共有している状態サーバーの代わり"""
+
+    shared = True
+
+
+def test_put_is_content_addressed():
+    store = ArtifactStore(disk_dir="", backend=InProcessBackend())
+    key = store.put("<html></html>")
+    assert key == store.put("<html></html>")
+    assert key == ArtifactStore.make_key(b"<html></html>")
+    assert store.get(key).content == b"<html></html>"
+    assert store.stats()["artifacts"] == 1
+
+
+def test_oldest_artifacts_are_evicted():
+    store = ArtifactStore(max_bytes=10, disk_dir="", backend=InProcessBackend())
+    first = store.put("123456")
+    second = store.put("abcdef")
+    assert store.get(first) is None
+    assert store.get(second) is not None
+
+
+def test_disk_layer_is_read_after_restart(tmp_path):
+    async def scenario():
+        key = ArtifactStore(disk_dir=str(tmp_path), backend=InProcessBackend()).put("<p>saved</p>")
+        # ディスクへの書き込みはバックグラウンドで行われる
+        for _ in range(100):
+            if (tmp_path / key[:2] / f"{key}.html").exists():
+                break
+            await asyncio.sleep(0.01)
+        restarted = ArtifactStore(disk_dir=str(tmp_path), backend=InProcessBackend())
+        return await restarted.aget(key), await restarted.aget("../../etc/passwd")
+
+    artifact, invalid = asyncio.run(scenario())
+    assert artifact.content == b"<p>saved</p>"
+    assert invalid is None
+
+
+def test_concurrent_disk_reads_add_the_artifact_once(tmp_path):
+    async def scenario():
+        content = "<p>concurrent</p>"
+        key = ArtifactStore.make_key(content.encode("utf-8"))
+        writer = ArtifactStore(disk_dir=str(tmp_path), backend=InProcessBackend())
+        writer._write_disk(key, content.encode("utf-8"))
+        store = ArtifactStore(disk_dir=str(tmp_path), backend=InProcessBackend())
+        first, second = await asyncio.gather(store.aget(key), store.aget(key))
+        return first, second, store
+
+    first, second, store = asyncio.run(scenario())
+    assert first is second
+    assert store.stats()["artifacts"] == 1
+    assert store._bytes == first.size
+
+
+def test_shared_artifact_must_match_its_key():
+    async def scenario():
+        backend = SharedBackend()
+        store = ArtifactStore(disk_dir="", backend=backend)
+        key = ArtifactStore.make_key(b"<p>original</p>")
+        await backend.set(f"artifact:{key}", "<p>tampered</p>", 60)
+        tampered = await store.aget(key)
+        await backend.set(f"artifact:{key}", "<p>original</p>", 60)
+        return tampered, await store.aget(key)
+
+    tampered, artifact = asyncio.run(scenario())
+    assert tampered is None
+    assert artifact.content == b"<p>original</p>"
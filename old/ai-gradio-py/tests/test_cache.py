@@ -0,0 +1,82 @@
+import asyncio
+import time
+
+from ai_gradio.cache import ResponseCache
+from ai_gradio.shared_state import InProcessBackend
+
+
+class SharedBackend(InProcessBackend):
+    """他のワーカー・ノードと共有している状態サーバーの代わり"""
+
+    shared = True
+
+
+def test_make_key_is_deterministic():
+    key = ResponseCache.make_key("openai", "gpt-4o", query="q", params={"b": 1, "a": 2})
+    assert key == ResponseCache.make_key("openai", "gpt-4o", params={"a": 2, "b": 1}, query="q")
+    assert key != ResponseCache.make_key("openai", "gpt-4o", query="q", params={"a": 2, "b": 2})
+    assert len(key) == 64
+
+
+def test_lru_eviction():
+    cache = ResponseCache(max_entries=2, ttl=60, disk_dir="")
+    cache.set("a", "A")
+    cache.set("b", "B")
+    assert cache.get("a") == "A"  # a を最近使ったものにする
+    cache.set("c", "C")
+    assert cache.get("b") is None
+    assert (cache.get("a"), cache.get("c")) == ("A", "C")
+    assert cache.stats()["entries"] == 2
+
+
+def test_expired_entries_are_misses():
+    cache = ResponseCache(ttl=-1, disk_dir="")
+    cache.set("a", "A")
+    assert cache.get("a") is None
+    stats = cache.stats()
+    assert (stats["hits"], stats["misses"], stats["entries"]) == (0, 1, 0)
+
+
+def test_disabled_cache_stores_nothing():
+    cache = ResponseCache(disk_dir="", enabled=False)
+    cache.set("a", "A")
+    assert cache.get("a") is None
+    assert cache.stats()["entries"] == 0
+
+
+def test_disk_layer_survives_restart(tmp_path):
+    ResponseCache(disk_dir=str(tmp_path), ttl=60).set("a" * 64, {"text": "A"})
+    restarted = ResponseCache(disk_dir=str(tmp_path), ttl=60)
+    assert restarted.get("a" * 64) == {"text": "A"}
+    assert restarted.stats()["disk_hits"] == 1
+
+
+def test_async_disk_layer(tmp_path):
+    async def scenario():
+        await ResponseCache(disk_dir=str(tmp_path), ttl=60).aset("b" * 64, "B")
+        restarted = ResponseCache(disk_dir=str(tmp_path), ttl=60)
+        return await restarted.aget("b" * 64), await restarted.aget("c" * 64), restarted.stats()
+
+    value, missing, stats = asyncio.run(scenario())
+    assert (value, missing) == ("B", None)
+    assert (stats["disk_hits"], stats["misses"]) == (1, 1)
+
+
+def test_expired_disk_entry_is_removed(tmp_path):
+    cache = ResponseCache(disk_dir=str(tmp_path), ttl=60)
+    key = "d" * 64
+    cache._write_disk(key, "D", time.time() - 1)
+    assert cache.get(key) is None
+    assert not (tmp_path / key[:2] / f"{key}.json").exists()
+
+
+def test_shared_backend_is_used_between_instances():
+    async def scenario():
+        backend = SharedBackend()
+        await ResponseCache(disk_dir="", backend=backend).aset("k", "V")
+        other = ResponseCache(disk_dir="", backend=backend)
+        return await other.aget("k"), other.stats()
+
+    value, stats = asyncio.run(scenario())
+    assert value == "V"
+    assert stats["shared_hits"] == 1
@@ -0,0 +1,107 @@
+import asyncio
+
+import pytest
+
+from ai_gradio.cancellation import CANCEL_DISCONNECTED, GenerationCancelled, GenerationRegistry
+
+
+async def counting(closed, count=None):
+    """0, 1, 2, ... を yield し、終了時（キャンセルを含む）に closed をセットする"""
+    try:
+        i = 0
+        while count is None or i < count:
+            yield i
+            i += 1
+            await asyncio.sleep(0)
+        if count is None:
+            await asyncio.sleep(10)
+    finally:
+        closed.set()
+
+
+async def collect(agen, limit=None):
+    items = []
+    async for item in agen:
+        items.append(item)
+        if limit is not None and len(items) >= limit:
+            break
+    return items
+
+
+def test_items_are_relayed_until_completion():
+    async def scenario():
+        registry = GenerationRegistry()
+        closed = asyncio.Event()
+        items = await collect(registry.run("s", counting(closed, count=3)))
+        return items, closed.is_set(), registry.stats()
+
+    assert asyncio.run(scenario()) == ([0, 1, 2], True, {"running": 0})
+
+
+def test_cancel_stops_the_generation():
+    async def scenario():
+        registry = GenerationRegistry()
+        closed = asyncio.Event()
+        items = []
+        with pytest.raises(GenerationCancelled) as excinfo:
+            async for item in registry.run("s", counting(closed)):
+                items.append(item)
+                if item == 1:
+                    assert registry.cancel("s", CANCEL_DISCONNECTED)
+        await asyncio.wait_for(closed.wait(), 1)
+        return items[:2], excinfo.value.reason, registry.stats()
+
+    items, reason, stats = asyncio.run(scenario())
+    assert items == [0, 1]
+    assert reason == CANCEL_DISCONNECTED
+    assert stats == {"running": 0}
+
+
+def test_resubmit_cancels_the_previous_generation_silently():
+    async def scenario():
+        registry = GenerationRegistry()
+        first_closed, second_closed = asyncio.Event(), asyncio.Event()
+        first = registry.run("s", counting(first_closed))
+        assert await first.__anext__() == 0
+        second = await collect(registry.run("s", counting(second_closed, count=2)))
+        # 再送信でキャンセルされた生成は例外を送出せずに終わる
+        rest = await collect(first)
+        return second, rest, first_closed.is_set()
+
+    second, rest, first_closed = asyncio.run(scenario())
+    assert second == [0, 1]
+    assert first_closed
+    assert len(rest) <= 1
+
+
+def test_errors_are_propagated():
+    async def failing():
+        yield "partial"
+        raise ValueError("boom")
+
+    async def scenario():
+        registry = GenerationRegistry()
+        items = []
+        with pytest.raises(ValueError):
+            async for item in registry.run("s", failing()):
+                items.append(item)
+        return items
+
+    assert asyncio.run(scenario()) == ["partial"]
+
+
+def test_consumer_stopping_cancels_the_generation():
+    async def scenario():
+        registry = GenerationRegistry()
+        closed = asyncio.Event()
+        run = registry.run("s", counting(closed))
+        items = await collect(run, limit=2)
+        await run.aclose()
+        await asyncio.wait_for(closed.wait(), 1)
+        return items, registry.stats()
+
+    assert asyncio.run(scenario()) == ([0, 1], {"running": 0})
+
+
+def test_cancel_without_running_generation():
+    assert GenerationRegistry().cancel("missing") is False
@@ -0,0 +1,73 @@
+import pytest
+
+from ai_gradio.fences import CodeExtractor, extract_code, parse_blocks, parse_fence
+
+RESPONSES = {
+    "html": "Here you go.\n\n```html\n<!DOCTYPE html>\n<html>\n<body>hi</body>\n</html>\n```\n\nEnjoy!\n",
+    "no_language": "```\n<p>plain</p>\n```\n",
+    "inline_close": "```html\n<html>\n<body>x</body>\n</html>```\ntrailing text\n",
+    "tilde": "~~~html\n<div>tilde</div>\n~~~\n",
+    "nested": "````markdown\nExample:\n```html\n<b>inner</b>\n```\n````\n```html\n<i>real</i>\n```\n",
+    "other_language_first": "```css\nbody { color: red; }\n```\n```html\n<p>page</p>\n```\n",
+    "unclosed": "Working on it:\n```html\n<html>\n<body>partial",
+    "no_block": "  Just an answer without code.  ",
+    "backticks_in_code": "```html\n<script>const s = `a ${b}`;</script>\n``not a fence\n```\n",
+}
+
+
+def stream_code(text, languages, token_size):
+    extractor = CodeExtractor(languages)
+    deltas = []
+    for i in range(0, len(text), token_size):
+        deltas.append(extractor.feed(text[i:i + token_size]))
+    deltas.append(extractor.close())
+    return extractor, "".join(deltas)
+
+
+@pytest.mark.parametrize("name", sorted(RESPONSES))
+@pytest.mark.parametrize("token_size", [1, 2, 3, 7, 64])
+@pytest.mark.parametrize("languages", [("html",), None])
+def test_streaming_matches_whole_text(name, token_size, languages):
+    text = RESPONSES[name]
+    extractor, streamed = stream_code(text, languages, token_size)
+    expected = extract_code(text, languages)
+    assert extractor.code == expected
+    assert extractor.text == text
+    # 逐次返したテキストも、取り出したブロックの中身と一致する（ブロックがない場合は何も返さない）
+    assert streamed.strip() == (expected if extractor.block is not None else "")
+
+
+def test_extract_code_selects_blocks():
+    assert extract_code(RESPONSES["html"], ("html",)).startswith("<!DOCTYPE html>")
+    assert extract_code(RESPONSES["no_language"], ("html",)) == "<p>plain</p>"
+    assert extract_code(RESPONSES["inline_close"], ("html",)) == "<html>\n<body>x</body>\n</html>"
+    assert extract_code(RESPONSES["tilde"], ("html",)) == "<div>tilde</div>"
+    assert extract_code(RESPONSES["other_language_first"], ("html",)) == "<p>page</p>"
+    assert extract_code(RESPONSES["other_language_first"]) == "body { color: red; }"
+    assert extract_code(RESPONSES["unclosed"], ("html",)) == "<html>\n<body>partial"
+    assert extract_code(RESPONSES["no_block"], ("html",)) == "Just an answer without code."
+
+
+def test_nested_blocks_do_not_close_the_outer_block():
+    blocks = parse_blocks(RESPONSES["nested"])
+    assert [block.language for block in blocks] == ["markdown", "html"]
+    assert "<b>inner</b>" in blocks[0].text
+    assert blocks[0].closed
+    assert extract_code(RESPONSES["nested"], ("html",)) == "<i>real</i>"
+
+
+def test_parse_fence():
+    assert parse_fence("```html\n") == ("```", "html")
+    assert parse_fence("  ~~~~ python title=x\n") == ("~~~~", "python title=x")
+    assert parse_fence("``not a fence\n") == (None, "")
+    assert parse_fence("```inline```\n") == (None, "")
+
+
+def test_streaming_emits_text_before_newline():
+    extractor = CodeExtractor(("html",))
+    assert extractor.feed("```html\n<div>") == "<div>"
+    assert extractor.feed("hello") == "hello"
+    # 閉じるフェンスの可能性がある末尾のバッククォートは保留する
+    assert extractor.feed("</div>``") == "</div>"
+    assert extractor.feed("`\n") == ""
+    assert extractor.block.closed
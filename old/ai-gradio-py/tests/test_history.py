@@ -0,0 +1,104 @@
+import sqlite3
+import time
+
+import pytest
+
+from ai_gradio.history import SCHEMA, HistoryStore
+
+
+@pytest.fixture
+def store(tmp_path):
+    store = HistoryStore(str(tmp_path / "history.db"), enabled=True)
+    yield store
+    store.close()
+
+
+def record(store, query, code="<html></html>", prompt_type="Web App", model="openai:gpt-4o"):
+    return store.record(query, model, prompt_type, "hash", code, latency=1.0)
+
+
+def queries(rows):
+    return [row["query"] for row in rows]
+
+
+def test_fts_search_matches_query_and_code(store):
+    record(store, "在庫管理アプリを作って", code="<h1>Inventory</h1>")
+    record(store, "todo list app", code="<ul id='todo'></ul>")
+    record(store, "calculator", code="<button>Inventory</button>")
+    assert store.fts_enabled
+    assert queries(store.search("在庫管理")) == ["在庫管理アプリを作って"]
+    # 新しい順に返す
+    assert queries(store.search("Inventory")) == ["calculator", "在庫管理アプリを作って"]
+    # 複数の語はすべてを含むものに絞り込む
+    assert queries(store.search("todo list")) == ["todo list app"]
+
+
+def test_fts_search_treats_input_as_text(store):
+    record(store, 'say "hello" OR NOT')
+    assert queries(store.search('"hello" OR')) == ['say "hello" OR NOT']
+
+
+def test_short_terms_fall_back_to_like(store):
+    record(store, "ToDo アプリ")
+    record(store, "calculator")
+    # trigram では検索できない2文字以下の語
+    assert queries(store.search("Do")) == ["ToDo アプリ"]
+
+
+def test_like_search_without_fts(store):
+    record(store, "在庫管理アプリ")
+    record(store, "calculator", prompt_type="Mermaid")
+    store.fts_enabled = False
+    assert queries(store.search("在庫")) == ["在庫管理アプリ"]
+    assert queries(store.search("", prompt_type="Mermaid")) == ["calculator"]
+
+
+def test_get_returns_rows_in_requested_order(store):
+    first, second = record(store, "first"), record(store, "second")
+    assert queries(store.get([second, first, 999])) == ["second", "first"]
+
+
+def test_retention_limits_entry_count(tmp_path):
+    store = HistoryStore(str(tmp_path / "history.db"), enabled=True, max_entries=2)
+    for query in ("one", "two", "three"):
+        record(store, query)
+    assert queries(store.search()) == ["three", "two"]
+    # 削除された履歴は全文検索のインデックスからも削除される
+    assert store.search("one") == []
+    store.close()
+
+
+def test_retention_limits_entry_age(tmp_path):
+    store = HistoryStore(str(tmp_path / "history.db"), enabled=True, max_age_days=1)
+    record(store, "old entry")
+    with store._lock:
+        store._conn.execute("UPDATE generations SET created_at = ?", (time.time() - 2 * 86400,))
+        store._conn.commit()
+    record(store, "new entry")
+    assert queries(store.search("entry")) == ["new entry"]
+    store.close()
+
+
+def test_existing_rows_are_indexed_when_fts_is_created(tmp_path):
+    path = str(tmp_path / "history.db")
+    # 全文検索を導入する前のデータベース
+    conn = sqlite3.connect(path)
+    conn.executescript(SCHEMA)
+    conn.execute(
+        "INSERT INTO generations (created_at, query, model, prompt_type, system_prompt_hash, code, latency)"
+        " VALUES (?, 'legacy dashboard', 'openai:gpt-4o', 'Web App', 'hash', '<div></div>', 1.0)",
+        (time.time(),),
+    )
+    conn.commit()
+    conn.close()
+
+    store = HistoryStore(path, enabled=True)
+    assert queries(store.search("dashboard")) == ["legacy dashboard"]
+    assert store.fts_enabled
+    store.close()
+
+
+def test_disabled_store_records_nothing(tmp_path):
+    store = HistoryStore(str(tmp_path / "history.db"), enabled=False)
+    assert record(store, "ignored") is None
+    assert store.search() == []
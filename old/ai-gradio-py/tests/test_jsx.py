@@ -0,0 +1,70 @@
+import pytest
+
+from ai_gradio.artifacts import artifact_store
+from ai_gradio.cache import ResponseCache
+from ai_gradio.integrated_gradio import fence_languages, extract_code, prepare_react_code, send_to_preview
+from ai_gradio.jsx import JSXCompiler, JSXSyntaxError, compile_jsx
+from ai_gradio.shared_state import InProcessBackend
+
+COMPONENT = """import React, { useState } from 'react';
+
+export default function GeneratedComponent() {
+  const [count, setCount] = useState(0);
+  return <button className="btn" onClick={() => setCount(count + 1)}>Clicked {count}</button>;
+}
+"""
+
+
+def make_compiler():
+    return JSXCompiler(ResponseCache(disk_dir="", enabled=True, backend=InProcessBackend()))
+
+
+def test_compile_elements_and_attributes():
+    assert compile_jsx('const a = <div id="x" {...rest}>hi</div>;') == (
+        'const a = React.createElement("div", {id: "x", ...rest}, "hi");'
+    )
+    assert compile_jsx("const b = <><Foo.Bar flag /></>;") == (
+        "const b = React.createElement(React.Fragment, null, React.createElement(Foo.Bar, {flag: true}));"
+    )
+
+
+def test_comparisons_and_strings_are_not_jsx():
+    source = "if (a < b && c > d) { s = '<div>'; t = `<p>${x}</p>`; }"
+    assert compile_jsx(source) == source
+
+
+def test_invalid_jsx_raises():
+    with pytest.raises(JSXSyntaxError):
+        compile_jsx("const a = <div>unclosed;")
+    with pytest.raises(JSXSyntaxError):
+        compile_jsx("const a = <div></span>;")
+
+
+def test_compiled_output_is_cached_by_source():
+    compiler = make_compiler()
+    first = compiler.compile("const a = <p>cached</p>;")
+    assert compiler.compile("const a = <p>cached</p>;") == first
+    assert compiler.stats()["compiled"] == 1
+    with pytest.raises(JSXSyntaxError):
+        compiler.compile("<p>")
+    assert compiler.stats()["errors"] == 1
+
+
+def test_react_imports_and_exports_are_removed():
+    code = prepare_react_code(COMPONENT)
+    assert "import" not in code
+    assert "const { useState } = React;" in code
+    assert "\nfunction GeneratedComponent()" in code
+
+
+def test_jsx_block_is_previewed_with_plain_script():
+    response = f"Here is the component:\n\n```jsx\n{COMPONENT}```\n"
+    code = extract_code(response, fence_languages("Web App"))
+    assert code.startswith("import React")
+    iframe = send_to_preview(code, iframe_id="react_test")
+    key = iframe.split("src=\"")[1].split("\"")[0].rstrip("/").split("/")[-1]
+    document = artifact_store.get(key).content.decode("utf-8")
+    assert "<script>" in document
+    assert "text/babel" not in document
+    assert "React.createElement(\"button\"" in document
+    assert "createRoot" in document
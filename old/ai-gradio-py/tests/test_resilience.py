@@ -0,0 +1,180 @@
+import asyncio
+
+import httpx
+import pytest
+
+from ai_gradio.resilience import (
+    CLOSED, HALF_OPEN, OPEN, CircuitBreaker, CircuitOpenError, ProviderResilience, RateLimiter,
+    get_retry_after, is_retryable,
+)
+from ai_gradio.shared_state import InProcessBackend
+
+
+class StatusError(Exception):
+    """SDK の APIStatusError の代わり"""
+
+    def __init__(self, status_code, headers=None):
+        super().__init__(f"status {status_code}")
+        self.status_code = status_code
+        self.headers = headers or {}
+
+
+def open_breaker(breaker):
+    for _ in range(breaker.failure_threshold):
+        breaker.before_call()
+        breaker.record_failure()
+
+
+def expire(breaker):
+    breaker.opened_at -= breaker.reset_timeout
+
+
+def make_resilience(**kwargs):
+    kwargs.setdefault("base_delay", 0.0)
+    kwargs.setdefault("max_delay", 0.0)
+    return ProviderResilience(rate_limiter=RateLimiter(backend=InProcessBackend()), **kwargs)
+
+
+def test_breaker_opens_after_consecutive_outages():
+    breaker = CircuitBreaker("test", failure_threshold=3, reset_timeout=30)
+    breaker.record_failure()
+    breaker.record_failure()
+    assert breaker.state == CLOSED
+    breaker.record_failure()
+    assert breaker.state == OPEN
+    with pytest.raises(CircuitOpenError) as excinfo:
+        breaker.before_call()
+    assert excinfo.value.status_code == 503
+    assert excinfo.value.retry_after >= 1
+
+
+def test_non_outage_errors_reset_the_failure_count():
+    breaker = CircuitBreaker("test", failure_threshold=2, reset_timeout=30)
+    breaker.record_failure()
+    breaker.record_failure(outage=False)
+    breaker.record_failure()
+    assert breaker.state == CLOSED
+
+
+def test_half_open_allows_a_single_probe_and_closes_on_success():
+    breaker = CircuitBreaker("test", failure_threshold=1, reset_timeout=30)
+    open_breaker(breaker)
+    expire(breaker)
+    breaker.before_call()
+    assert breaker.state == HALF_OPEN
+    # 試行中は他の呼び出しを通さない
+    with pytest.raises(CircuitOpenError):
+        breaker.before_call()
+    breaker.record_success()
+    assert (breaker.state, breaker.failures) == (CLOSED, 0)
+    breaker.before_call()
+
+
+def test_failed_probe_reopens_the_breaker():
+    breaker = CircuitBreaker("test", failure_threshold=3, reset_timeout=30)
+    open_breaker(breaker)
+    expire(breaker)
+    breaker.before_call()
+    breaker.record_failure()
+    assert breaker.state == OPEN
+    assert breaker.retry_in() > 0
+
+
+def test_inconclusive_or_cancelled_probe_frees_the_probe_slot():
+    breaker = CircuitBreaker("test", failure_threshold=1, reset_timeout=30)
+    open_breaker(breaker)
+    expire(breaker)
+    breaker.before_call()
+    breaker.record_failure(outage=False)
+    assert breaker.state == HALF_OPEN
+    breaker.before_call()
+    breaker.release()
+    breaker.before_call()
+    assert breaker.state == HALF_OPEN
+
+
+def test_retryable_errors():
+    assert is_retryable(StatusError(429))
+    assert is_retryable(StatusError(503))
+    assert not is_retryable(StatusError(400))
+    assert is_retryable(httpx.ConnectError("refused"))
+    assert not is_retryable(ValueError("bad"))
+
+
+def test_retry_after_headers():
+    assert get_retry_after(StatusError(429, {"Retry-After": "7"})) == 7.0
+    assert get_retry_after(StatusError(429, {"retry-after-ms": "1500"})) == 1.5
+    assert get_retry_after(StatusError(429)) is None
+
+
+def test_call_retries_transient_errors():
+    async def scenario():
+        resilience = make_resilience(max_attempts=3)
+        attempts = 0
+
+        async def func():
+            nonlocal attempts
+            attempts += 1
+            if attempts < 3:
+                raise StatusError(503)
+            return "ok"
+
+        return await resilience.call("test", "model", func), attempts, resilience.breaker("test").failures
+
+    assert asyncio.run(scenario()) == ("ok", 3, 0)
+
+
+def test_call_does_not_retry_client_errors():
+    async def scenario():
+        resilience = make_resilience(max_attempts=3)
+        attempts = 0
+
+        async def func():
+            nonlocal attempts
+            attempts += 1
+            raise StatusError(400)
+
+        with pytest.raises(StatusError):
+            await resilience.call("test", "model", func)
+        return attempts
+
+    assert asyncio.run(scenario()) == 1
+
+
+def test_open_breaker_stops_retries_and_rejects_calls():
+    async def scenario():
+        resilience = make_resilience(max_attempts=5, failure_threshold=2, reset_timeout=30)
+        attempts = 0
+
+        async def func():
+            nonlocal attempts
+            attempts += 1
+            raise StatusError(500)
+
+        with pytest.raises(StatusError):
+            await resilience.call("test", "model", func)
+        with pytest.raises(CircuitOpenError):
+            await resilience.call("test", "model", func)
+        return attempts, resilience.stats()["test"]["state"]
+
+    assert asyncio.run(scenario()) == (2, OPEN)
+
+
+def test_stream_is_not_retried_after_the_first_item():
+    async def scenario():
+        resilience = make_resilience(max_attempts=3)
+        attempts = 0
+
+        async def factory():
+            nonlocal attempts
+            attempts += 1
+            yield "partial"
+            raise StatusError(503)
+
+        received = []
+        with pytest.raises(StatusError):
+            async for item in resilience.stream("test", "model", factory):
+                received.append(item)
+        return received, attempts
+
+    assert asyncio.run(scenario()) == (["partial"], 1)
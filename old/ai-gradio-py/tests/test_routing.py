@@ -0,0 +1,138 @@
+import asyncio
+
+import httpx
+import pytest
+
+from ai_gradio.routing import HedgingRouter, LatencyTracker, is_fallback_error
+from ai_gradio.scheduler import Overloaded
+
+
+class StatusError(Exception):
+    """SDK の APIStatusError の代わり"""
+
+    def __init__(self, status_code):
+        super().__init__(f"status {status_code}")
+        self.status_code = status_code
+
+
+def make_router(**kwargs):
+    kwargs.setdefault("latency", LatencyTracker())
+    kwargs.setdefault("default_delay", 0.05)
+    kwargs.setdefault("min_delay", 0.0)
+    return HedgingRouter(**kwargs)
+
+
+def test_fallback_errors():
+    assert is_fallback_error(StatusError(503))
+    assert is_fallback_error(httpx.ReadTimeout("timeout"))
+    assert is_fallback_error(asyncio.TimeoutError())
+    assert is_fallback_error(Overloaded("busy", 429, 1))
+    assert not is_fallback_error(StatusError(400))
+    assert not is_fallback_error(ValueError("bad prompt"))
+
+
+def test_primary_result_is_returned():
+    async def scenario():
+        router = make_router()
+        calls = []
+
+        async def call(model):
+            calls.append(model)
+            return f"from {model}"
+
+        return await router.run(["a", "b"], call), calls
+
+    assert asyncio.run(scenario()) == (("from a", "a"), ["a"])
+
+
+def test_falls_back_on_outage():
+    async def scenario():
+        router = make_router(hedge=False)
+
+        async def call(model):
+            if model == "a":
+                raise StatusError(503)
+            return f"from {model}"
+
+        return await router.run(["a", "b"], call)
+
+    assert asyncio.run(scenario()) == ("from b", "b")
+
+
+def test_does_not_fall_back_on_client_errors():
+    async def scenario():
+        router = make_router(hedge=False)
+        calls = []
+
+        async def call(model):
+            calls.append(model)
+            raise StatusError(400)
+
+        with pytest.raises(StatusError):
+            await router.run(["a", "b"], call)
+        return calls
+
+    assert asyncio.run(scenario()) == ["a"]
+
+
+def test_last_error_is_raised_when_all_candidates_fail():
+    async def scenario():
+        router = make_router(hedge=False)
+
+        async def call(model):
+            raise Overloaded(f"{model} busy", 503, 1)
+
+        with pytest.raises(Overloaded) as excinfo:
+            await router.run(["a", "b"], call)
+        return str(excinfo.value)
+
+    assert asyncio.run(scenario()) == "b busy"
+
+
+def test_slow_primary_is_hedged_and_cancelled():
+    async def scenario():
+        router = make_router(default_delay=0.01)
+        cancelled = asyncio.Event()
+
+        async def call(model):
+            if model == "a":
+                try:
+                    await asyncio.sleep(10)
+                except asyncio.CancelledError:
+                    cancelled.set()
+                    raise
+            return f"from {model}"
+
+        result = await router.run(["a", "b"], call)
+        await asyncio.wait_for(cancelled.wait(), 1)
+        return result
+
+    assert asyncio.run(scenario()) == ("from b", "b")
+
+
+def test_router_does_not_record_latency():
+    async def scenario():
+        latency = LatencyTracker()
+        router = make_router(latency=latency)
+
+        async def call(model):
+            return "cached"
+
+        await router.run(["a"], call)
+        return latency.stats()
+
+    # 応答時間は provider を呼び出した箇所でのみ記録する（キャッシュのヒットなどは含めない）
+    assert asyncio.run(scenario()) == {}
+
+
+def test_hedge_delay_uses_observed_percentile():
+    latency = LatencyTracker()
+    router = HedgingRouter(latency=latency, hedge_percentile=95, min_delay=0.5, max_delay=5.0,
+                           default_delay=10.0, min_samples=20)
+    assert router.hedge_delay("a") == 10.0
+    for i in range(1, 21):
+        latency.observe("a", i * 0.1)
+    assert router.hedge_delay("a") == pytest.approx(1.9)
+    for _ in range(20):
+        latency.observe("b", 0.01)
+    assert router.hedge_delay("b") == 0.5
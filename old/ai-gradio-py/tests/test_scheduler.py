@@ -0,0 +1,114 @@
+import asyncio
+
+import pytest
+
+from ai_gradio.scheduler import AdmissionGate, FairScheduler, Overloaded
+
+
+def test_round_robin_between_tenants():
+    async def scenario():
+        scheduler = FairScheduler(max_active=1, max_per_tenant=1)
+        running = scheduler.submit("x")
+        tickets = {
+            "a1": scheduler.submit("a"),
+            "a2": scheduler.submit("a"),
+            "a3": scheduler.submit("a"),
+            "b1": scheduler.submit("b"),
+            "c1": scheduler.submit("c"),
+        }
+        running.release()
+        order = []
+        while len(order) < len(tickets):
+            granted = [name for name, ticket in tickets.items() if ticket.granted and name not in order]
+            assert len(granted) == 1
+            order.append(granted[0])
+            tickets[granted[0]].release()
+        return order
+
+    # 先に多く投入したテナントがあっても、他のテナントの先頭が先に割り当てられる
+    assert asyncio.run(scenario()) == ["a1", "b1", "c1", "a2", "a3"]
+
+
+def test_position_matches_round_robin_order():
+    async def scenario():
+        scheduler = FairScheduler(max_active=1, max_per_tenant=1)
+        running = scheduler.submit("x")
+        a1, a2, a3 = scheduler.submit("a"), scheduler.submit("a"), scheduler.submit("a")
+        b1, c1 = scheduler.submit("b"), scheduler.submit("c")
+        return running.position, [t.position for t in (a1, b1, c1, a2, a3)]
+
+    running, positions = asyncio.run(scenario())
+    assert running == 0
+    assert positions == [1, 2, 3, 4, 5]
+
+
+def test_per_tenant_limit():
+    async def scenario():
+        scheduler = FairScheduler(max_active=2, max_per_tenant=1)
+        a1, a2, b1 = scheduler.submit("a"), scheduler.submit("a"), scheduler.submit("b")
+        granted = (a1.granted, a2.granted, b1.granted)
+        a1.release()
+        return granted, a2.granted, scheduler.stats()
+
+    granted, a2_granted, stats = asyncio.run(scenario())
+    assert granted == (True, False, True)
+    assert a2_granted
+    assert stats == {"active": 2, "waiting": 0, "tenants": 2}
+
+
+def test_released_waiting_ticket_leaves_queue():
+    async def scenario():
+        scheduler = FairScheduler(max_active=1, max_per_tenant=1)
+        running = scheduler.submit("a")
+        cancelled, waiting = scheduler.submit("b"), scheduler.submit("c")
+        cancelled.release()
+        before = waiting.position
+        running.release()
+        return before, cancelled.granted, waiting.granted
+
+    assert asyncio.run(scenario()) == (1, False, True)
+
+
+def test_wait_times_out():
+    async def scenario():
+        scheduler = FairScheduler(max_active=1, max_per_tenant=1)
+        scheduler.submit("a")
+        ticket = scheduler.submit("b")
+        result = await ticket.wait(timeout=0.01)
+        ticket.release()
+        return result, scheduler.stats()
+
+    result, stats = asyncio.run(scenario())
+    assert result is False
+    assert stats["waiting"] == 0
+
+
+def test_admission_gate_rejects_when_queue_is_full():
+    async def scenario():
+        gate = AdmissionGate(max_concurrency=1, max_queue=0, queue_timeout=1.0)
+        ticket = await gate.acquire()
+        with pytest.raises(Overloaded) as excinfo:
+            await gate.acquire()
+        ticket.release()
+        ticket.release()  # 2回目の返却は無視される
+        return excinfo.value, gate.stats()
+
+    error, stats = asyncio.run(scenario())
+    assert error.status_code == 429
+    assert error.retry_after >= 1
+    assert stats["active"] == 0 and stats["rejected"] == 1
+
+
+def test_admission_gate_times_out_waiting_requests():
+    async def scenario():
+        gate = AdmissionGate(max_concurrency=1, max_queue=1, queue_timeout=0.01)
+        ticket = await gate.acquire()
+        with pytest.raises(Overloaded) as excinfo:
+            await gate.acquire()
+        ticket.release()
+        # 返却後は再び確保できる
+        async with gate.admit():
+            pass
+        return excinfo.value
+
+    assert asyncio.run(scenario()).status_code == 503
@@ -0,0 +1,138 @@
+import asyncio
+
+import pytest
+
+from ai_gradio.shared_state import InProcessBackend
+from ai_gradio.singleflight import SingleFlight
+
+
+class SharedBackend(InProcessBackend):
+    """他のワーカー・ノードと共有している状態サーバーの代わり"""
+
+    shared = True
+
+
+def test_concurrent_calls_share_one_execution():
+    async def scenario():
+        flight = SingleFlight(backend=InProcessBackend())
+        calls = 0
+        release = asyncio.Event()
+
+        async def factory():
+            nonlocal calls
+            calls += 1
+            await release.wait()
+            return "result"
+
+        tasks = [asyncio.create_task(flight.do("k", factory)) for _ in range(3)]
+        await asyncio.sleep(0)
+        release.set()
+        return await asyncio.gather(*tasks), calls, flight.stats()
+
+    results, calls, stats = asyncio.run(scenario())
+    assert results == ["result"] * 3
+    assert calls == 1
+    assert stats == {"in_flight": 0, "leaders": 1, "shared": 2, "remote_shared": 0}
+
+
+def test_errors_are_shared_and_not_remembered():
+    async def scenario():
+        flight = SingleFlight(backend=InProcessBackend())
+
+        async def failing():
+            await asyncio.sleep(0)
+            raise ValueError("boom")
+
+        results = await asyncio.gather(flight.do("k", failing), flight.do("k", failing), return_exceptions=True)
+
+        async def ok():
+            return "ok"
+
+        return results, await flight.do("k", ok)
+
+    results, retried = asyncio.run(scenario())
+    assert all(isinstance(r, ValueError) for r in results)
+    # 失敗した呼び出しは保持されないため、次の呼び出しは改めて実行される
+    assert retried == "ok"
+
+
+def test_cancelled_waiter_does_not_cancel_others():
+    async def scenario():
+        flight = SingleFlight(backend=InProcessBackend())
+        release = asyncio.Event()
+
+        async def factory():
+            await release.wait()
+            return "result"
+
+        first = asyncio.create_task(flight.do("k", factory))
+        second = asyncio.create_task(flight.do("k", factory))
+        await asyncio.sleep(0)
+        first.cancel()
+        await asyncio.sleep(0)
+        release.set()
+        with pytest.raises(asyncio.CancelledError):
+            await first
+        return await second
+
+    assert asyncio.run(scenario()) == "result"
+
+
+def test_cancelling_all_waiters_cancels_the_call():
+    async def scenario():
+        flight = SingleFlight(backend=InProcessBackend())
+        cancelled = asyncio.Event()
+        started = 0
+
+        async def factory():
+            nonlocal started
+            started += 1
+            try:
+                await asyncio.sleep(10)
+            except asyncio.CancelledError:
+                cancelled.set()
+                raise
+            return "stale"
+
+        waiters = [asyncio.create_task(flight.do("k", factory)) for _ in range(2)]
+        await asyncio.sleep(0)
+        for waiter in waiters:
+            waiter.cancel()
+        await asyncio.gather(*waiters, return_exceptions=True)
+        await asyncio.wait_for(cancelled.wait(), 1)
+
+        async def fresh():
+            return "fresh"
+
+        # 放棄された呼び出しは共有されず、新たに実行される
+        return await flight.do("k", fresh), started, flight.stats()["leaders"]
+
+    result, started, leaders = asyncio.run(scenario())
+    assert result == "fresh"
+    assert (started, leaders) == (1, 2)
+
+
+def test_result_from_another_worker_is_reused():
+    async def scenario():
+        backend = SharedBackend()
+        worker_a = SingleFlight(backend=backend, poll_interval=0.01)
+        worker_b = SingleFlight(backend=backend, poll_interval=0.01)
+        release = asyncio.Event()
+        calls = []
+
+        async def factory(name):
+            calls.append(name)
+            await release.wait()
+            return f"from {name}"
+
+        leader = asyncio.create_task(worker_a.do("k", lambda: factory("a")))
+        await asyncio.sleep(0.01)
+        follower = asyncio.create_task(worker_b.do("k", lambda: factory("b")))
+        await asyncio.sleep(0.01)
+        release.set()
+        return await leader, await follower, calls, worker_b.stats()["remote_shared"]
+
+    leader, follower, calls, remote_shared = asyncio.run(scenario())
+    assert (leader, follower) == ("from a", "from a")
+    assert calls == ["a"]
+    assert remote_shared == 1
@@ -0,0 +1,29 @@
+import pytest
+from fastapi.testclient import TestClient
+
+from ai_gradio import state_server
+from ai_gradio.state_server import create_state_app, is_loopback
+
+
+def test_loopback_hosts():
+    assert is_loopback("127.0.0.1")
+    assert is_loopback("::1")
+    assert is_loopback("localhost")
+    assert not is_loopback("0.0.0.0")
+    assert not is_loopback("state-host")
+
+
+def test_refuses_public_host_without_token(monkeypatch):
+    monkeypatch.setattr(state_server, "STATE_SERVER_TOKEN", "")
+    with pytest.raises(SystemExit):
+        state_server.main(["--host", "0.0.0.0"])
+
+
+def test_token_is_required_when_set():
+    client = TestClient(create_state_app(token="secret"))
+    assert client.post("/state/get", json={"key": "k"}).status_code == 401
+    response = client.post("/state/set", json={"key": "k", "value": "v", "ttl": 60},
+                           headers={"Authorization": "Bearer secret"})
+    assert response.status_code == 200
+    response = client.post("/state/get", json={"key": "k"}, headers={"Authorization": "Bearer secret"})
+    assert response.json() == {"result": "v"}
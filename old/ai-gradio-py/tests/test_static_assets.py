@@ -0,0 +1,48 @@
+import hashlib
+
+from ai_gradio.static_assets import STATIC_ROUTE_PREFIX, StaticAssets, static_assets
+
+CONTENT = b"console.log('vendored');"
+
+
+def make_assets(tmp_path):
+    assets = {"lib.js": ("vendor/lib/1.0.0/lib.min.js", hashlib.sha256(CONTENT).hexdigest())}
+    return StaticAssets(str(tmp_path), assets)
+
+
+def write(tmp_path, content):
+    path = tmp_path / "vendor" / "lib" / "1.0.0" / "lib.min.js"
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_bytes(content)
+
+
+def test_bundled_assets_match_their_pins():
+    assert static_assets.missing() == []
+
+
+def test_url_contains_content_hash(tmp_path):
+    write(tmp_path, CONTENT)
+    assets = make_assets(tmp_path)
+    version = hashlib.sha256(CONTENT).hexdigest()[:16]
+    assert assets.url("lib.js") == f"{STATIC_ROUTE_PREFIX}/{version}/vendor/lib/1.0.0/lib.min.js"
+    asset, content_type = assets.get(version, "vendor/lib/1.0.0/lib.min.js")
+    assert asset.content == CONTENT
+    assert content_type.startswith("text/javascript")
+    assert assets.get("0" * 16, "vendor/lib/1.0.0/lib.min.js") is None
+    assert assets.get(version, "../lib.min.js") is None
+
+
+def test_missing_file_is_picked_up_later(tmp_path):
+    assets = make_assets(tmp_path)
+    assert assets.missing() == ["lib.js"]
+    assert assets.url("lib.js").startswith(f"{STATIC_ROUTE_PREFIX}/missing/")
+    write(tmp_path, CONTENT)
+    assert assets.missing() == []
+    assert assets.load("lib.js").content == CONTENT
+
+
+def test_modified_file_is_not_served(tmp_path):
+    write(tmp_path, b"alert('modified');")
+    assets = make_assets(tmp_path)
+    assert assets.load("lib.js") is None
+    assert assets.missing() == ["lib.js"]